@@ -36,7 +36,7 @@ as part of this package.
 
 """
 
-from bamnostic.core import AlignmentFile, AlignedSegment
+from bamnostic.core import AlignmentFile, AlignedSegment, RecordBatch
 
 import pkg_resources
 example_bam = pkg_resources.resource_filename('bamnostic', 'data/') + 'example.bam'
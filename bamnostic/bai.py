@@ -17,8 +17,8 @@ reads that are associated with specific subsections of the BAM file. When the BA
 random access to the BAM is available.
 
 This script is for parsing the binary encoded BAI file, inherently making it human readable.
-Furthermore, it allows subsections of the BAI to be loaded into memory, reducing the memory
-footprint and speeding up queries within a small number of references. Lastly, by parsing it
+Furthermore, the BAI is held in memory as flat arrays of virtual offsets, keeping the memory
+footprint small while making queries that jump between references cheap. Lastly, by parsing it
 as such, random access queries directly into the associated BAM file is available to other
 tools within bamnostic
 
@@ -28,11 +28,13 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import division
 
+import gzip
 import struct
 import os
 import sys
 import warnings
 from array import array
+from bisect import bisect_left
 from collections import namedtuple
 
 _PY_VERSION = sys.version
@@ -40,9 +42,7 @@ _PY_VERSION = sys.version
 if _PY_VERSION.startswith('2'):
     from io import open
 
-if not _PY_VERSION.startswith('2'):
-    from functools import lru_cache
-
+import bamnostic
 from bamnostic.utils import *
 
 
@@ -57,18 +57,39 @@ unpack_chunk = struct.Struct('<2Q').unpack
 unpack_intervals = struct.Struct('<Q').unpack
 unpack_bid_nchunk = struct.Struct('<Ii').unpack
 unpack_unmapped = struct.Struct('<4Q').unpack
+unpack_int32L_from = struct.Struct('<l').unpack_from
+unpack_bid_nchunk_from = struct.Struct('<Ii').unpack_from
+unpack_bid_loffset_nchunk_from = struct.Struct('<IQi').unpack_from
+unpack_unmapped_from = struct.Struct('<4Q').unpack_from
+# refID, pos, bin_mq_nl, flag_nc of a BAM record (after its block_size)
+unpack_record_start_from = struct.Struct('<2i2I').unpack_from
+
+# `array` typecode of virtual offsets: 'Q' is not available on Python 2,
+# where 'L' is 64 bits wide on 64-bit platforms
+try:
+    array('Q')
+    _VOFFSET_TYPE = 'Q'
+except ValueError:
+    _VOFFSET_TYPE = 'L'
 
 
-class conditional_decorator(object):
-    def __init__(self, dec, condition):
-        self.decorator = dec
-        self.condition = condition
+def _voffset_array(data):
+    """Reads little-endian unsigned 64-bit integers (virtual offsets) into an `array`
 
-    def __call__(self, func):
-        if self.condition:
-            # Return the function unchanged, not decorated.
-            return func
-        return self.decorator(func)
+    Args:
+        data (bytes): the packed integers
+
+    Returns:
+        (:py:obj:`array.array`): the integers
+    """
+    arr = array(_VOFFSET_TYPE)
+    if hasattr(arr, 'frombytes'):
+        arr.frombytes(data)
+    else:
+        arr.fromstring(data)
+    if sys.byteorder == 'big':
+        arr.byteswap()
+    return arr
 
 
 # __slot__ classes for performant named indexing and future-proofing &readability
@@ -88,12 +109,66 @@ class Chunk(object):
     def __init__(self, handle):
         self.voffset_beg, self.voffset_end = unpack_chunk(handle.read(16))
 
+    @classmethod
+    def from_offsets(cls, voffset_beg, voffset_end):
+        chunk = cls.__new__(cls)
+        chunk.voffset_beg, chunk.voffset_end = voffset_beg, voffset_end
+        return chunk
+
 
 class Ref(object):
-    __slots__ = ['bins', 'intervals', 'ref_id']
+    """Index of a single reference, held in flat arrays
 
-    def __init__(self, *args):
-        self.bins, self.intervals, self.ref_id = args
+    Attributes:
+        bin_ids (:py:obj:`array.array`): sorted IDs of the bins of the reference
+        bin_bounds (:py:obj:`array.array`): the chunks of `bin_ids[i]` are chunks \
+            `bin_bounds[i]` to `bin_bounds[i + 1]` (exclusive)
+        chunks (:py:obj:`array.array`): begin and end virtual offsets of every chunk, interleaved
+        all_intervals (:py:obj:`array.array`): linear indices of all the references, back to back
+        ioffset (int): position of the first linear interval of the reference within `all_intervals`
+        n_intervals (int): number of linear intervals of the reference
+        ref_id (int): TID/refID of the reference
+        bin_loffsets (None|:py:obj:`array.array`): for CSI indices, which have no linear index, \
+            the virtual offset of the first read overlapping each bin of `bin_ids`
+    """
+    __slots__ = ['bin_ids', 'bin_bounds', 'chunks', 'all_intervals', 'ioffset', 'n_intervals', 'ref_id',
+                 'bin_loffsets']
+
+    def __init__(self, bin_ids, bin_bounds, chunks, all_intervals, ioffset, n_intervals, ref_id,
+                 bin_loffsets=None):
+        (self.bin_ids, self.bin_bounds, self.chunks, self.all_intervals,
+         self.ioffset, self.n_intervals, self.ref_id) = (bin_ids, bin_bounds, chunks, all_intervals,
+                                                         ioffset, n_intervals, ref_id)
+        self.bin_loffsets = bin_loffsets
+
+    def bin_chunks(self, bin_id):
+        """Finds the chunks of a bin
+
+        Args:
+            bin_id (int): distinct bin ID
+
+        Returns:
+            (:py:obj:`tuple` of int): first and one past the last index of the bin's chunks \
+                within `chunks` (counted in chunks, not offsets). Both are equal if the bin is empty.
+        """
+        i = bisect_left(self.bin_ids, bin_id)
+        if i < len(self.bin_ids) and self.bin_ids[i] == bin_id:
+            return self.bin_bounds[i], self.bin_bounds[i + 1]
+        return 0, 0
+
+    @property
+    def bins(self):
+        """Dictionary of bin IDs and their lists of `Chunk` objects (built on each access)"""
+        bins = {}
+        for i, bin_id in enumerate(self.bin_ids):
+            bins[bin_id] = [Chunk.from_offsets(self.chunks[2 * j], self.chunks[2 * j + 1])
+                            for j in range(self.bin_bounds[i], self.bin_bounds[i + 1])]
+        return bins
+
+    @property
+    def intervals(self):
+        """Linear index of the reference: virtual offset of the first read of each 16384 bp window"""
+        return self.all_intervals[self.ioffset:self.ioffset + self.n_intervals]
 
 
 class Unmapped(object):
@@ -106,31 +181,39 @@ class Unmapped(object):
         self.n_unmapped = numap
 
 
-def reg2bin(beg, end):
+def reg2bin(beg, end, min_shift=14, depth=5):
     """Finds the largest superset bin of region. Numeric values taken from hts-specs
 
     Args:
         beg (int): inclusive beginning position of region
         end (int): exclusive end position of region
+        min_shift (int): size of the smallest bins, as a power of 2 (default: 14, as in BAI)
+        depth (int): number of levels of bins below the root bin (default: 5, as in BAI)
 
     Returns:
         (int): distinct bin ID for largest superset bin of region
+
+    Example:
+        >>> reg2bin(100, 200), reg2bin(100, 200, min_shift=12, depth=6)
+        (4681, 37449)
+
     """
-    left_shift = 15
-    for i in range(14, 27, 3):
-        if beg >> i == (end - 1) >> i:
-            return int(((1 << left_shift) - 1) / 7 + (beg >> i))
-        left_shift -= 3
-    else:
-        return 0
+    shift = min_shift
+    for level in range(depth, 0, -1):
+        if beg >> shift == (end - 1) >> shift:
+            return ((1 << 3 * level) - 1) // 7 + (beg >> shift)
+        shift += 3
+    return 0
 
 
-def reg2bins(rbeg, rend):
+def reg2bins(rbeg, rend, min_shift=14, depth=5):
     """Generates bin ids which overlap the specified region.
 
     Args:
         beg (int): inclusive beginning position of region
         end (int): exclusive end position of region
+        min_shift (int): size of the smallest bins, as a power of 2 (default: 14, as in BAI)
+        depth (int): number of levels of bins below the root bin (default: 5, as in BAI)
 
     Yields:
         (int): bin IDs for overlapping bins of region
@@ -139,22 +222,50 @@ def reg2bins(rbeg, rend):
         AssertionError (Exception): if the range is malformed or invalid
     """
     # Based off the algorithm presented in:
-    # https://samtools.github.io/hts-specs/SAMv1.pdf
-
-    # Bin calculation constants.
-    BIN_ID_STARTS = (0, 1, 9, 73, 585, 4681)
+    # https://samtools.github.io/hts-specs/SAMv1.pdf and CSIv1.pdf
 
-    # Maximum range supported by specifications.
-    MAX_RNG = (2 ** 29) - 1
+    # Maximum range supported by the binning scheme (2 ** 29 - 1 for BAI).
+    MAX_RNG = (1 << (min_shift + 3 * depth)) - 1
 
     assert 0 <= rbeg <= rend <= MAX_RNG, 'Invalid region {}, {}'.format(rbeg, rend)
 
-    for start, shift in zip(BIN_ID_STARTS, range(29, 13, -3)):
+    # The first bin ID of each level: 0, 1, 9, 73, 585, 4681, ...
+    start = 0
+    for level in range(depth + 1):
+        shift = min_shift + 3 * (depth - level)
         i = rbeg >> shift if rbeg > 0 else 0
         j = rend >> shift if rend < MAX_RNG else MAX_RNG >> shift
 
         for bin_id_offset in range(i, j + 1):
             yield start + bin_id_offset
+        start += 1 << 3 * level
+
+
+def merge_chunks(chunks):
+    """Sorts chunks of a BAM file and merges those that can be read in one go
+
+    Chunks are merged when they overlap, or when one starts in the BGZF block
+    where the previous one ends.
+
+    Args:
+        chunks (:py:obj:`list` of :py:obj:`tuple`): (voffset_beg, voffset_end) of the chunks
+
+    Returns:
+        (:py:obj:`list` of :py:obj:`tuple`): sorted (voffset_beg, voffset_end) of the merged chunks
+
+    Example:
+        >>> merge_chunks([(5 << 16, 6 << 16), (1 << 16, 2 << 16 | 10), (2 << 16 | 40, 3 << 16)])
+        [(65536, 196608), (327680, 393216)]
+
+    """
+    merged = []
+    for voffset_beg, voffset_end in sorted(chunks):
+        if merged and voffset_beg >> 16 <= merged[-1][1] >> 16:
+            if voffset_end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], voffset_end)
+        else:
+            merged.append((voffset_beg, voffset_end))
+    return merged
 
 
 class Bai(object):
@@ -172,27 +283,30 @@ class Bai(object):
         _io (fileObject): opened BAI file object
         _LINEAR_INDEX_WINDOW (int): constant of the linear interval window size
         _UNMAP_BIN (int): constant for bin ID of unmapped read stats
+        min_shift (int): size of the smallest bins (and linear index windows), as a power of 2
+        depth (int): number of levels of bins below the root bin
         magic (bytes): first 4 bytes of file. Must be equal to b'BAI\x01'
         n_refs (int): number of references in BAI
         unmapped (dict): dictionary of the unmapped read stats by each reference
-        current_ref (None|dict): dictionary of the current reference loaded into memory.
-                                It contains the a dictionary of bin IDs and their respective
-                                chunks, and a list of linear intervals.
+        current_ref (None|Ref): the reference last queried
         ref_indices (dict): dictionary of reference ids and their start/stop offsets within the BAI file
         n_no_coord (None|int): if present in BAI, is the number of reads that have no coordinates
         _last_pos (int): used for indexing, the byte position of the file head.
+        _refs (dict): the `Ref` of each reference id
+        _intervals (:py:obj:`array.array`): linear indices of all the references, back to back
 
     """
-    __slots__ = ['_io', '_LINEAR_INDEX_WINDOW', '_UNMAP_BIN', 'BAM_LIDX_SHIFT',
+    __slots__ = ['_io', '_LINEAR_INDEX_WINDOW', '_UNMAP_BIN', 'BAM_LIDX_SHIFT', 'min_shift', 'depth',
                  'magic', 'n_refs', 'unmapped', 'current_ref', 'ref_indices',
-                 'n_no_coor', '_last_pos']
+                 'n_no_coor', '_last_pos', '_refs', '_intervals']
 
     def __init__(self, filename):
         """Initialization method
 
-        Generates an "index" of the index. This gives us the byte positions of each chromosome
-        within the index file. Now, when a user queries over a specific chromosome, it pulls
-        out just the index information for that chromosome--not the whole genome.
+        The whole index is parsed in a single pass. The chunks of each reference are
+        kept in one flat array of virtual offsets, ordered by bin ID, and the linear
+        indices of all the references share a single array. Switching between
+        references therefore costs nothing, and no object is built per chunk.
 
         Args:
             filename (str): '/path/to/bam_file' that automatically adds the '.bai' suffix
@@ -211,219 +325,212 @@ class Bai(object):
         self._LINEAR_INDEX_WINDOW = 16384
         self._UNMAP_BIN = 37450
         self.BAM_LIDX_SHIFT = 14
+        self.min_shift, self.depth = 14, 5
 
         self.magic, self.n_refs = unpack("<4sl", self._io)
         assert self.magic == b'BAI\x01', 'Wrong BAI magic header'
 
+        self._load()
+
+    def _load(self):
+        """(PRIVATE) Parses the references of the index, from the current position of the file on"""
         self.unmapped = {}
         self.current_ref = None
+        self.ref_indices = {}
+        self._refs = {}
 
-        # Capture the offsets for each reference within the index
-        self.ref_indices = {ref: self.get_ref(ref, idx=True) for ref in range(self.n_refs)}
+        data = self._io.read()
+        cursor = self._parse_refs(data, self._io.tell() - len(data))
 
         # Get the n_no_coor if it is present
-        nnc_dat = self._io.read(8)
+        nnc_dat = data[cursor:cursor + 8]
         self.n_no_coor = unpack('<Q', nnc_dat) if nnc_dat else None
 
         self._last_pos = self._io.tell()
 
-    def get_chunks(self, n_chunks):
-        """Simple generator for unpacking chunk data
-
-        Chunks are defined as groupings of reads within a BAM file
-        that share the same bin. A `Chunk` object in the context of
-        this function is a `namedtuple` that contains the virtual offsets
-        for the beginning and end of each of these chunks.
+    def _parse_refs(self, data, data_offset):
+        """(PRIVATE) Parses the bins, chunks, and linear indices of all the references
 
-        Note: a special case of a chunk is in any Bin labeled as 37450.
-        These bins always contain 2 chunks that provide the statistics
-        of the number of reads that are unmapped to that reference.
+        Sets `ref_indices`, `unmapped`, `_refs`, and `_intervals`. The bins of CSI
+        indices carry their own offset (`loffset`) in place of a linear index.
 
         Args:
-            n_chunks (int): number of chunks to be unpacked from stream
+            data (bytes): contents of the index file, from the first reference on
+            data_offset (int): position of `data` within the index file
 
         Returns:
-            chunks (list): a list of Chunk objects with the attributes of
-                            chunks[i] are .voffset_beg and voffset_end
-        """
-        chunks = [Chunk(self._io) for chunk in range(n_chunks)]
-        return chunks
-
-    # TODO: Add a check for long reads and allow for skipping the linear index on queries
-    def get_ints(self, n_int):
-        """Unpacks `n_int` number of interval virtual offsets from stream
-
-        A linear interval is defined as a 16384 bp window along a given reference. The
-        value stored in the BAI is the virtual offset of the first read within
-        that given interval. This virtual offset is the byte offset (coffset) of the start of the
-        BGZF block that contains the beginning of the read and the byte offset (uoffset)
-        within the uncompressed data of the residing BGZF block to that first read.
+            (int): position of the end of the references within `data`
 
-        Note: a caveat to using linear interval with long reads: A long read can
-        span multiple linear intervals. As such, the current encoding could potentially shift
-        the expected region of interest to the left more than expected.
-
-        Args:
-            n_int (int): number of intervals to unpack
-
-        Returns:
-            intervals (list): list of virtual offsets for `n_int` number of linear intervals
-        """
-        intervals = unpack('<{}Q'.format(n_int), self._io)
-        return intervals if type(intervals) != int else [intervals]
-
-    def get_bins(self, n_bins, ref_id=None, idx=False):
-        """Simple function that iteratively unpacks the data of a number (`n_bin`)
-        of bins.
-
-        As the function discovers the number of chunks needed for a given
-        bin, it deletages work to `self.get_chunks(n_chunks)`. A bin is
-        comprised of 2 parts: 1) the distinct bin ID (within a given reference). If
-        no reads are associated with that bin, it is left out of the indexing process,
-        and therefore not represented in the BAI file. Furthermore, while each bin
-        has a bin ID, the bin IDs are only distinct within a given reference. This means
-        that 2 or more references can have the same bin IDs. These bin IDs are also
-        not in any order as they are essentially a hash dump. Lastly, the only reserved
-        bin ID is 37450. This bin relates to 2 chunks that contain the number of
-        unmapped and mapped reads for a given reference. 2) the chunk(s) of reads that
-        are assigned to a given bin.
-
-        As a secondary feature, this function will also quickly seek over regions for
-        the purposes of documenting the start and stop byte offsets of a given reference
-        block within the file. This is invoked by setting `idx=True`
-
-
-        Args:
-            n_int (int): number of bins to be unpacked from stream
-
-        Returns:
-            bins (None | dict): None if just indexing the index file or a dictionary
-                                of `bin_id: chunks` pairs
         Raises:
-            AssertionError (Exception): if bin 37450 does not contain 2 chunks exactly
+            AssertionError (Exception): if bin 37450 (the pseudo-bin) does not contain 2 chunks exactly
         """
-        bins = None if idx else {}
-
-        for b in range(n_bins):
-            bin_id, n_chunks = unpack_bid_nchunk(self._io.read(8))
-
-            if idx:
-                if bin_id == self._UNMAP_BIN:
-                    assert n_chunks == 2, 'Bin 3740 is supposed to have 2 chunks. This has {}'.format(n_chunks)
-                    unmapped = Unmapped(*unpack_unmapped(self._io.read(32)))
-                    self.unmapped[ref_id] = unmapped
+        csi = self.magic == b'CSI\x01'
+        cursor = 0
+        refs = []
+        interval_data = []
+        n_intervals_total = 0
+        for ref_id in range(self.n_refs):
+            ref_start = cursor
+            n_bins = unpack_int32L_from(data, cursor)[0]
+            cursor += 4
+
+            bins = []
+            for b in range(n_bins):
+                if csi:
+                    bin_id, loffset, n_chunks = unpack_bid_loffset_nchunk_from(data, cursor)
+                    cursor += 16  # 16 = struct.calcsize('<IQi')
                 else:
-                    if not n_chunks == 0:
-                        self._io.seek(16 * n_chunks, 1)  # 16 = struct.calcsize('<2Q')
+                    bin_id, n_chunks = unpack_bid_nchunk_from(data, cursor)
+                    loffset = None
+                    cursor += 8
+                if bin_id == self._UNMAP_BIN:
+                    assert n_chunks == 2, 'Bin {} is supposed to have 2 chunks. This has {}'.format(bin_id, n_chunks)
+                    self.unmapped[ref_id] = Unmapped(*unpack_unmapped_from(data, cursor))
+                bins.append((bin_id, cursor, n_chunks, loffset))
+                cursor += 16 * n_chunks  # 16 = struct.calcsize('<2Q')
+            bins.sort()
+
+            bin_bounds = array('L', [0])
+            for bin_id, chunk_start, n_chunks, loffset in bins:
+                bin_bounds.append(bin_bounds[-1] + n_chunks)
+            chunks = _voffset_array(b''.join([data[chunk_start:chunk_start + 16 * n_chunks]
+                                              for bin_id, chunk_start, n_chunks, loffset in bins]))
+            bin_loffsets = array(_VOFFSET_TYPE, [loffset for bin_id, chunk_start, n_chunks, loffset in bins]) \
+                if csi else None
+
+            if csi:
+                n_int = 0
             else:
-                chunks = self.get_chunks(n_chunks)
-                bins[bin_id] = chunks
-        else:
-            return bins
+                n_int = unpack_int32L_from(data, cursor)[0]
+                cursor += 4
+                interval_data.append(data[cursor:cursor + 8 * n_int])
+                cursor += 8 * n_int  # 8 = struct.calcsize('<Q')
+
+            refs.append((array('I', [bin_id for bin_id, chunk_start, n_chunks, loffset in bins]),
+                         bin_bounds, chunks, n_intervals_total, n_int, ref_id, bin_loffsets))
+            n_intervals_total += n_int
+            self.ref_indices[ref_id] = RefIdx(data_offset + ref_start, data_offset + cursor, n_bins)
+
+        self._intervals = _voffset_array(b''.join(interval_data))
+        for bin_ids, bin_bounds, chunks, ioffset, n_int, ref_id, bin_loffsets in refs:
+            self._refs[ref_id] = Ref(bin_ids, bin_bounds, chunks, self._intervals, ioffset, n_int, ref_id,
+                                     bin_loffsets)
+        return cursor
 
-    # Cache the references to speed up queries.
-
-    # @functools.lru_cache(maxsize=256, typed=True)
-    # @lru_cache(6)
-    @conditional_decorator(lambda func: lru_cache(maxsize=6)(func), _PY_VERSION.startswith('2'))
     def get_ref(self, ref_id=None, idx=False):
-        """Interatively unpacks all the bins, linear intervals, and chunks for a given reference
+        """Gets the index of a given reference
 
         A reference is comprised of 2 things: 1) a series of bins that reference chunks of aligned
         reads that are grouped within that bin. 2) a series of virtual offsets of the first read of a
         16384 bp window along the given reference.
 
-        This function also serves to "index" the BAI file such that, if it is invoked by setting
-        `ids=True`, will do a single pass through the BAI file and saving the start and stop
-        offsets of each of the references. This is used for minimizing the memory footprint of
-        storing the BAI in memory. When queried against, the appropriate reference block will be
-        loaded. Because of this constant loading, `functools.lru_cache` was applied to cache recently
-        used reference blocks to speed up computation. It is assumed that when querying is done, most
-        users are looking and just a few references at a time.
+        All the references are parsed when the index is opened, so this is a lookup.
 
         Args:
-            ref_id (None|int): used for random access or indexing the BAI
-            idx (bool): Flag for setting whether or not to run an index of the BAI
+            ref_id (int): TID/refID of the reference
+            idx (bool): return the location of the reference within the BAI file instead
 
         Returns:
             RefIdx: `namedtuple` containing the byte offsets of the reference start, stop, and number of bins
             or
-            Ref: `namedtuple` containing a dictionary of bins and list of linear intervals
+            Ref: the bins, chunks, and linear intervals of the reference
 
         Raises:
-            AssertionError (Exception): if, when random access is used, the current reference offset
-                                        does not match indexed reference offset.
+            KeyError: if the reference is not in the index
         """
-        if ref_id is not None and not idx:
-            try:
-                ref_start, _, _ = self.ref_indices[ref_id]
-                self._io.seek(ref_start)
-            except KeyError:
-                raise KeyError('Reference is not found in header')
-        ref_start = self._io.tell()
-
-        if not idx:
-            assert ref_start == self.ref_indices[ref_id].start_offset, 'ref not properly aligned'
+        try:
+            return self.ref_indices[ref_id] if idx else self._refs[ref_id]
+        except KeyError:
+            raise KeyError('Reference is not found in header')
 
-        n_bins = unpack_int32L(self._io.read(4))[0]
-        bins = self.get_bins(n_bins, ref_id, idx)
+    def query_chunks(self, ref_id, start, stop=-1):
+        """Finds all the chunks of the BAM file that can hold reads of a region
 
-        n_int = unpack_int32L(self._io.read(4))[0]
-        if idx:
-            self._io.seek(8 * n_int, 1)  # 8 = struct.calcsize('<Q')
-
-        ints = None if idx else self.get_ints(n_int)
-
-        self._last_pos = self._io.tell()
-
-        if idx:
-            return RefIdx(ref_start, self._last_pos, n_bins)
-        else:
-            return Ref(bins, ints, ref_id)
-
-    def query(self, ref_id, start, stop=-1):
-        """ Main query function for determining seek offset to BAM section that
-        AlignedRead objects from specified region start
+        The chunks of every bin overlapping the region are gathered, except for those
+        ending before the linear index of the region's start: they only hold reads
+        that end before the region. The chunks are then sorted and merged (see `merge_chunks`).
 
         Args:
-            ref (int): which reference/chromosome TID
+            ref_id (int): which reference/chromosome TID
             start (int): left most bp position of region (zero-based)
             stop (int): right most bp position of region (zero-based)
 
         Returns:
-            (int): the voffset_beg of the first chunk given the chunk's voffset_end
-                    is greater than the voffset of the linear index that overlaps
-                    the region of interest's start offset
+            (:py:obj:`list` of :py:obj:`tuple`): sorted (voffset_beg, voffset_end) of the merged chunks
+
+        Raises:
+            AssertionError (Exception): if the region is malformed
+            KeyError: if the reference is not in the index
+
+        Example:
+            >>> bai = Bai(bamnostic.example_bam + '.bai')
+            >>> bai.query_chunks(0, 100, 200)
+            [(3473408, 3567918741)]
+
         """
-        if stop < 0:
-            end_offset = self.current_ref.intervals[-1] + 1
         assert start <= stop, 'Malformed region: start should be <= stop, you entered {}, {}'.format(start, stop)
 
-        if self.current_ref is None:
-            self.current_ref = self.get_ref(ref_id)
-        elif self.current_ref.ref_id != ref_id:
-            self.current_ref = self.get_ref(ref_id)
+        ref = self.current_ref = self.get_ref(ref_id)
 
         # get linear index first
         # how many windows do we need to go over
         # because of floor div, we need to make it 0-based
-
         reg_lin_idx = start >> self.BAM_LIDX_SHIFT
+        if ref.bin_loffsets is not None:
+            linear_offset = self._bin_loffset(ref, reg_lin_idx)
+        elif ref.n_intervals:
+            l_idx = reg_lin_idx if reg_lin_idx < ref.n_intervals else ref.n_intervals - 1
+            linear_offset = ref.all_intervals[ref.ioffset + l_idx]
+        else:
+            linear_offset = 0
 
-        l_idx = reg_lin_idx if reg_lin_idx < len(self.current_ref.intervals) else -1
-        linear_offset = self.current_ref.intervals[l_idx]
+        chunks = ref.chunks
+        found = []
+        for binID in reg2bins(start, stop, self.min_shift, self.depth):
+            chunk_beg, chunk_end = ref.bin_chunks(binID)
+            for i in range(chunk_beg, chunk_end):
+                if chunks[2 * i + 1] > linear_offset:
+                    found.append((chunks[2 * i], chunks[2 * i + 1]))
+        return merge_chunks(found)
 
-        for binID in reg2bins(start, stop):
-            try:
-                bin_chunks = self.current_ref.bins[binID]
-            except KeyError:
-                continue
+    def _bin_loffset(self, ref, window):
+        """(PRIVATE) Smallest offset of the reads overlapping a window of a CSI index
 
-            for chunk in bin_chunks:
-                if not linear_offset <= chunk.voffset_end:
-                    continue
-                else:
-                    return chunk.voffset_beg
+        CSI indices have no linear index: the offset is taken from the smallest bin
+        of the window or, if it is empty, from the closest bin on its left or above it.
+
+        Args:
+            ref (Ref): index of the reference
+            window (int): position of the window, in units of the smallest bin size
+
+        Returns:
+            (int): virtual offset below which no read of the window can start
+        """
+        bin_id = ((1 << 3 * self.depth) - 1) // 7 + window
+        while True:
+            i = bisect_left(ref.bin_ids, bin_id)
+            if i < len(ref.bin_ids) and ref.bin_ids[i] == bin_id:
+                return ref.bin_loffsets[i]
+            if bin_id == 0:
+                return 0
+            first_sibling = (((bin_id - 1) >> 3) << 3) + 1
+            bin_id = bin_id - 1 if bin_id > first_sibling else (bin_id - 1) >> 3
+
+    def query(self, ref_id, start, stop=-1):
+        """ Main query function for determining seek offset to BAM section that
+        AlignedRead objects from specified region start
+
+        Args:
+            ref (int): which reference/chromosome TID
+            start (int): left most bp position of region (zero-based)
+            stop (int): right most bp position of region (zero-based)
+
+        Returns:
+            (None|int): the voffset_beg of the first chunk that can hold reads of the region \
+                (see `query_chunks`), or None if there is none
+        """
+        chunks = self.query_chunks(ref_id, start, stop)
+        return chunks[0][0] if chunks else None
 
     def seek(self, offset=None, whence=0):
         """Simple seek function for binary files
@@ -468,3 +575,336 @@ class Bai(object):
             (int): byte position of file head
         """
         return self._io.tell()
+
+
+class Csi(Bai):
+    """Coordinate-sorted index (CSI) of a BAM file
+
+    CSI generalizes the BAI binning scheme: the size of the smallest bins
+    (`min_shift`) and the number of levels of bins (`depth`) are set by the index,
+    so references longer than the 512 Mbp BAI limit can be indexed. There is no
+    linear index: every bin holds the smallest offset of its reads instead.
+    Queries work as with :py:class:`Bai`. CSI files are BGZF-compressed.
+
+    Attributes:
+        aux (bytes): auxiliary data of the index (unused for BAM files)
+
+    """
+    __slots__ = ['aux']
+
+    def __init__(self, filename):
+        """Initialization method
+
+        Args:
+            filename (str): '/path/to/bam_file.csi'
+
+        Raises:
+            OSError (Exception): if the CSI file is not found or does not exist
+            AssertionError (Exception): if CSI magic is not found
+        """
+        if not os.path.isfile(filename):
+            raise OSError('{} not found. Please change check your path or index your BAM file'.format(filename))
+        self._io = gzip.GzipFile(filename, 'rb')
+
+        self.magic, self.min_shift, self.depth, l_aux = unpack('<4s3i', self._io)
+        assert self.magic == b'CSI\x01', 'Wrong CSI magic header'
+        self.aux = self._io.read(l_aux)
+        self.n_refs = unpack_int32L(self._io.read(4))[0]
+
+        self._LINEAR_INDEX_WINDOW = 1 << self.min_shift
+        self._UNMAP_BIN = ((1 << 3 * self.depth + 3) - 1) // 7 + 1
+        self.BAM_LIDX_SHIFT = self.min_shift
+
+        self._load()
+
+
+def load_index(filename):
+    """Opens a BAI or CSI index, depending on its contents
+
+    Args:
+        filename (str): path of the index
+
+    Returns:
+        (:py:class:`Bai` | :py:class:`Csi`): the index
+
+    Raises:
+        OSError (Exception): if the index file is not found or does not exist
+
+    Example:
+        >>> isinstance(load_index(bamnostic.example_bam + '.bai'), Csi)
+        False
+
+    """
+    if not os.path.isfile(filename):
+        raise OSError('{} not found. Please change check your path or index your BAM file'.format(filename))
+    with open(filename, 'rb') as handle:
+        magic = handle.read(2)
+    # CSI files are BGZF-compressed, and so start with the gzip magic number
+    return Csi(filename) if magic == b'\x1f\x8b' else Bai(filename)
+
+
+def _compress_bins(bins, n_lvls=5, n_bins=37449):
+    """(PRIVATE) Merges small bins into their parents and adjacent chunks, as `samtools index` does
+
+    A bin whose chunks span less than one BGZF block (64 KiB of compressed data) is
+    moved into its parent bin, if the parent has chunks. Then, within each bin, chunks
+    that start in the BGZF block where the previous one ends are merged.
+
+    Args:
+        bins (dict): lists of (voffset_beg, voffset_end) chunks by bin ID, modified in place
+        n_lvls (int): depth of the binning scheme
+        n_bins (int): number of bin IDs of the binning scheme. Bins from there on are pseudo-bins.
+    """
+    for level in range(n_lvls, 0, -1):
+        first = ((1 << 3 * level) - 1) // 7
+        for bin_id in sorted(bins):
+            if not first <= bin_id < n_bins:
+                continue
+            chunks = bins[bin_id]
+            if level < n_lvls:
+                chunks.sort()
+            parent = (bin_id - 1) >> 3
+            if (chunks[-1][1] >> 16) - (chunks[0][0] >> 16) < 0x10000 and parent in bins:
+                bins[parent].extend(chunks)
+                del bins[bin_id]
+    if 0 in bins:
+        bins[0].sort()
+
+    for bin_id, chunks in bins.items():
+        if bin_id >= n_bins:
+            continue
+        merged = [chunks[0]]
+        for voffset_beg, voffset_end in chunks[1:]:
+            if merged[-1][1] >> 16 >= voffset_beg >> 16:
+                if merged[-1][1] < voffset_end:
+                    merged[-1] = (merged[-1][0], voffset_end)
+            else:
+                merged.append((voffset_beg, voffset_end))
+        bins[bin_id] = merged
+
+
+def _write_ref(out, bins, intervals, csi=False, depth=5):
+    """(PRIVATE) Writes the bins (sorted by ID) and linear index of a reference to an index file
+
+    Args:
+        out (:py:obj:`file`): the index file
+        bins (dict): lists of (voffset_beg, voffset_end) chunks by bin ID, including the pseudo-bin
+        intervals (list): virtual offset of the first read overlapping each window, or None
+        csi (bool): write in the CSI format: each bin carries the offset of the linear index \
+            at its first window, and the linear index itself is left out (default: False).
+        depth (int): number of levels of bins below the root bin (default: 5)
+    """
+    n_bins = ((1 << 3 * depth + 3) - 1) // 7
+
+    # Windows without reads of their own point to the previous window's first read,
+    # or to the start of the reference's reads (held by the pseudo-bin)
+    filled = []
+    offset = bins[n_bins + 1][0][0] if n_bins + 1 in bins else 0
+    for interval in intervals:
+        if interval is not None:
+            offset = interval
+        filled.append(offset)
+
+    out.write(struct.pack('<i', len(bins)))
+    for bin_id in sorted(bins):
+        chunks = bins[bin_id]
+        if csi:
+            loffset = 0
+            if bin_id < n_bins:
+                level = depth
+                while bin_id < ((1 << 3 * level) - 1) // 7:
+                    level -= 1
+                first_window = (bin_id - ((1 << 3 * level) - 1) // 7) << 3 * (depth - level)
+                loffset = filled[first_window] if first_window < len(filled) else 0
+            out.write(struct.pack('<IQi', bin_id, loffset, len(chunks)))
+        else:
+            out.write(struct.pack('<Ii', bin_id, len(chunks)))
+        out.write(struct.pack('<{}Q'.format(2 * len(chunks)), *[voffset for chunk in chunks for voffset in chunk]))
+
+    if not csi:
+        out.write(struct.pack('<i{}Q'.format(len(filled)), len(filled), *filled))
+
+
+def _end_offset(bam):
+    """(PRIVATE) Virtual offset of the position of a BAM reader, as used by `samtools index`
+
+    The end of a block is reported as the start of the next one.
+    """
+    if bam._within_block_offset < len(bam._buffer):
+        return bam.tell()
+    return (bam._block_start_offset + bam._block_raw_length) << 16
+
+
+def _write_index(bam, out, csi=False, min_shift=14, depth=5):
+    """(PRIVATE) Writes the index of an open BAM file, read from its first record on
+
+    Args:
+        bam (:py:class:`bamnostic.AlignmentFile`): the BAM file, positioned at its first record
+        out (:py:obj:`file`): the index file
+        csi (bool): write a CSI index rather than a BAI index (default: False)
+        min_shift (int): size of the smallest bins, as a power of 2 (default: 14)
+        depth (int): number of levels of bins below the root bin (default: 5)
+
+    Raises:
+        ValueError: if the BAM file is not sorted by coordinate, or if a read lies beyond the binning scheme
+    """
+    max_pos = 1 << (min_shift + 3 * depth)
+    n_bins = ((1 << 3 * depth + 3) - 1) // 7
+    unmap_bin = n_bins + 1
+    # References without reads have no bins and, in BAI indices, an empty linear index
+    empty_ref = struct.pack('<i', 0) if csi else struct.pack('<2i', 0, 0)
+    n_refs = bam._header.n_refs
+    if csi:
+        out.write(struct.pack('<4s4i', b'CSI\x01', min_shift, depth, 0, n_refs))
+    else:
+        out.write(struct.pack('<4si', b'BAI\x01', n_refs))
+
+    record = bam._read_raw_record()
+    # Reads are indexed with the virtual offset where they end. This is the
+    # virtual offset of the end of the previous read, or of the start of the first one.
+    last_off = record[0] if record is not None else bam.tell()
+    off_beg = last_off
+    n_done = 0  # references written so far
+    last_tid = last_bin = save_bin = None
+    last_coor = -1
+    save_off = last_off
+    n_mapped = n_unmapped = 0
+    bins = {}
+    intervals = []
+
+    while record is not None:
+        voffset, raw = record
+        ref_id, pos, bin_mq_nl, flag_nc = unpack_record_start_from(raw, 4)
+        if ref_id < 0:
+            break
+
+        offset = _end_offset(bam)
+        if ref_id != last_tid:
+            if last_tid is not None:
+                if ref_id < last_tid:
+                    raise ValueError('BAM file is not sorted by coordinate')
+                bins.setdefault(save_bin, []).append((save_off, last_off))
+                bins[unmap_bin] = [(off_beg, last_off), (n_mapped, n_unmapped)]
+                _compress_bins(bins, depth, n_bins)
+                _write_ref(out, bins, intervals, csi, depth)
+                n_done += 1
+                off_beg = last_off
+                n_mapped = n_unmapped = 0
+                bins = {}
+                intervals = []
+            while n_done < ref_id:
+                out.write(empty_ref)
+                n_done += 1
+            last_tid = ref_id
+            last_bin = None
+        elif pos < last_coor:
+            raise ValueError('BAM file is not sorted by coordinate')
+
+        is_mapped = not (flag_nc >> 16) & 4
+        end = bamnostic.core.raw_reference_end(raw) if is_mapped else None
+        if end is None or end <= pos:
+            end = pos + 1
+        if end > max_pos:
+            raise ValueError('Read at {}:{} is beyond the range of the index. '
+                             'Use a CSI index with a larger min_shift or depth.'.format(ref_id, pos))
+
+        # Record the first read overlapping each window of the linear index. Placed
+        # unmapped reads count too, as they are returned by queries of their position.
+        win_beg, win_end = pos >> min_shift, (end - 1) >> min_shift
+        if len(intervals) <= win_end:
+            intervals.extend([None] * (win_end + 1 - len(intervals)))
+        for window in range(win_beg, win_end + 1):
+            if intervals[window] is None:
+                intervals[window] = last_off
+
+        bin_id = reg2bin(pos, end, min_shift, depth)
+        if bin_id != last_bin:
+            if last_bin is not None:
+                bins.setdefault(save_bin, []).append((save_off, last_off))
+            save_off = last_off
+            save_bin = last_bin = bin_id
+
+        if is_mapped:
+            n_mapped += 1
+        else:
+            n_unmapped += 1
+        last_off = offset
+        last_coor = pos
+        record = bam._read_raw_record()
+
+    if last_tid is not None:
+        if record is None:
+            # At the end of the file, the last chunk runs past the EOF marker block
+            last_off = _end_offset(bam)
+        bins.setdefault(save_bin, []).append((save_off, last_off))
+        bins[unmap_bin] = [(off_beg, last_off), (n_mapped, n_unmapped)]
+        _compress_bins(bins, depth, n_bins)
+        _write_ref(out, bins, intervals, csi, depth)
+        n_done += 1
+    while n_done < n_refs:
+        out.write(empty_ref)
+        n_done += 1
+
+    # Reads without coordinates are at the end of the file
+    n_no_coor = 0
+    while record is not None:
+        if unpack_record_start_from(record[1], 4)[0] >= 0:
+            raise ValueError('BAM file is not sorted by coordinate')
+        n_no_coor += 1
+        record = bam._read_raw_record()
+    out.write(struct.pack('<Q', n_no_coor))
+
+
+def build_index(bam_path, out_path=None, csi=False, min_shift=14, depth=5):
+    """Builds the BAI (or CSI) index of a coordinate-sorted BAM file
+
+    The BAM file is read once, from start to end, without decoding the reads beyond
+    their position, flag, and CIGAR. The bins, chunks, linear index, and unmapped read
+    statistics (pseudo-bin 37450) are computed as `samtools index` does, and each
+    reference is written out as soon as its last read has been seen, so only the
+    index of one reference is held in memory at a time. Bins are written in ascending
+    order of their IDs. Like current versions of samtools, the linear index includes
+    the unmapped reads that have a position.
+
+    Args:
+        bam_path (str): path of the BAM file
+        out_path (str): path of the index file to create (default: None, `bam_path` + '.bai', \
+            or `bam_path` + '.csi' for CSI indices)
+        csi (bool): build a CSI index, which supports references longer than 512 Mbp (default: False)
+        min_shift (int): size of the smallest bins of a CSI index, as a power of 2 (default: 14)
+        depth (int): number of levels of bins of a CSI index below the root bin (default: 5)
+
+    Returns:
+        (str): path of the index file
+
+    Raises:
+        ValueError: if the BAM file is not sorted by coordinate, if a read lies beyond the \
+            binning scheme, or if `min_shift` or `depth` are changed for a BAI index
+
+    Example:
+        >>> import os, tempfile
+        >>> out_path = os.path.join(tempfile.mkdtemp(), 'example.bam.bai')
+        >>> bai = Bai(build_index(bamnostic.example_bam, out_path))
+        >>> list(bai.get_ref(0).intervals), list(bai.get_ref(1).intervals)
+        ([3473408], [3567918741])
+
+    """
+    if not csi and (min_shift, depth) != (14, 5):
+        raise ValueError('BAI indices only support min_shift=14 and depth=5. Use a CSI index instead.')
+    if out_path is None:
+        out_path = bam_path + ('.csi' if csi else '.bai')
+
+    with warnings.catch_warnings():
+        # The index may well not exist yet
+        warnings.simplefilter('ignore')
+        bam = bamnostic.AlignmentFile(bam_path, 'rb')
+
+    try:
+        with bam, (bamnostic.bgzf.BgzfWriter(out_path, 'wb') if csi else open(out_path, 'wb')) as out:
+            _write_index(bam, out, csi, min_shift, depth)
+    except Exception:
+        # Do not leave a partial index behind
+        if os.path.isfile(out_path):
+            os.remove(out_path)
+        raise
+    return out_path
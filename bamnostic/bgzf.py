@@ -36,10 +36,20 @@ import os
 import warnings
 import array
 import re
+import mmap
+import threading
+import bisect
+from itertools import groupby
+from multiprocessing.pool import ThreadPool
 
 import bamnostic
 from bamnostic.utils import *
 
+try:
+    import numpy as _np
+except ImportError:
+    _np = None
+
 _PY_VERSION = sys.version
 
 if _PY_VERSION.startswith('2'):
@@ -100,11 +110,27 @@ unpack_subfields = struct.Struct('<2s2H').unpack
 _subfield_size = struct.calcsize('<2s2H')
 
 unpack_gzip_integrity = struct.Struct('<2I').unpack
+unpack_gzip_integrity_from = struct.Struct('<2I').unpack_from
 _integrity_size = struct.calcsize('<2I')
 
 unpack_bgzf_metaheader = struct.Struct('<4BI2BH2BH').unpack
+unpack_bgzf_metaheader_from = struct.Struct('<4BI2BH2BH').unpack_from
 _metaheader_size = struct.calcsize('<4BI2BH2BH')
 
+unpack_bsize_from = struct.Struct('<H').unpack_from
+unpack_int32_from = struct.Struct('<i').unpack_from
+unpack_refid_pos_from = struct.Struct('<2i').unpack_from
+
+# block_size prefix and fixed-size fields at the start of every BAM record:
+# block_size, refID, pos, bin_mq_nl, flag_nc, l_seq, next_refID, next_pos, tlen
+unpack_record_core_from = struct.Struct('<3i2I4i').unpack_from
+_record_core_size = struct.calcsize('<3i2I4i')
+
+# Columns returned by `core_fields` and the `array` typecodes they are stored as
+_CORE_COLUMNS = (('refID', 'i'), ('pos', 'i'), ('bin', 'H'), ('mapq', 'B'), ('l_read_name', 'B'),
+                 ('flag', 'H'), ('n_cigar_op', 'H'), ('l_seq', 'i'), ('next_refID', 'i'),
+                 ('next_pos', 'i'), ('tlen', 'i'))
+
 
 def _bgzf_metaheader(handle):
     """ Pull out the metadata header for a BGZF block
@@ -143,6 +169,43 @@ def _bgzf_metaheader(handle):
     """
     meta_raw = handle.read(_metaheader_size)
     meta = unpack_bgzf_metaheader(meta_raw)
+    _check_metaheader(meta)
+    return meta, meta_raw
+
+
+def _bgzf_metaheader_from(buf, offset=0):
+    """ Pull out the metadata header for a BGZF block held in memory
+
+    Same as :py:func:`_bgzf_metaheader`, but unpacks the header in place from
+    a buffer (e.g. a `memoryview` of a memory-mapped BAM file) instead of
+    reading it from a file handle.
+
+    Args:
+        buf (:py:obj:`memoryview` | :py:obj:`mmap.mmap`): buffer holding the BGZF block
+        offset (int): byte offset of the start of the BGZF block within `buf` (default: 0)
+
+    Returns:
+        :py:obj:`tuple`: the unpacked metadata
+
+    Raises:
+        ValueError: if the header does not match expected values
+
+    """
+    meta = unpack_bgzf_metaheader_from(buf, offset)
+    _check_metaheader(meta)
+    return meta
+
+
+def _check_metaheader(meta):
+    """ Check the integrity of an unpacked BGZF metadata header (PRIVATE)
+
+    Args:
+        meta (:py:obj:`tuple`): the unpacked metadata header
+
+    Raises:
+        ValueError: if the header does not match expected values
+
+    """
     ID1, ID2, CM, FLG, MTIME, XFL, OS, XLEN, SI1, SI2, SLEN = meta
 
     # check the header integrity
@@ -158,8 +221,6 @@ def _bgzf_metaheader(handle):
     if not all(checks):
         raise ValueError('Malformed BGZF block')
 
-    return meta, meta_raw
-
 
 def get_block(handle, offset=0):
     r""" Pulls out entire GZIP block
@@ -192,7 +253,12 @@ def get_block(handle, offset=0):
 
     """
 
-    if isinstance(handle, bamnostic.core.AlignmentFile):
+    if isinstance(handle, BgzfReader):
+        if handle._stream:
+            # A stream cannot be re-read, so the reader retains its first block
+            if offset != 0:
+                raise ValueError('Only the first BGZF block of a stream is retained')
+            return handle._first_block_raw
         handle = handle._handle
     with open(handle.name, 'rb') as header_handle:
         header_handle.seek(offset)  # get to the start of the BGZF block
@@ -204,35 +270,29 @@ def get_block(handle, offset=0):
         BSIZE = struct.unpack('<H', BSIZE_raw)[0]
 
         # capture the CRC32 and ISIZE fields in addition to compressed data
-        # 6 = XLEN, 19 = spec offset, 8 = CRC32 & ISIZE -> -5
-        block_tail = header_handle.read(BSIZE - 5)
+        # BSIZE is the total block size - 1, of which the metadata header and BSIZE are 18 bytes
+        block_tail = header_handle.read(BSIZE + 1 - _metaheader_size - 2)
         return meta_raw + BSIZE_raw + block_tail
 
 
-def _load_bgzf_block(handle):
-    r"""Load the next BGZF block of compressed data (PRIVATE).
+def _read_bgzf_block(handle):
+    r"""Read the next BGZF block of compressed data without inflating it (PRIVATE).
 
-    BAM files essentially concatenated GZIP blocks put together into a cohesive file
-    format. The caveat to this is that the GZIP blocks are specially formatted to contain
-    metadata that indicates them as being part of a larger BAM file. Due to these specifications,
-    these blocks are identified as BGZF blocks.
+    Splitting the I/O from the decompression allows the (GIL-releasing) inflate
+    step to be handed off to worker threads while the file handle itself is
+    only ever touched by the calling thread.
 
     Args:
         handle (:py:obj:`file`): open BAM file
 
     Returns:
-        deflated GZIP data
-
-    Raises:
-        ValueError: if CRC32 or ISIZE do not match deflated data
+        :py:obj:`tuple` of (int, :py:obj:`bytes`, int, int): the total block size,
+        the raw deflated payload, and the expected CRC32 and ISIZE of the payload
 
     Example:
         >>> with open('./bamnostic/data/example.bam','rb') as bam:
-        ...     block = _load_bgzf_block(bam)
-        ...     try:
-        ...         block[0] == 53 and block[1].startswith(b'BAM\x01')
-        ...     except TypeError:
-        ...         block[0] == 53 and block[1].startswith('BAM\x01')
+        ...     block_size, cdata, crc, isize = _read_bgzf_block(bam)
+        ...     block_size == bam.tell() and isize == len(_inflate_bgzf_block(cdata, crc, isize))
         True
 
     """
@@ -244,20 +304,130 @@ def _load_bgzf_block(handle):
 
     # Expose the compressed data
     d_size = BSIZE - XLEN - 19
+    cdata = handle.read(d_size)
+    CRC32, ISIZE = unpack_gzip_integrity(handle.read(_integrity_size))
+    return BSIZE + 1, cdata, CRC32, ISIZE
+
+
+def _read_bgzf_block_from(buf, offset):
+    r"""Locate the BGZF block at `offset` within an in-memory buffer (PRIVATE).
+
+    The in-memory counterpart to :py:func:`_read_bgzf_block`. When `buf` is a
+    `memoryview`, the returned payload is a view into `buf`, so no compressed
+    bytes are copied before they are handed to `zlib`.
+
+    Args:
+        buf (:py:obj:`memoryview` | :py:obj:`mmap.mmap`): buffer holding the BGZF blocks
+        offset (int): byte offset of the start of the BGZF block within `buf`
+
+    Returns:
+        :py:obj:`tuple` of (int, :py:obj:`memoryview`, int, int): the total block size,
+        the raw deflated payload, and the expected CRC32 and ISIZE of the payload
+
+    Example:
+        >>> with open('./bamnostic/data/example.bam','rb') as bam:
+        ...     view = memoryview(bam.read())
+        >>> block_size, cdata, crc, isize = _read_bgzf_block_from(view, 0)
+        >>> _inflate_bgzf_block(cdata, crc, isize).startswith(b'BAM\x01')
+        True
+
+    """
+    header = _bgzf_metaheader_from(buf, offset)
+    XLEN = header[-4]
+    BSIZE = unpack_bsize_from(buf, offset + _metaheader_size)[0]
+
+    # Expose the compressed data
+    d_start = offset + _metaheader_size + 2
+    d_end = d_start + BSIZE - XLEN - 19
+    CRC32, ISIZE = unpack_gzip_integrity_from(buf, d_end)
+    return BSIZE + 1, buf[d_start:d_end], CRC32, ISIZE
+
+
+def _read_bgzf_block_raw(handle):
+    r"""Read the next complete BGZF block, as is, from a sequential stream (PRIVATE).
+
+    Args:
+        handle (:py:obj:`file`): open, possibly non-seekable, binary stream
+
+    Returns:
+        (:py:obj:`bytes`): the whole raw BGZF block, or an empty byte string at the end of the stream
+
+    Raises:
+        ValueError: if the BGZF block header is malformed
+        IOError: if the stream ends in the middle of a block
+
+    """
+    meta_raw = handle.read(_metaheader_size + 2)
+    if not meta_raw:
+        return meta_raw
+    if len(meta_raw) < _metaheader_size + 2:
+        raise IOError('BGZF stream ended in the middle of a block header')
+    _check_metaheader(unpack_bgzf_metaheader_from(meta_raw))
+    BSIZE = unpack_bsize_from(meta_raw, _metaheader_size)[0]
+    block_tail = handle.read(BSIZE + 1 - len(meta_raw))
+    if len(block_tail) < BSIZE + 1 - len(meta_raw):
+        raise IOError('BGZF stream ended in the middle of a block')
+    return meta_raw + block_tail
+
+
+def _inflate_bgzf_block(cdata, crc, isize):
+    r"""Inflate the payload of a BGZF block and check its integrity (PRIVATE).
+
+    Args:
+        cdata (:py:obj:`bytes`): raw deflated payload of the block
+        crc (int): CRC32 recorded in the block footer
+        isize (int): uncompressed size recorded in the block footer
+
+    Returns:
+        deflated GZIP data
+
+    Raises:
+        ValueError: if CRC32 or ISIZE do not match deflated data
+
+    """
     d_obj = zlib.decompressobj(-15)
-    data = d_obj.decompress(handle.read(d_size)) + d_obj.flush()
+    data = d_obj.decompress(cdata) + d_obj.flush()
 
     # Checking data integrity
-    CRC32, ISIZE = unpack_gzip_integrity(handle.read(_integrity_size))
     deflated_crc = zlib.crc32(data)
     if deflated_crc < 0:
         deflated_crc = deflated_crc % (1 << 32)
-    if CRC32 != deflated_crc:
-        raise ValueError('CRCs are not equal: is {}, not {}'.format(CRC32, deflated_crc))
-    if ISIZE != len(data):
+    if crc != deflated_crc:
+        raise ValueError('CRCs are not equal: is {}, not {}'.format(crc, deflated_crc))
+    if isize != len(data):
         raise ValueError('unequal uncompressed data size')
+    return data
+
+
+def _load_bgzf_block(handle):
+    r"""Load the next BGZF block of compressed data (PRIVATE).
+
+    BAM files essentially concatenated GZIP blocks put together into a cohesive file
+    format. The caveat to this is that the GZIP blocks are specially formatted to contain
+    metadata that indicates them as being part of a larger BAM file. Due to these specifications,
+    these blocks are identified as BGZF blocks.
+
+    Args:
+        handle (:py:obj:`file`): open BAM file
+
+    Returns:
+        deflated GZIP data
+
+    Raises:
+        ValueError: if CRC32 or ISIZE do not match deflated data
+
+    Example:
+        >>> with open('./bamnostic/data/example.bam','rb') as bam:
+        ...     block = _load_bgzf_block(bam)
+        ...     try:
+        ...         block[0] == 53 and block[1].startswith(b'BAM\x01')
+        ...     except TypeError:
+        ...         block[0] == 53 and block[1].startswith('BAM\x01')
+        True
 
-    return BSIZE + 1, data
+    """
+    block_size, cdata, crc, isize = _read_bgzf_block(handle)
+    return block_size, _inflate_bgzf_block(cdata, crc, isize)
 
 
 class BAMheader(object):
@@ -324,7 +494,7 @@ class BAMheader(object):
             self._SAMheader_raw = None
             self.SAMheader = None
 
-        self._SAMheader_end = _io._handle.tell()
+        self._SAMheader_end = _io.tell()
 
         # Each reference is listed with the @SQ tag. We need the number of refs to process the data
         self.n_refs = unpack('<i', _io)
@@ -336,7 +506,7 @@ class BAMheader(object):
             ref_name = unpack('{}s'.format(name_len - 1), _io.read(name_len)[:-1])  # get rid of null: \x00
             ref_len = unpack_int32(_io.read(4))[0]
             self.refs.update({r: (ref_name.decode(), ref_len)})
-        self._BAMheader_end = _io._handle.tell()
+        self._BAMheader_end = _io.tell()
 
         self._header_block = get_block(_io)
 
@@ -381,6 +551,426 @@ class BAMheader(object):
         return self._SAMheader_raw.decode().rstrip() if self._SAMheader_raw else str(self.refs)
 
 
+def record_offsets(data, start=0):
+    """Locate the complete BAM records within a decompressed buffer
+
+    Records are laid out back to back, each starting with its own size, so
+    the boundaries are found by hopping from one size field to the next.
+
+    Args:
+        data (bytes): decompressed BGZF data (e.g. a buffer of `BgzfReader._buffers`)
+        start (int): offset of the first record within `data` (default: 0)
+
+    Returns:
+        (:py:obj:`tuple` of (:py:obj:`list`, int)): offsets of the records that lie entirely \
+            within `data`, and the offset where the first incomplete record (if any) starts
+
+    """
+    offsets = []
+    size = len(data)
+    cursor = start
+    while cursor + 4 <= size:
+        stop = cursor + 4 + unpack_int32_from(data, cursor)[0]
+        if stop > size:
+            break
+        offsets.append(cursor)
+        cursor = stop
+    return offsets, cursor
+
+
+def core_fields(data, offsets, numpy=None):
+    """Gather the fixed-size fields of many BAM records at once
+
+    With NumPy, the 36-byte headers (`block_size` and the 32 bytes of fixed-size
+    fields) of all the records are gathered in a single fancy-indexing step and
+    the packed fields are split with vectorized bit operations. Without NumPy,
+    each header is unpacked in turn into :py:obj:`array.array` columns.
+
+    Args:
+        data (bytes): decompressed BGZF data
+        offsets (:py:obj:`list` of int): offsets of records within `data` (see `record_offsets`)
+        numpy (None|bool): return NumPy arrays. If None, NumPy is used when it \
+            is installed (default: None).
+
+    Returns:
+        (:py:obj:`dict`): one column per field, keyed by `refID`, `pos`, `bin`, `mapq`, \
+            `l_read_name`, `flag`, `n_cigar_op`, `l_seq`, `next_refID`, `next_pos`, and `tlen`
+
+    Raises:
+        ImportError: if `numpy` is True and NumPy is not installed
+
+    Example:
+        >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb')
+        >>> bam._load_block(53)  # the first block of reads
+        >>> offsets, stop = record_offsets(bam._buffer)
+        >>> fields = core_fields(bam._buffer, offsets, numpy=False)
+        >>> list(fields['pos'][:3]), list(fields['flag'][:3])
+        ([99, 99, 102], [69, 137, 99])
+
+    """
+    if numpy is None:
+        numpy = _np is not None
+    elif numpy and _np is None:
+        raise ImportError('NumPy is not installed')
+
+    if not numpy:
+        columns = [array.array(typecode) for name, typecode in _CORE_COLUMNS]
+        (ref_ids, poss, bins, mapqs, l_read_names, flags, n_cigar_ops,
+         l_seqs, next_ref_ids, next_poss, tlens) = columns
+        for offset in offsets:
+            (block_size, ref_id, pos, bin_mq_nl, flag_nc,
+             l_seq, next_ref_id, next_pos, tlen) = unpack_record_core_from(data, offset)
+            ref_ids.append(ref_id)
+            poss.append(pos)
+            bins.append(bin_mq_nl >> 16)
+            mapqs.append((bin_mq_nl >> 8) & 0xFF)
+            l_read_names.append(bin_mq_nl & 0xFF)
+            flags.append(flag_nc >> 16)
+            n_cigar_ops.append(flag_nc & 0xFFFF)
+            l_seqs.append(l_seq)
+            next_ref_ids.append(next_ref_id)
+            next_poss.append(next_pos)
+            tlens.append(tlen)
+        return dict((name, column) for (name, typecode), column in zip(_CORE_COLUMNS, columns))
+
+    raw = _np.frombuffer(data, dtype=_np.uint8)
+    starts = _np.asarray(offsets, dtype=_np.intp)
+    headers = raw[starts[:, None] + _np.arange(_record_core_size)]
+    signed = headers.view('<i4')
+    unsigned = headers.view('<u4')
+    bin_mq_nl = unsigned[:, 3]
+    flag_nc = unsigned[:, 4]
+    return {'refID': signed[:, 1].astype(_np.int32),
+            'pos': signed[:, 2].astype(_np.int32),
+            'bin': (bin_mq_nl >> 16).astype(_np.uint16),
+            'mapq': ((bin_mq_nl >> 8) & 0xFF).astype(_np.uint8),
+            'l_read_name': (bin_mq_nl & 0xFF).astype(_np.uint8),
+            'flag': (flag_nc >> 16).astype(_np.uint16),
+            'n_cigar_op': (flag_nc & 0xFFFF).astype(_np.uint16),
+            'l_seq': signed[:, 5].astype(_np.int32),
+            'next_refID': signed[:, 6].astype(_np.int32),
+            'next_pos': signed[:, 7].astype(_np.int32),
+            'tlen': signed[:, 8].astype(_np.int32)}
+
+
+def _is_seekable(handle):
+    """(PRIVATE) Check whether a file object supports random access.
+
+    Args:
+        handle (:py:obj:`file`): open binary file object
+
+    Returns:
+        (bool): True if the file object can seek, else False (e.g. pipes, sockets, standard input)
+    """
+    try:
+        return handle.seekable()
+    except AttributeError:
+        # Python 2 file objects
+        try:
+            handle.tell()
+            return True
+        except (IOError, OSError):
+            return False
+
+
+class BlockIndex(object):
+    """ Block boundary index of a BGZF file (`.gzi`)
+
+    The index is a sorted pair of arrays holding the compressed offset and the
+    cumulative uncompressed offset of the start of every BGZF block. With it,
+    any position within the uncompressed data stream can be translated into a
+    virtual offset without a coordinate index (BAI), which makes it usable for
+    unsorted and name-sorted BAM files. The on-disk format is the one used by
+    `bgzip -i` (a little-endian `uint64` count followed by `uint64` offset pairs,
+    omitting the implicit first block at `(0, 0)`).
+
+    Attributes:
+        coffsets (:py:obj:`array.array`): compressed offset of each block start
+        uoffsets (:py:obj:`array.array`): uncompressed offset of each block start
+        total_size (int): size of the whole uncompressed data stream
+
+    Example:
+        >>> idx = BlockIndex.build(bamnostic.example_bam)
+        >>> idx.coffsets[:2].tolist(), idx.uoffsets[:2].tolist()
+        ([0, 53], [0, 38])
+        >>> idx.virtual_offset(40) == make_virtual_offset(53, 2)
+        True
+
+    """
+    __slots__ = ['coffsets', 'uoffsets', 'total_size']
+
+    def __init__(self, coffsets, uoffsets, total_size=None):
+        """ Initialize the index.
+
+        Args:
+            coffsets (iterable): compressed offset of each block start, in file order
+            uoffsets (iterable): uncompressed offset of each block start, in file order
+            total_size (None|int): size of the uncompressed data stream. If not given, the \
+                start of the last block is used.
+        """
+        self.coffsets = array.array(U64_TYPECODE, coffsets)
+        self.uoffsets = array.array(U64_TYPECODE, uoffsets)
+        if len(self.coffsets) != len(self.uoffsets):
+            raise ValueError('Block index requires the same number of compressed and uncompressed offsets')
+        if total_size is None:
+            total_size = self.uoffsets[-1] if self.uoffsets else 0
+        self.total_size = total_size
+
+    @classmethod
+    def build(cls, filepath_or_object):
+        """ Build the index by walking the BGZF block headers.
+
+        Only each block's header and footer are read (the footer records the
+        uncompressed size), so no data is decompressed.
+
+        Args:
+            filepath_or_object (str | :py:obj:`file`): path or open binary file object of the BGZF file
+
+        Returns:
+            (:py:class:`BlockIndex`): the index of every block in the file
+
+        Raises:
+            ValueError: if a malformed BGZF block is encountered
+        """
+        if isinstance(filepath_or_object, io.IOBase):
+            handle, close = filepath_or_object, False
+            handle.seek(0)
+        else:
+            handle, close = open(filepath_or_object, 'rb'), True
+        coffsets, uoffsets = [], []
+        coffset = uoffset = 0
+        try:
+            while True:
+                meta_raw = handle.read(_metaheader_size)
+                if not meta_raw:
+                    break
+                _check_metaheader(unpack_bgzf_metaheader(meta_raw))
+                BSIZE = struct.unpack('<H', handle.read(2))[0]
+                handle.seek(coffset + BSIZE + 1 - 4)
+                ISIZE = unpack_int32(handle.read(4))[0]
+                coffsets.append(coffset)
+                uoffsets.append(uoffset)
+                coffset += BSIZE + 1
+                uoffset += ISIZE
+        finally:
+            if close:
+                handle.close()
+        return cls(coffsets, uoffsets, uoffset)
+
+    @classmethod
+    def load(cls, filename):
+        """ Load a `.gzi` block index.
+
+        Args:
+            filename (str): path to the `.gzi` file
+
+        Returns:
+            (:py:class:`BlockIndex`): the loaded index
+        """
+        with open(filename, 'rb') as gzi:
+            n_entries = struct.unpack('<Q', gzi.read(8))[0]
+            pairs = array.array(U64_TYPECODE)
+            raw = gzi.read(16 * n_entries)
+            try:
+                pairs.frombytes(raw)
+            except AttributeError:
+                pairs.fromstring(raw)
+        if sys.byteorder == 'big':
+            pairs.byteswap()
+        return cls([0] + pairs[0::2].tolist(), [0] + pairs[1::2].tolist())
+
+    def save(self, filename):
+        """ Save the index in the `.gzi` format.
+
+        Args:
+            filename (str): path of the `.gzi` file to write
+        """
+        pairs = array.array(U64_TYPECODE, [0] * (2 * (len(self) - 1)))
+        pairs[0::2] = self.coffsets[1:]
+        pairs[1::2] = self.uoffsets[1:]
+        if sys.byteorder == 'big':
+            pairs.byteswap()
+        with open(filename, 'wb') as gzi:
+            gzi.write(struct.pack('<Q', len(pairs) // 2))
+            try:
+                gzi.write(pairs.tobytes())
+            except AttributeError:
+                gzi.write(pairs.tostring())
+
+    def __len__(self):
+        return len(self.coffsets)
+
+    def virtual_offset(self, uoffset):
+        """ Translate an uncompressed data position into a virtual offset.
+
+        Args:
+            uoffset (int): position within the uncompressed data stream
+
+        Returns:
+            (int): BGZF virtual offset of that position
+
+        Raises:
+            ValueError: if the position is outside of the data stream
+        """
+        if not 0 <= uoffset <= self.total_size:
+            raise ValueError('Uncompressed offset {} is outside of the data (0-{})'.format(uoffset, self.total_size))
+        i = bisect.bisect_right(self.uoffsets, uoffset) - 1
+        return make_virtual_offset(self.coffsets[i], uoffset - self.uoffsets[i])
+
+    def split(self, n):
+        """ Split the blocks into `n` contiguous ranges of roughly equal uncompressed size.
+
+        Ranges are aligned to block boundaries. Note that BAM records may span
+        block boundaries, so a worker reading a range may need to begin at the
+        first record that starts within its range.
+
+        Args:
+            n (int): desired number of ranges
+
+        Returns:
+            (:py:obj:`list` of :py:obj:`tuple`): `(start, stop)` virtual offset pairs, where \
+                `stop` is the start of the next range (or the end of the file)
+
+        Example:
+            >>> idx = BlockIndex.build(bamnostic.example_bam)
+            >>> ranges = idx.split(3)
+            >>> len(ranges), ranges[0][0], ranges[-1][1] == make_virtual_offset(idx.coffsets[-1], 0)
+            (3, 0, True)
+
+        """
+        if n < 1:
+            raise ValueError('Use n with a minimum of 1')
+        bounds = [0]
+        for i in range(1, n):
+            b = bisect.bisect_left(self.uoffsets, self.total_size * i // n)
+            if bounds[-1] < b < len(self) - 1:
+                bounds.append(b)
+        bounds.append(len(self) - 1)
+        return [(make_virtual_offset(self.coffsets[a], 0), make_virtual_offset(self.coffsets[b], 0))
+                for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+# Process-wide block cache shared by every reader (disabled by default)
+_SHARED_CACHE = None
+_SHARED_CACHE_LOCK = threading.Lock()
+
+
+def enable_shared_cache(max_bytes=512 * 1024 ** 2, max_cache=None):
+    """Share decompressed BGZF blocks between all readers within the process.
+
+    Every `BgzfReader` (and therefore `AlignmentFile`) opened while the shared
+    cache is enabled stores its blocks in a single process-wide LRU cache instead
+    of its own. Blocks are keyed by the file's device, inode, and modification time
+    along with the block offset, so readers of the same file (e.g. those opened by
+    `mate()` or `head(multiple_iterators=True)`) reuse each other's decompressed
+    blocks, while a file that has been rewritten is never served stale data.
+    Calling this again replaces the shared cache with an empty one.
+
+    Args:
+        max_bytes (int): decompressed byte budget of the shared cache (default: 512 MiB)
+        max_cache (None|int): maximum number of blocks held (default: None, unbounded)
+
+    Example:
+        >>> enable_shared_cache(max_bytes=2**24)
+        >>> with bamnostic.AlignmentFile(bamnostic.example_bam, 'rb') as bam:
+        ...     reads = bam.head(n=2, multiple_iterators=True)
+        >>> shared_cache_stats().hits > 0
+        True
+        >>> disable_shared_cache()
+
+    """
+    global _SHARED_CACHE
+    with _SHARED_CACHE_LOCK:
+        _SHARED_CACHE = BlockCache(max_bytes=max_bytes, max_cache=max_cache)
+
+
+def disable_shared_cache():
+    """Stop sharing blocks between readers.
+
+    Readers opened afterwards use their own block cache. Readers that are
+    already open keep using the (now detached) shared cache until closed.
+    """
+    global _SHARED_CACHE
+    with _SHARED_CACHE_LOCK:
+        _SHARED_CACHE = None
+
+
+def shared_cache_stats():
+    """Get the usage statistics of the shared block cache.
+
+    Returns:
+        (None | :py:class:`bamnostic.utils.CacheStats`): statistics of the shared cache, \
+            or None if it is not enabled
+    """
+    cache = _SHARED_CACHE
+    if cache is None:
+        return None
+    with _SHARED_CACHE_LOCK:
+        return cache.stats()
+
+
+class SharedBlockCache(object):
+    """A single file's view into the process-wide block cache.
+
+    Exposes the same interface as :py:class:`bamnostic.utils.BlockCache` for the
+    reader, while prefixing every block offset with the identity of the file
+    (device, inode, and modification time) and serializing access to the
+    shared cache.
+
+    """
+    __slots__ = ['_cache', '_file_key']
+
+    def __init__(self, cache, file_key):
+        """Initialize the view.
+
+        Args:
+            cache (:py:class:`bamnostic.utils.BlockCache`): the process-wide cache
+            file_key (tuple): identity of the file whose blocks are cached
+        """
+        self._cache = cache
+        self._file_key = file_key
+
+    def lookup(self, offset, default=None):
+        with _SHARED_CACHE_LOCK:
+            return self._cache.lookup((self._file_key, offset), default)
+
+    def stats(self):
+        with _SHARED_CACHE_LOCK:
+            return self._cache.stats()
+
+    def __contains__(self, offset):
+        with _SHARED_CACHE_LOCK:
+            return (self._file_key, offset) in self._cache
+
+    def __getitem__(self, offset):
+        with _SHARED_CACHE_LOCK:
+            return self._cache[(self._file_key, offset)]
+
+    def __setitem__(self, offset, value):
+        with _SHARED_CACHE_LOCK:
+            self._cache[(self._file_key, offset)] = value
+
+
+def _shared_block_cache(handle):
+    """(PRIVATE) Get a view into the shared block cache for the given file handle.
+
+    Args:
+        handle (:py:obj:`file`): open BAM file
+
+    Returns:
+        (None | :py:class:`SharedBlockCache`): None if the shared cache is disabled or the \
+            handle is not backed by a regular file
+    """
+    cache = _SHARED_CACHE
+    if cache is None:
+        return None
+    try:
+        stat = os.fstat(handle.fileno())
+    except (AttributeError, io.UnsupportedOperation, OSError):
+        return None
+    return SharedBlockCache(cache, (stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size))
+
+
 class BgzfReader(object):
     """ The BAM reader. Heavily modified from Peter Cock's BgzfReader.
 
@@ -405,11 +995,13 @@ class BgzfReader(object):
     def __init__(self, filepath_or_object, mode="rb", max_cache=128, index_filename=None,
                  filename=None, check_header=False, check_sq=True, reference_filename=None,
                  filepath_index=None, require_index=False, duplicate_filehandle=None,
-                 ignore_truncation=False):
+                 ignore_truncation=False, threads=1, mmap=False, cache_bytes=None, lazy=False,
+                 fields=None):
         """Initialize the class.
 
         Args:
-            filepath_or_object (str | :py:obj:`file`): the path or file object of the BAM file
+            filepath_or_object (str | :py:obj:`file`): the path or file object of the BAM file. Pipes, \
+                sockets, and standard input (`'-'`) are read as streams: sequential iteration only.
             mode (str): Mode for reading. BAM files are binary by nature (default: 'rb').
             max_cache (int): number of desired LRU cache size, preferably a multiple of 2 (default: 128).
             index_filename (str): path to index file (BAI) if it is named differently than the BAM file (default: None).
@@ -421,13 +1013,36 @@ class BgzfReader(object):
             require_index (bool): require the presence of an index file or raise (default: False)
             duplicate_filehandle (bool): Not implemented. Raises warning if True.
             ignore_truncation (bool): Whether or not to allow trucated file processing (default: False).
+            threads (int): number of threads used to inflate upcoming BGZF blocks ahead of the \
+                cursor. A value of 1 disables read-ahead (default: 1).
+            mmap (bool): memory-map the BAM file and inflate blocks straight out of the mapping \
+                instead of issuing a `seek` and `read` for every block (default: False).
+            cache_bytes (int): upper bound on the decompressed bytes held by the block cache, \
+                in addition to `max_cache` (default: None, bounded by `max_cache` only). Ignored \
+                (along with `max_cache`) if the shared cache is enabled (see `enable_shared_cache`).
+            lazy (bool): only decode the sequence, qualities, tags, and CIGAR-derived attributes \
+                of reads the first time they are used (default: False).
+            fields (:py:obj:`tuple` of :py:obj:`str`): if given, iteration and `fetch` yield named \
+                tuples of only these fields (see :py:class:`bamnostic.core.Projection`) \
+                instead of :py:class:`bamnostic.AlignedSegment` objects (default: None).
 
         """
 
+        self._lazy = lazy
+        self._projection = bamnostic.core.Projection.of(fields) if fields is not None else None
+
         # Set up the LRU buffer dictionary
         if max_cache < 1:
             raise ValueError("Use max_cache with a minimum of 1")
-        self._buffers = LruDict(max_cache=max_cache)
+        self._buffers = BlockCache(max_cache=max_cache, max_bytes=cache_bytes)
+
+        # Read-ahead is only set up once the header has been parsed (see below)
+        if threads < 1:
+            raise ValueError("Use threads with a minimum of 1")
+        self._threads = threads
+        self._pool = None
+        self._readahead = {}
+        self._readahead_offset = None
 
         # handle contradictory arguments caused by synonyms
         if filepath_or_object and filename and filename != filepath_or_object:
@@ -440,9 +1055,11 @@ class BgzfReader(object):
             else:
                 raise ValueError('either filepath_or_object or filename must be set')
 
-        # Check to see if file object or path was passed
-        if isinstance(filepath_or_object, io.IOBase):
-            handle = fileobj
+        # Check to see if file object or path was passed ('-' is standard input)
+        if isinstance(filepath_or_object, io.IOBase) or hasattr(filepath_or_object, 'read'):
+            handle = filepath_or_object
+        elif filepath_or_object == '-':
+            handle = getattr(sys.stdin, 'buffer', sys.stdin)
         else:
             handle = open(filepath_or_object, "rb")
 
@@ -453,26 +1070,51 @@ class BgzfReader(object):
         # Connect to the BAM file
         self._handle = handle
 
-        self._truncated = self._check_truncation()
+        # Pipes, sockets, and standard input can only be read sequentially
+        self._stream = not _is_seekable(handle)
+        self._stream_offset = 0
+        self._stream_ended = False
+        self._first_block_raw = None
+        self._last_stream_block = None
         self._igore_truncation = ignore_truncation
-        # Check BAM file integrity
-        if not self._igore_truncation:
-            if self._truncated:
-                raise Exception('BAM file may be truncated. Turn off ignore_truncation if you wish to continue')
+
+        # Readers of the same file share their blocks if the process-wide cache is enabled
+        shared_cache = None if self._stream else _shared_block_cache(handle)
+        if shared_cache is not None:
+            self._buffers = shared_cache
+        self._mmap = None
+        self._view = None
+        if mmap:
+            self._map_file()
 
         # Connect and process the Index file (if present)
         self._index = None
+        self._block_index = None
 
         if filepath_index and index_filename and index_filename != filepath_index:
             raise IOError('Use index_filename or filepath_or_object. Not both')
 
-        self._check_idx = self.check_index(index_filename if index_filename else filepath_index, require_index)
-        self._init_index()
+        if self._stream:
+            # The EOF marker of a stream is checked once the stream is exhausted
+            self._truncated = False
+            if require_index:
+                raise IOError('Random access (and therefore an index) is not available for streams')
+            self._random_access = False
+            self._check_idx = False
+        else:
+            self._truncated = self._check_truncation()
+            # Check BAM file integrity
+            if not self._igore_truncation:
+                if self._truncated:
+                    raise Exception('BAM file may be truncated. Turn off ignore_truncation if you wish to continue')
+
+            self._check_idx = self.check_index(index_filename if index_filename else filepath_index, require_index)
+            self._init_index()
 
         # Load the first block into the buffer and intialize cursor attributes
         self._block_start_offset = None
         self._block_raw_length = None
-        self._load_block(handle.tell())
+        self._load_block(0 if self._stream else handle.tell())
 
         # Load in the BAM header as an instance attribute
         self._load_header(check_sq)
@@ -480,6 +1122,11 @@ class BgzfReader(object):
         # Helper dictionary for changing reference names to refID/TID
         self.ref2tid = {v[0]: k for k, v in self._header.refs.items()}
 
+        # Start the read-ahead workers now that the header offsets have been recorded
+        if self._threads > 1:
+            self._pool = ThreadPool(self._threads)
+            self._schedule_readahead()
+
         # Final exception handling
         if check_header:
             warnings.warn('Obsolete method', UserWarning)
@@ -504,41 +1151,211 @@ class BgzfReader(object):
         if start_offset == self._block_start_offset:
             self._within_block_offset = 0
             return
-        elif start_offset in self._buffers:
+        cached = self._buffers.lookup(start_offset)
+        if cached is not None:
             # Already in cache
-            try:
-                self._buffer, self._block_raw_length = self._buffers.get(start_offset)
-            except TypeError:
-                pass
+            self._buffer, self._block_raw_length = cached
             self._within_block_offset = 0
             self._block_start_offset = start_offset
             return
 
         # Now load the block
         handle = self._handle
-        if start_offset is not None:
-            handle.seek(start_offset)
-        self._block_start_offset = handle.tell()
-        try:
-            block_size, self._buffer = _load_bgzf_block(handle)
-        except StopIteration:
-            # EOF
-            block_size = 0
-            if self._text:
-                self._buffer = ""
+        if start_offset in self._readahead:
+            # Inflated (or being inflated) by a read-ahead worker
+            block_size, pending = self._readahead.pop(start_offset)
+            self._block_start_offset = start_offset
+            self._buffer = pending.get()
+        elif self._stream:
+            if start_offset != self._stream_offset:
+                raise IOError('Cannot seek to offset {} of a non-seekable stream (next block is at {})'.format(
+                    start_offset, self._stream_offset))
+            self._block_start_offset = start_offset
+            raw = self._read_stream_block()
+            if raw:
+                block_size, cdata, crc, isize = _read_bgzf_block_from(raw, 0)
+                self._buffer = _inflate_bgzf_block(cdata, crc, isize)
             else:
+                # EOF
+                block_size = 0
                 self._buffer = b''
+        elif self._view is not None:
+            self._block_start_offset = start_offset
+            if start_offset < len(self._view):
+                block_size, cdata, crc, isize = _read_bgzf_block_from(self._view, start_offset)
+                self._buffer = _inflate_bgzf_block(cdata, crc, isize)
+            else:
+                # EOF
+                block_size = 0
+                self._buffer = b''
+        else:
+            if start_offset is not None:
+                handle.seek(start_offset)
+            self._block_start_offset = handle.tell()
+            try:
+                block_size, self._buffer = _load_bgzf_block(handle)
+            except StopIteration:
+                # EOF
+                block_size = 0
+                if self._text:
+                    self._buffer = ""
+                else:
+                    self._buffer = b''
         self._within_block_offset = 0
         self._block_raw_length = block_size
 
-        # Finally save the block in our cache,
-        self._buffers[self._block_start_offset] = self._buffer, block_size
+        # Finally save the block in our cache. The end of a stream is not a block: caching it
+        # would make `_at_eof` take it for the next block.
+        if block_size or not self._stream:
+            self._buffers[self._block_start_offset] = self._buffer, block_size
+
+        if self._pool is not None:
+            self._schedule_readahead()
+
+    def _schedule_readahead(self):
+        """(PRIVATE) Queue the blocks following the current block for inflation.
+
+        The compressed payloads are read on the calling thread (so the file handle
+        is never shared), while decompression and the integrity checks are handed
+        to the thread pool. Up to twice as many blocks as threads are kept in flight.
+        Blocks that a forward jump (e.g. between the chunks of a `fetch`) has skipped
+        are dropped. If the cursor has jumped away from the blocks being read ahead
+        altogether (e.g. after a `seek`), the stale read-ahead is discarded and
+        restarted from the new block.
+
+        """
+        # Skipped blocks would never be read, yet count against the read-ahead depth
+        for offset in [offset for offset in self._readahead if offset < self._block_start_offset]:
+            del self._readahead[offset]
+
+        next_offset = self._block_start_offset + self._block_raw_length
+        if next_offset not in self._readahead and next_offset != self._readahead_offset:
+            if self._stream and next_offset != self._stream_offset:
+                # The cursor is still catching up on blocks already read from the stream
+                return
+            self._readahead.clear()
+            self._readahead_offset = next_offset
+
+        handle = self._handle
+        if self._view is None and not self._stream:
+            handle.seek(self._readahead_offset)
+        while len(self._readahead) < 2 * self._threads:
+            start_offset = self._readahead_offset
+            if self._stream:
+                raw = self._read_stream_block()
+                if not raw:
+                    break  # EOF
+                block_size, cdata, crc, isize = _read_bgzf_block_from(raw, 0)
+                pending = self._pool.apply_async(_inflate_bgzf_block, (cdata, crc, isize))
+                self._readahead[start_offset] = block_size, pending
+                self._readahead_offset += block_size
+                continue
+            if start_offset in self._buffers:
+                # No need to inflate a block we already hold
+                self._readahead_offset += self._buffers[start_offset][1]
+                if self._view is None:
+                    handle.seek(self._readahead_offset)
+                continue
+            if self._view is not None:
+                if start_offset >= len(self._view):
+                    break  # EOF
+                block_size, cdata, crc, isize = _read_bgzf_block_from(self._view, start_offset)
+            else:
+                if not handle.read(1):
+                    break  # EOF
+                handle.seek(start_offset)
+                block_size, cdata, crc, isize = _read_bgzf_block(handle)
+            pending = self._pool.apply_async(_inflate_bgzf_block, (cdata, crc, isize))
+            self._readahead[start_offset] = block_size, pending
+            self._readahead_offset += block_size
+
+    def _map_file(self):
+        """(PRIVATE) Memory-map the BAM file for zero-copy block access.
+
+        Block headers are then unpacked in place and the deflated payloads are
+        passed to `zlib` as views into the mapping, so neither a `seek` nor a
+        copy of the compressed bytes is needed per block.
+
+        Raises:
+            ValueError: if the underlying file object cannot be memory-mapped
+
+        """
+        try:
+            self._mmap = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, io.UnsupportedOperation, mmap.error):
+            raise ValueError('mmap=True requires a regular file that can be memory-mapped')
+        try:
+            self._view = memoryview(self._mmap)
+        except TypeError:
+            # Python 2 mmap objects do not expose the new-style buffer interface
+            self._view = self._mmap
+
+    def _at_eof(self):
+        """(PRIVATE) Check whether any BGZF block follows the current one.
+
+        Returns:
+            (bool): True if the current block is the last block of the file, else False
+
+        """
+        next_offset = self._block_start_offset + self._block_raw_length
+        if self._view is not None:
+            return next_offset >= len(self._view)
+        if self._stream:
+            if self._stream_ended and next_offset == self._stream_offset:
+                return True
+            if next_offset in self._readahead or next_offset in self._buffers:
+                return False
+            if next_offset != self._stream_offset:
+                return False
+            # Pull the next block into the cache without moving the cursor
+            raw = self._read_stream_block()
+            if not raw:
+                return True
+            block_size, cdata, crc, isize = _read_bgzf_block_from(raw, 0)
+            self._buffers[next_offset] = _inflate_bgzf_block(cdata, crc, isize), block_size
+            return False
+        self._handle.seek(next_offset)
+        return not self._handle.read(1)
+
+    def _read_stream_block(self):
+        """(PRIVATE) Read the next raw BGZF block from a non-seekable stream.
+
+        Keeps track of the compressed offset of the stream, retains the first
+        block (for copying the header), and checks for the BGZF EOF marker once
+        the stream is exhausted.
+
+        Returns:
+            (:py:obj:`bytes`): the raw BGZF block, or an empty byte string at the end of the stream
+
+        Raises:
+            IOError: if the stream ends without the EOF marker and truncation is not ignored
+
+        """
+        if self._stream_ended:
+            return b''
+        raw = _read_bgzf_block_raw(self._handle)
+        if not raw:
+            self._stream_ended = True
+            if self._last_stream_block != _bgzf_eof:
+                self._truncated = True
+                if not self._igore_truncation:
+                    raise IOError('BAM stream ended without an EOF marker and may be truncated. '
+                                  'Set ignore_truncation if you wish to continue')
+            return raw
+        if self._stream_offset == 0:
+            self._first_block_raw = raw
+        self._last_stream_block = raw
+        self._stream_offset += len(raw)
+        return raw
 
     def check_index(self, index_filename=None, req_idx=False):
         """ Checks to make sure index file is available. If not, it disables random access.
 
+        Without `index_filename`, a BAI index ('<bam>.bai') is looked for first, then a
+        CSI index ('<bam>.csi').
+
         Args:
-            index_filename (str): path to index file (BAI) if it does not fit naming convention (default: None).
+            index_filename (str): path to index file (BAI or CSI) if it does not fit naming convention (default: None).
             req_idx (bool): Raise error if index file is not present (default: False).
 
         Returns:
@@ -561,6 +1378,9 @@ class BgzfReader(object):
         """
         if index_filename is None:
             possible_index_path = r'./{}.bai'.format(os.path.relpath(self._handle.name))
+            possible_csi_path = r'./{}.csi'.format(os.path.relpath(self._handle.name))
+            if not os.path.isfile(possible_index_path) and os.path.isfile(possible_csi_path):
+                possible_index_path = possible_csi_path
             if os.path.isfile(possible_index_path):
                 self._index_path = possible_index_path
                 self._random_access = True
@@ -584,14 +1404,32 @@ class BgzfReader(object):
                 return False
 
     def _init_index(self):
-        """Initialize the index file (BAI)"""
+        """Initialize the index file (BAI or CSI)"""
 
         if self._check_idx:
-            self._index = bamnostic.bai.Bai(self._index_path)
+            self._index = bamnostic.bai.load_index(self._index_path)
             self.__nocoordinate = self._index.n_no_coor
             self.__mapped = sum(self._index.unmapped[mapped].n_mapped for mapped in self._index.unmapped) + self.nocoordinate
             self.__unmapped = sum(self._index.unmapped[unmapped].n_unmapped for unmapped in self._index.unmapped) + self.nocoordinate
 
+    @property
+    def cache_stats(self):
+        """Get the usage statistics of the decompressed block cache.
+
+        Returns:
+            (:py:class:`bamnostic.utils.CacheStats`): hits, misses, evictions, and the number \
+                of blocks and decompressed bytes currently held
+
+        Example:
+            >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb', cache_bytes=2**20)
+            >>> reads = bam.head(n=5)
+            >>> stats = bam.cache_stats
+            >>> stats.hits > 0 and stats.nbytes <= stats.max_bytes
+            True
+
+        """
+        return self._buffers.stats()
+
     @property
     def nocoordinate(self):
         """Get the number of reads without coordiantes according to the statistics recorded in the index.
@@ -659,6 +1497,7 @@ class BgzfReader(object):
         self._header = BAMheader(self)
         self.header = self._header.SAMheader if self._header.SAMheader else self._header
         self.text = self._header._SAMheader_raw
+        self._refs_key = bamnostic.core.register_header(self._header)
 
         # make compatible with pysam attributes, even though the data exists elsewhere
         self.__references = []
@@ -792,6 +1631,74 @@ class BgzfReader(object):
         self._within_block_offset = within_block
         return virtual_offset
 
+    @property
+    def block_index(self):
+        """Get the block boundary index (`.gzi`) of the BAM file.
+
+        The index is loaded from `<BAM path>.gzi` if that file exists; otherwise,
+        it is built (without decompressing any data) on first access. See
+        :py:class:`BlockIndex` for details.
+
+        Returns:
+            (:py:class:`BlockIndex`): the block boundary index
+
+        """
+        if self._block_index is None:
+            gzi_path = '{}.gzi'.format(self._handle.name)
+            if os.path.isfile(gzi_path):
+                self._block_index = BlockIndex.load(gzi_path)
+            else:
+                self._block_index = BlockIndex.build(self._handle.name)
+        return self._block_index
+
+    def save_block_index(self, filename=None):
+        """Save the block boundary index next to the BAM file (or to `filename`)
+
+        Args:
+            filename (str): path of the `.gzi` file (default: `<BAM path>.gzi`)
+
+        Returns:
+            (str): path of the written `.gzi` file
+        """
+        if filename is None:
+            filename = '{}.gzi'.format(self._handle.name)
+        self.block_index.save(filename)
+        return filename
+
+    def useek(self, uoffset):
+        """Seek to a position within the uncompressed data stream.
+
+        Uses the block boundary index, so it works without a BAI. Note that the
+        position is not checked to be the start of a BAM record.
+
+        Args:
+            uoffset (int): position within the uncompressed data stream
+
+        Returns:
+            (int): the virtual offset of the new position
+
+        Example:
+            >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb')
+            >>> first_read = bam.block_index.uoffsets[1]  # the header fills the first block
+            >>> voffset = bam.useek(first_read)
+            >>> next(bam).read_name
+            'EAS56_57:6:190:289:82'
+            >>> bam.utell() > first_read
+            True
+
+        """
+        return self.seek(self.block_index.virtual_offset(uoffset))
+
+    def utell(self):
+        """Return the current position within the uncompressed data stream.
+
+        Returns:
+            (int): uncompressed offset of the cursor
+        """
+        index = self.block_index
+        i = bisect.bisect_left(index.coffsets, self._block_start_offset)
+        return index.uoffsets[i] + self._within_block_offset
+
     def read(self, size=-1):
         """Read method for the BGZF module.
 
@@ -880,9 +1787,14 @@ class BgzfReader(object):
 
     def fetch(self, contig=None, start=None, stop=None, region=None,
               tid=None, until_eof=False, multiple_iterators=False,
-              reference=None, end=None):
+              reference=None, end=None, require_flags=0, exclude_flags=0,
+              min_mapq=0, min_end=None, fields=None):
         r"""Creates a generator that returns all reads within the given region
 
+        Reads can also be filtered on their flag, MAPQ, and reference end. These
+        filters are checked against the raw record before the read is decoded, so
+        reads that are filtered out cost next to nothing.
+
         Args:
             contig (str): name of reference/contig
             start (int): start position of region of interest (0-based)
@@ -894,6 +1806,15 @@ class BgzfReader(object):
                  Notice: each iterator will open up a new view into the BAM file, so overhead will apply.
             reference (str): synonym for `contig`
             end (str): synonym for `stop`
+            require_flags (int): only return reads with all of these flag bits set (default: 0)
+            exclude_flags (int): skip reads with any of these flag bits set. For instance, \
+                0x704 skips unmapped, secondary, QC fail, and duplicate reads (default: 0)
+            min_mapq (int): skip reads with a MAPQ below this value (default: 0)
+            min_end (int): skip reads whose `reference_end` is below this value, \
+                along with reads that have no CIGAR (default: None)
+            fields (:py:obj:`tuple` of :py:obj:`str`): yield named tuples of only these fields \
+                (see :py:class:`bamnostic.core.Projection`). If None, the `fields` the file \
+                was opened with are used, if any (default: None).
 
         Yields:
             reads over the region of interest if any
@@ -933,6 +1854,9 @@ class BgzfReader(object):
                 ...
             AssertionError: Malformed region: start should be <= stop, you entered 100, 10
 
+            >>> [read.mapq for read in bam.fetch('chr1', 100, 200, min_mapq=90)][:5]
+            [99, 99, 99, 99, 99]
+
         """
 
         if not self._random_access:
@@ -940,11 +1864,111 @@ class BgzfReader(object):
         if multiple_iterators:
             raise NotImplementedError('multiple_iterators not yet implemented')
 
-        signature = locals()
-        for key in ['self', 'multiple_iterators']:
-            signature.pop(key)
+        query = self._resolve_region(contig=contig, start=start, stop=stop, region=region,
+                                     tid=tid, until_eof=until_eof, reference=reference, end=end)
+        projection = bamnostic.core.Projection.of(fields) if fields is not None else self._projection
+        for voffset, raw in self._fetch_raw(query, until_eof, require_flags=require_flags,
+                                            exclude_flags=exclude_flags, min_mapq=min_mapq,
+                                            min_end=min_end):
+            if projection is not None:
+                yield projection(raw, self)
+            else:
+                yield bamnostic.AlignedSegment(self, raw=raw)
+
+    def fetch_many(self, regions, dedup=False, fields=None):
+        """Creates a generator of the reads within many regions at once
+
+        The regions are sorted by reference and start, and the index chunks of all
+        the regions of a reference are merged (see `bamnostic.bai.merge_chunks`).
+        Every BGZF block needed is therefore read and inflated once, and every read
+        is decoded once, however many regions it falls into. Reads are selected
+        like `fetch` does, and come out in the order of the file, tagged with
+        the region(s) they belong to.
 
-        query = parse_region(**signature)
+        Args:
+            regions (iterable): regions, each either a SAM-formatted string (e.g. 'chr1:100-200') \
+                or a tuple of `fetch` positional arguments (e.g. ('chr1', 99, 200))
+            dedup (bool): yield each read once, along with all of its regions, instead of once \
+                per region (default: False).
+            fields (:py:obj:`tuple` of :py:obj:`str`): if given, yield named tuples of only these \
+                fields (see :py:class:`bamnostic.core.Projection`) instead of \
+                :py:class:`bamnostic.AlignedSegment` objects (default: None, uses the reader's `fields`).
+
+        Yields:
+            (:py:obj:`tuple`): the index of the region within `regions` (or, with `dedup`, a tuple \
+                of the indices of all its regions), and the read
+
+        Raises:
+            ValueError: if the BAM has no index, or a genomic region is invalid
+            KeyError: if a reference is not found in the header
+
+        Example:
+            >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb')
+            >>> hits = list(bam.fetch_many(['chr1:100-120', ('chr1', 110, 140)], dedup=True))
+            >>> [(regions, read.pos) for regions, read in hits][:4]
+            [((0,), 102), ((0,), 109), ((0, 1), 111), ((0, 1), 112)]
+            >>> len(hits), sum(1 for hit in bam.fetch_many(['chr1:100-120', ('chr1', 110, 140)]))
+            (20, 26)
+
+        """
+        if not self._random_access:
+            raise ValueError('Random access not available due to lack of index file')
+
+        queries = []
+        for i, region in enumerate(regions):
+            if isinstance(region, (tuple, list)):
+                query = self._resolve_region(*region)
+            else:
+                query = self._resolve_region(region=region)
+            queries.append((query.tid, query.start, query.stop, i))
+        queries.sort()
+
+        projection = bamnostic.core.Projection.of(fields) if fields is not None else self._projection
+        for tid, group in groupby(queries, key=lambda query: query[0]):
+            group = list(group)
+            chunks = []
+            for _, start, stop, _ in group:
+                chunks.extend(self._index.query_chunks(tid, start, stop))
+            last_stop = max(stop for _, start, stop, _ in group)
+
+            # Regions are activated as reads reach their start, and dropped once reads pass their stop
+            pending = 0
+            active = []
+            for chunk in self._chunk_records(bamnostic.bai.merge_chunks(chunks)):
+                for voffset, raw in chunk:
+                    ref_id, pos = unpack_refid_pos_from(raw, 4)
+                    if ref_id != tid or pos > last_stop:
+                        break
+                    while pending < len(group) and group[pending][1] <= pos:
+                        active.append(group[pending])
+                        pending += 1
+                    if active and min(stop for _, start, stop, _ in active) < pos:
+                        active = [query for query in active if query[2] >= pos]
+                    if not active:
+                        continue
+                    read = projection(raw, self) if projection is not None else bamnostic.AlignedSegment(self, raw=raw)
+                    if dedup:
+                        yield tuple(sorted(query[3] for query in active)), read
+                    else:
+                        for query in active:
+                            yield query[3], read
+                else:
+                    continue
+                break
+
+    def _resolve_region(self, contig=None, start=None, stop=None, region=None,
+                        tid=None, until_eof=False, reference=None, end=None):
+        """(PRIVATE) Parse a region and check it against the header. See `fetch` for the arguments.
+
+        Returns:
+            (:py:class:`bamnostic.utils.Roi`): the region, with both its `tid` and `contig` set
+
+        Raises:
+            ValueError: if the genomic coordinates are out of range or invalid
+            KeyError: Reference is not found in header
+        """
+        query = parse_region(contig=contig, start=start, stop=stop, region=region,
+                             tid=tid, until_eof=until_eof, reference=reference, end=end)
 
         if query.tid is not None and query.contig is None:
             query.contig = self.get_reference_name(tid)
@@ -966,38 +1990,121 @@ class BgzfReader(object):
             assert query.start <= query.stop, 'Malformed region: start should be <= stop, you entered {}, {}'.format(query.start, query.stop)
         except KeyError:
             raise KeyError('{} was not found in the file header'.format(query.contig))
+        return query
+
+    def _fetch_raw(self, query, until_eof=False, require_flags=0, exclude_flags=0,
+                   min_mapq=0, min_end=None):
+        """(PRIVATE) Iterate over the raw records of a region, as returned by `_resolve_region`
 
-        # from the index, get the virtual offset of the chunk that
-        # begins the overlapping region of interest
-        first_read_block = self._index.query(query.tid, query.start, query.stop)
-        if first_read_block is None:
+        The same records as `fetch` are selected. Only the fixed-size fields
+        are decoded to check the region and filters (and the CIGAR, if `min_end`
+        is set). See `fetch` for the filters.
+
+        Only the chunks of the file that the index lists for the region are read
+        (see `Bai.query_chunks`): the reader jumps from one chunk to the next and
+        stops at the end of the last one, or as soon as a read starts past the region.
+
+        Yields:
+            (:py:obj:`tuple` of (int, :py:obj:`memoryview`)): virtual offset and raw bytes of each record
+        """
+        chunks = self._index.query_chunks(query.tid, query.start, query.stop)
+        if not chunks:
             return
-        # move to that virtual offset...should load the block into the cache
-        # if it hasn't been visited before
-        self.seek(first_read_block)
-        boundary_check = True
-        while boundary_check:
-            next_read = next(self)
-            if not until_eof:
-                # check to see if the read is out of bounds of the region
-                if next_read.reference_name != query.contig:
-                    boundary_check = False
-                elif query.start < query.stop < next_read.pos:
-                    boundary_check = False
-                elif not query.start <= next_read.pos <= query.stop:
-                    continue
-                # check for stop iteration
-                elif next_read:
-                    yield next_read
-                else:
-                    return
-            else:
-                try:
-                    yield next_read
-                except:
+        if until_eof:
+            chunks = [(chunks[0][0], None)]
+        filtered = require_flags or exclude_flags or min_mapq
+        for chunk in self._chunk_records(chunks):
+            for record in chunk:
+                raw = record[1]
+                (block_size, ref_id, pos, bin_mq_nl, flag_nc,
+                 l_seq, next_ref_id, next_pos, tlen) = unpack_record_core_from(raw, 0)
+                if not until_eof:
+                    # check to see if the read is out of bounds of the region
+                    if ref_id != query.tid or query.start < query.stop < pos:
+                        return
+                    elif not query.start <= pos <= query.stop:
+                        continue
+                if filtered:
+                    flag = flag_nc >> 16
+                    if flag & require_flags != require_flags or flag & exclude_flags:
+                        continue
+                    if (bin_mq_nl >> 8) & 0xFF < min_mapq:
+                        continue
+                if min_end is not None:
+                    read_end = bamnostic.core.raw_reference_end(raw)
+                    if read_end is None or read_end < min_end:
+                        continue
+                yield record
+
+    def _chunk_records(self, chunks):
+        """(PRIVATE) Iterate over the raw records of index chunks
+
+        Args:
+            chunks (:py:obj:`list` of :py:obj:`tuple`): sorted, non-overlapping (voffset_beg, voffset_end) \
+                chunks. An end of None reads up to the end of the file.
+
+        Yields:
+            (generator): for each chunk, a generator of the (virtual offset, raw bytes) \
+                of its records. It must be consumed before moving on to the next chunk.
+        """
+        read_raw = self._read_raw_record
+
+        def chunk_records(voffset_end):
+            while True:
+                record = read_raw()
+                if record is None or (voffset_end is not None and record[0] >= voffset_end):
                     return
-        else:
-            return
+                yield record
+
+        for voffset_beg, voffset_end in chunks:
+            # move to that virtual offset...should load the block into the cache
+            # if it hasn't been visited before
+            self.seek(voffset_beg)
+            yield chunk_records(voffset_end)
+
+    def fetch_batches(self, contig=None, start=None, stop=None, region=None,
+                      tid=None, until_eof=False, reference=None, end=None,
+                      batch_size=10000, fields=None, numpy=None):
+        r"""Creates a generator of columnar batches of the reads within the given region
+
+        The reads are the same as those returned by `fetch`, but they are decoded
+        straight into a :py:class:`bamnostic.RecordBatch` (one array per field)
+        without building an :py:class:`bamnostic.AlignedSegment` for each read.
+
+        Args:
+            contig, start, stop, region, tid, until_eof, reference, end: the region, see `fetch`
+            batch_size (int): maximum number of reads per batch (default: 10000)
+            fields (:py:obj:`list` of :py:obj:`str`): fields to decode, see \
+                :py:class:`bamnostic.RecordBatch` (default: None, all the fixed-size fields)
+            numpy (None|bool): store the columns as NumPy arrays. If None, NumPy is \
+                used when it is installed (default: None).
+
+        Yields:
+            (:py:class:`bamnostic.RecordBatch`): batches of at most `batch_size` reads
+
+        Raises:
+            ValueError: if the genomic coordinates are out of range or invalid
+            KeyError: Reference is not found in header
+
+        Examples:
+            >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb')
+            >>> [len(batch) for batch in bam.fetch_batches('chr1', 100, 500, batch_size=150)]
+            [150, 150, 55]
+
+        """
+        if not self._random_access:
+            raise ValueError('Random access not available due to lack of index file')
+
+        query = self._resolve_region(contig=contig, start=start, stop=stop, region=region,
+                                     tid=tid, until_eof=until_eof, reference=reference, end=end)
+        records = []
+        for voffset, raw in self._fetch_raw(query, until_eof):
+            records.append(raw)
+            if len(records) == batch_size:
+                yield bamnostic.RecordBatch.from_records(records, fields, numpy)
+                records = []
+        if records:
+            yield bamnostic.RecordBatch.from_records(records, fields, numpy)
 
     def count(self, contig=None, start=None, stop=None, region=None,
               until_eof=False, tid=None, read_callback='nofilter',
@@ -1081,14 +2188,20 @@ class BgzfReader(object):
         signature = locals()
         signature.pop('read_callback')
         signature.pop('self')
-        roi_reads = self.fetch(**signature)
-        # make `nofilter` the default filter unless told otherwise
-        # read_callback = kwargs.get('read_callback', 'nofilter')
+
+        if not self._random_access:
+            raise ValueError('Random access not available due to lack of index file')
+        query = self._resolve_region(**signature)
+
+        # Built-in filters are checked on the raw records, so no read has to be decoded
+        if read_callback in ('all', 'nofilter'):
+            exclude_flags = 0x704 if read_callback == 'all' else 0
+            return sum(1 for record in self._fetch_raw(query, until_eof, exclude_flags=exclude_flags))
 
         # go through all the reads over a given region and count them
         count = 0
-        for read in roi_reads:
-            if filter_read(read, read_callback):
+        for voffset, raw in self._fetch_raw(query, until_eof):
+            if filter_read(bamnostic.AlignedSegment(self, raw=raw), read_callback):
                 count += 1
         return count
 
@@ -1174,8 +2287,19 @@ class BgzfReader(object):
         guanine = adenine[:]
         thymine = adenine[:]
 
-        for read in self.fetch(**signature):
-            if read.cigarstring is not None and read.mapq >= quality_threshold:
+        if not self._random_access:
+            raise ValueError('Random access not available due to lack of index file')
+        query = self._resolve_region(**signature)
+
+        # MAPQ and the built-in flag filter are checked before the reads are decoded
+        exclude_flags = 0
+        if read_callback == 'all':
+            exclude_flags = 0x704
+            read_callback = 'nofilter'
+
+        for voffset, raw in self._fetch_raw(query, exclude_flags=exclude_flags, min_mapq=quality_threshold):
+            read = bamnostic.AlignedSegment(self, raw=raw)
+            if read.cigarstring is not None:
                 if filter_read(read, read_callback):
                     for base, index in cigar_alignment(seq=read.seq, cigar=read.cigarstring,
                                                        start_pos=read.pos, qualities=read.query_qualities,
@@ -1392,9 +2516,8 @@ class BgzfReader(object):
             head_iter = bamnostic.AlignmentFile(self._handle.name, index_filename=self._index_path)
         else:
             curr_pos = self.tell()
-            # BAMheader uses byte specific positions (and not BGZF virtual offsets)
-            self._handle.seek(self._header._BAMheader_end)
-            self._load_block(self._handle.tell())
+            # BAMheader records the virtual offset of the end of the header
+            self.seek(self._header._BAMheader_end)
             head_iter = self
 
         head_reads = [next(head_iter) for read in range(n)]
@@ -1408,17 +2531,217 @@ class BgzfReader(object):
             assert self.tell() == curr_pos
         return head_reads
 
+    def _read_raw_record(self):
+        """(PRIVATE) Read the next BAM record without decoding any of its fields.
+
+        The cursor is first moved past the end of an exhausted block, so the
+        returned virtual offset always points into the block where the record
+        starts. Records contained in a single block are returned as a view into
+        the decompressed block buffer; only records spanning blocks are copied.
+
+        Returns:
+            (None | :py:obj:`tuple` of (int, :py:obj:`memoryview`)): virtual offset of the record and its \
+                raw bytes (including the 4-byte `block_size` prefix), or None at the end of file
+
+        Raises:
+            IOError: if the file ends in an unexpected place
+
+        """
+        buf = self._buffer
+        within = self._within_block_offset
+        while within >= len(buf):
+            if not buf and self._at_eof():
+                return None
+            self._load_block()
+            buf = self._buffer
+            within = 0
+        voffset = (self._block_start_offset << 16) | within
+        stop = within + 4
+        if stop <= len(buf):
+            stop += unpack_int32_from(buf, within)[0]
+            if stop <= len(buf):
+                # Fast path: the record is contained within the current block
+                self._within_block_offset = stop
+                return voffset, memoryview(buf)[within:stop]
+
+        bsize_buffer = self.read(4)
+        if len(bsize_buffer) < 4:
+            raise IOError('Reached End of file, but marker does not match BAM standard')
+        block_size = unpack_int32(bsize_buffer)[0]
+        record = bsize_buffer + self.read(block_size)
+        if len(record) < 4 + block_size:
+            raise IOError('Reached End of file in the middle of a record')
+        return voffset, memoryview(record)
+
+    def iter_raw(self):
+        """Iterate over the raw bytes of the records from the current position.
+
+        No field of the records is decoded, which makes this the fastest way
+        to copy, count, hash, or route records. The views stay valid after the
+        iteration moves on (they keep their decompressed block alive), but they
+        should be copied (`bytes(view)`) if they are to be held for long.
+
+        Yields:
+            (:py:obj:`tuple` of (int, :py:obj:`memoryview`)): virtual offset of each record and its raw \
+                bytes, including the 4-byte `block_size` prefix
+
+        Example:
+            >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb')
+            >>> voffset, raw = next(bam.iter_raw())
+            >>> voffset == make_virtual_offset(53, 0), len(raw) == 4 + unpack_int32(raw[:4])[0]
+            (True, True)
+            >>> sum(1 for record in bam.iter_raw()) + 1
+            3270
+
+        """
+        read_raw = self._read_raw_record
+        while True:
+            record = read_raw()
+            if record is None:
+                return
+            yield record
+
+    def scan(self, reuse=False, lazy=None):
+        """Iterate over the reads from the current position.
+
+        With `reuse`, the same :py:class:`bamnostic.AlignedSegment` object (or
+        each object of a small ring of them, in turn) is re-populated with the
+        next record instead of a new read being allocated. This cuts allocation
+        and garbage collection in full-file scans where each read is used once
+        and then discarded: reused reads are lazy by default, and view the raw
+        record in the decompressed block rather than copying it. A reused read is
+        overwritten by the next iteration, so any read that has to be kept must be
+        copied out (e.g. its fields) first. Projected fields set on the reader
+        (`fields`) are not applied.
+
+        Args:
+            reuse (bool|int): re-populate the same read object. An integer greater than 1 \
+                cycles through a ring of that many objects, so that the latest \
+                `reuse` reads stay valid at once (default: False).
+            lazy (None|bool): decode the CIGAR, sequence, qualities, and tags on first access. \
+                If None, reused reads are lazy, and the setting of the reader is used \
+                otherwise (default: None).
+
+        Yields:
+            (:py:class:`bamnostic.AlignedSegment`): the reads
+
+        Example:
+            >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb')
+            >>> reads = bam.scan(reuse=True)
+            >>> first = next(reads)
+            >>> first.read_name
+            'EAS56_57:6:190:289:82'
+            >>> read = next(reads)
+            >>> read = next(reads)
+            >>> read is first, read.read_name
+            (True, 'EAS51_64:3:190:727:308')
+
+        """
+        read_raw = self._read_raw_record
+        if not reuse:
+            while True:
+                record = read_raw()
+                if record is None:
+                    return
+                yield bamnostic.AlignedSegment(self, lazy=lazy, raw=record[1])
+
+        if lazy is None:
+            lazy = True
+        ring = []
+        for _ in range(int(reuse)):
+            read = bamnostic.AlignedSegment.__new__(bamnostic.AlignedSegment)
+            read._io = self
+            ring.append(read)
+        i = 0
+        while True:
+            record = read_raw()
+            if record is None:
+                return
+            read = ring[i]
+            read._load(record[1], lazy, copy=False)
+            i = (i + 1) % len(ring)
+            yield read
+
+    def iter_core_fields(self, numpy=None):
+        """Iterate over the fixed-size fields of the records from the current position, block by block
+
+        Every decompressed BGZF block is handled as a whole by `record_offsets` and
+        `core_fields`, so no per-read object is created. A record that starts in one
+        block and ends in a later one is stitched together from the block edges
+        and reported along with the records of the block where it ends.
+
+        Args:
+            numpy (None|bool): yield NumPy arrays. If None, NumPy is used when it \
+                is installed (default: None).
+
+        Yields:
+            (:py:obj:`dict`): columns of fixed-size fields for the records of each block (see `core_fields`)
+
+        Raises:
+            IOError: if the file ends in the middle of a record
+
+        Example:
+            >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb')
+            >>> sum(len(fields['flag']) for fields in bam.iter_core_fields(numpy=False))
+            3270
+
+        """
+        if numpy is None:
+            numpy = _np is not None
+        carry = b''
+        buf = self._buffer
+        within = self._within_block_offset
+        while True:
+            stitched = None
+            if carry:
+                # Complete the record that spans the edge of the previous block
+                if len(carry) < 4:
+                    take = 4 - len(carry)
+                    carry += bytes(buf[within:within + take])
+                    within = min(within + take, len(buf))
+                if len(carry) >= 4:
+                    take = 4 + unpack_int32(carry[:4])[0] - len(carry)
+                    carry += bytes(buf[within:within + take])
+                    within = min(within + take, len(buf))
+                    if len(carry) == 4 + unpack_int32(carry[:4])[0]:
+                        stitched = core_fields(carry, [0], numpy)
+                        carry = b''
+
+            offsets, stop = record_offsets(buf, within)
+            fields = core_fields(buf, offsets, numpy) if offsets else None
+            if stitched is not None:
+                if fields is None:
+                    fields = stitched
+                elif numpy:
+                    fields = dict((name, _np.concatenate((stitched[name], fields[name]))) for name in fields)
+                else:
+                    fields = dict((name, stitched[name] + fields[name]) for name in fields)
+            if fields is not None:
+                yield fields
+
+            carry += bytes(buf[stop:])
+            self._within_block_offset = len(buf)
+            if self._at_eof():
+                break
+            self._load_block()
+            buf = self._buffer
+            within = 0
+        if carry:
+            raise IOError('Reached End of file in the middle of a record')
+
     def __next__(self):
         """Return the next line (Py2 Compatibility)."""
 
-        read = bamnostic.AlignedSegment(self)
-        if not read:
-            raise StopIteration
-        return read
+        return self.next()
 
     def next(self):
         """Return the next line."""
 
+        if self._projection is not None:
+            record = self._read_raw_record()
+            if record is None:
+                raise StopIteration
+            return self._projection(record[1], self)
         read = bamnostic.AlignedSegment(self)
         if not read:
             raise StopIteration
@@ -1432,6 +2755,20 @@ class BgzfReader(object):
     def close(self):
         """Close BGZF file."""
 
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+            self._readahead = {}
+        if self._mmap is not None:
+            if self._view is not self._mmap:
+                self._view.release()
+            self._view = None
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Views into the mapping are still alive; leave it to the garbage collector
+                pass
+            self._mmap = None
         self._handle.close()
         self._buffer = None
         self._block_start_offset = None
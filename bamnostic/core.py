@@ -14,6 +14,7 @@ as part of this package.
 @email: "mdsherman<at>betteridiot<dot>tech"
 
 """
+import hashlib
 import os
 import struct
 import sys
@@ -24,6 +25,11 @@ import bamnostic
 from bamnostic import bgzf, bai
 from bamnostic.utils import *
 
+try:
+    import numpy as _np
+except ImportError:
+    _np = None
+
 _PY_VERSION = sys.version
 
 
@@ -81,10 +87,19 @@ Cigar = namedtuple('Cigar', ('op_code', 'n_op', 'op_id', 'op_name'))
 #    'X' : ('BAM_CDIFF', 8),
 #    'B' : ('BAM_CBACK', 9)}
 
+# CIGAR op codes that consume the reference, and those that are aligned to it (M, =, X)
+_REF_CONSUMING_OPS = frozenset((0, 2, 3, 7, 8))
+_MATCH_OPS = frozenset((0, 7, 8))
+
 # The byte encoding of both CIGAR and SEQ are mapped to these strings
 _CIGAR_KEY = "MIDNSHP=X"
 _SEQ_KEY = '=ACMGRSVTWYHKDBN'
 
+# Lookup tables for decoding whole reads at once: every packed sequence byte
+# expands to its two bases, and Phred scores are offset by 33 through `translate`
+_SEQ_PAIRS = tuple(hi + lo for hi in _SEQ_KEY for lo in _SEQ_KEY)
+_QUAL_TABLE = bytes(bytearray((q + 33) & 0xFF for q in range(256)))
+
 
 def offset_qual(qual_string):
     """ Offsets the ASCII-encoded quality string to represent PHRED score.
@@ -130,22 +145,390 @@ def offset_qual(qual_string):
 
 
 # compiled/performant struct objects
-_unpack_refId_pos = struct.Struct('<2i').unpack
-_unpack_bmq_flag = struct.Struct('<2I').unpack
-_unpack_lseq_nrid_npos_tlen = struct.Struct('<4i').unpack
-_unpack_tag_val = struct.Struct('<2ss').unpack
-_unpack_string = struct.Struct('<s').unpack
-_unpack_array = struct.Struct('<si').unpack
+# refID, pos, bin_mq_nl, flag_nc, l_seq, next_refID, next_pos, tlen
+_unpack_core_from = struct.Struct('<2i2I4i').unpack_from
+_CORE_SIZE = 36  # block_size prefix and the core fields above
+_unpack_array_from = struct.Struct('<si').unpack_from
+
+# Parsers for the fixed-size tag values, and the `array` typecodes of `B` array subtypes
+_TAG_STRUCTS = dict((val_type, struct.Struct('<' + fmt)) for val_type, fmt in
+                    ((b'A', 'c'), (b'c', 'b'), (b'C', 'B'), (b's', 'h'),
+                     (b'S', 'H'), (b'i', 'i'), (b'I', 'I'), (b'f', 'f')))
+_TAG_ARRAY_TYPES = {b'c': 'b', b'C': 'B', b's': 'h', b'S': 'H', b'i': 'i', b'I': 'I', b'f': 'f'}
+
+
+def _parse_tag(tag_block, cursor):
+    """Processes the variety of tags that accompany sequencing reads
+
+    The BAM format does not store the length of string and hex-formatted byte
+    arrays. These are null-terminated, so their end is found by searching
+    for the next null byte. Numeric arrays are read straight into an
+    :py:obj:`array.array`. In all other cases, the size of the value follows
+    from its type.
+
+    The final caveat is that the number of tags is not stored. Therefore, the function
+    returns the position of the next tag so that tags can be serially parsed
+    until the end of the tag block.
+
+    Args:
+        tag_block (bytes): the raw tag data of a read
+        cursor (int): offset of the tag to be parsed within `tag_block`
+
+    Returns:
+        the tag, a tuple of the value type and value, and the offset of the next tag
+
+    Raises:
+        ValueError: if the value type of the tag is not defined by the BAM format
+    """
+    tag = tag_block[cursor:cursor + 2].decode()
+    val_type = tag_block[cursor + 2:cursor + 3]
+    cursor += 3
+
+    # Everything of a fixed size
+    if val_type in _TAG_STRUCTS:
+        tag_struct = _TAG_STRUCTS[val_type]
+        val = tag_struct.unpack_from(tag_block, cursor)[0]
+        if val_type == b'A':
+            val = val.decode(encoding='latin_1')
+        return tag, (val_type.decode(), val), cursor + tag_struct.size
+
+    # Capture given length string or hex array
+    elif val_type == b'Z' or val_type == b'H':
+        end = tag_block.find(b'\x00', cursor)
+        val = tag_block[cursor:end].decode(encoding='latin_1')
+        if val_type == b'H':
+            val = val.upper()
+        return tag, (val_type.decode(), val), end + 1
+
+    # Capture byte array of a given size
+    elif val_type == b'B':
+        arr_type, arr_size = _unpack_array_from(tag_block, cursor)
+        cursor += 5
+        arr = CompatibleArray(_TAG_ARRAY_TYPES[arr_type])
+        end = cursor + arr_size * arr.itemsize
+        arr.fromstring(tag_block[cursor:end])
+        if sys.byteorder == 'big':
+            arr.byteswap()
+        return tag, ('B', arr), end
+
+    else:
+        raise ValueError('Unknown value type {!r} for tag {}'.format(val_type, tag))
+
+
+def _scan_tag(tag_block, tag):
+    """Scans a raw tag block for a single tag, decoding only its value
+
+    The other tags are skipped over using the size of their value type.
+
+    Args:
+        tag_block (bytes): the raw tag data of a read
+        tag (str): the tag of interest
+
+    Returns:
+        tuple of the value type and value of `tag`, or None if the read does not have it
+    """
+    key = tag.encode()
+    cursor = 0
+    while cursor < len(tag_block):
+        if tag_block[cursor:cursor + 2] == key:
+            return _parse_tag(tag_block, cursor)[1]
+        val_type = tag_block[cursor + 2:cursor + 3]
+        cursor += 3
+        if val_type in _TAG_STRUCTS:
+            cursor += _TAG_STRUCTS[val_type].size
+        elif val_type == b'Z' or val_type == b'H':
+            cursor = tag_block.find(b'\x00', cursor) + 1
+        elif val_type == b'B':
+            arr_type, arr_size = _unpack_array_from(tag_block, cursor)
+            cursor += 5 + arr_size * _TAG_STRUCTS[arr_type].size
+        else:
+            raise ValueError('Unknown value type {!r} for tag {}'.format(val_type, tag_block[cursor - 3:cursor - 1]))
+    return None
+
+
+def _raw_cigar(raw):
+    """Unpacks the BAM-encoded CIGAR operations of a raw record
+
+    CIGARs with more than 65535 operations are stored in the CG tag, with a
+    placeholder in the CIGAR field. In that case, the operations of the CG tag
+    are returned.
+
+    Args:
+        raw (:py:obj:`memoryview`): raw record, including its `block_size` prefix
+
+    Returns:
+        (:py:obj:`tuple` | :py:obj:`array.array`): CIGAR operations (`length << 4 | op`)
+    """
+    (ref_id, pos, bin_mq_nl, flag_nc, l_seq,
+     next_ref_id, next_pos, tlen) = _unpack_core_from(raw, 4)
+    n_cigar_op = flag_nc & 0xFFFF
+    cigar_offset = _CORE_SIZE + (bin_mq_nl & 0xFF)
+    cigar = struct.unpack_from('<{}I'.format(n_cigar_op), raw, cigar_offset)
+    if n_cigar_op and cigar[0] == l_seq << 4 | 4:
+        tag_offset = cigar_offset + 4 * n_cigar_op + (l_seq + 1) // 2 + l_seq
+        cg = _scan_tag(raw[tag_offset:].tobytes(), 'CG')
+        if cg is not None:
+            return cg[1]
+    return cigar
+
+
+def raw_reference_end(raw):
+    """Computes the reference end of a raw record from its CIGAR, without decoding the rest
+
+    Args:
+        raw (:py:obj:`memoryview`): raw record, including its `block_size` prefix \
+            (as yielded by `BgzfReader.iter_raw`)
+
+    Returns:
+        (int | None): one past the last reference position aligned, or None if the read has no CIGAR
+
+    Example:
+        >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb')
+        >>> voffset, raw = next(read for read in bam.iter_raw() if raw_reference_end(read[1]) is not None)
+        >>> raw_reference_end(raw)
+        134
+
+    """
+    cigar = _raw_cigar(raw)
+    if not cigar:
+        return None
+    return _unpack_core_from(raw, 4)[1] + sum(op >> 4 for op in cigar if op & 0xF in _REF_CONSUMING_OPS)
+
+
+def _raw_offsets(core):
+    """Offsets of the CIGAR, sequence, qualities, and tags of a raw record from its unpacked core fields"""
+    cigar_offset = _CORE_SIZE + (core[2] & 0xFF)
+    seq_offset = cigar_offset + 4 * (core[3] & 0xFFFF)
+    qual_offset = seq_offset + (core[4] + 1) // 2
+    return cigar_offset, seq_offset, qual_offset, qual_offset + core[4]
+
+
+def _raw_cigartuples(raw):
+    cigar = _raw_cigar(raw)
+    return [(op & 0xF, op >> 4) for op in cigar] if cigar else None
+
+
+def _raw_cigarstring(raw):
+    cigar = _raw_cigar(raw)
+    return ''.join(['{}{}'.format(op >> 4, _CIGAR_KEY[op & 0xF]) for op in cigar]) if cigar else None
+
+
+def _raw_seq(raw, core):
+    cigar_offset, seq_offset, qual_offset, tag_offset = _raw_offsets(core)
+    return ''.join(map(_SEQ_PAIRS.__getitem__, bytearray(raw[seq_offset:qual_offset])))[:core[4]]
+
+
+def _raw_qual(raw, core):
+    cigar_offset, seq_offset, qual_offset, tag_offset = _raw_offsets(core)
+    raw_qual = raw[qual_offset:tag_offset].tobytes()
+    if raw_qual[:1] == b'\xff':
+        return '*'
+    return raw_qual.translate(_QUAL_TABLE).decode('latin_1')
+
+
+def _raw_query_qualities(raw, core):
+    cigar_offset, seq_offset, qual_offset, tag_offset = _raw_offsets(core)
+    query_qualities = CompatibleArray('B')
+    query_qualities.fromstring(raw[qual_offset:tag_offset].tobytes())
+    return query_qualities
+
+
+def _raw_tags(raw, core):
+    cigar_offset, seq_offset, qual_offset, tag_offset = _raw_offsets(core)
+    tag_block = raw[tag_offset:].tobytes()
+    tags = {}
+    cursor = 0
+    while cursor < len(tag_block):
+        tag, value, cursor = _parse_tag(tag_block, cursor)
+        tags[tag] = value
+    # Like `AlignedSegment`, a CG tag that holds the actual CIGAR is not reported as a tag
+    if 'CG' in tags and core[3] & 0xFFFF and \
+            struct.unpack_from('<I', raw, cigar_offset)[0] == core[4] << 4 | 4:
+        del tags['CG']
+    return tags
+
+
+def _raw_reference_length(raw):
+    end = raw_reference_end(raw)
+    return None if end is None else end - _unpack_core_from(raw, 4)[1]
+
+
+# SAM value types of the BAM tag types: integers of every size are written as 'i'
+_SAM_TAG_TYPES = {'c': 'i', 'C': 'i', 's': 'i', 'S': 'i', 'i': 'i', 'I': 'i'}
+_SAM_INT_STRUCTS = dict((val_type, _TAG_STRUCTS[val_type]) for val_type in (b'c', b'C', b's', b'S', b'i', b'I'))
+_SAM_ARRAY_SUBTYPES = dict((typecode, val_type.decode()) for val_type, typecode in _TAG_ARRAY_TYPES.items())
+
+
+def _sam_tag(tag, val_type, val):
+    """Formats a parsed tag as a SAM `TAG:TYPE:VALUE` field"""
+    if val_type == 'B':
+        fmt = '{:g}' if val.typecode == 'f' else '{}'
+        val = ','.join([_SAM_ARRAY_SUBTYPES[val.typecode]] + [fmt.format(v) for v in val])
+    elif val_type == 'f':
+        val = '{:g}'.format(val)
+    return '{}:{}:{}'.format(tag, _SAM_TAG_TYPES.get(val_type, val_type), val)
+
+
+def _raw_sam_line(raw, names):
+    """Renders a raw record as a line of SAM text (without the newline)
+
+    Unlike `AlignedSegment.__repr__`, the line is valid SAM: integer tags are
+    written with the `i` type, numeric arrays with their subtype, and the tags
+    keep the order they have in the record.
+
+    Args:
+        raw (:py:obj:`memoryview`): raw record, including its `block_size` prefix
+        names (:py:obj:`dict`): reference names by refID, with '*' for -1
+
+    Returns:
+        (str): the SAM line
+    """
+    core = _unpack_core_from(raw, 4)
+    ref_id, pos, bin_mq_nl, flag_nc, l_seq, next_ref_id, next_pos, tlen = core
+    cigar_offset, seq_offset, qual_offset, tag_offset = _raw_offsets(core)
+    cigar = _raw_cigar(raw)
+    if next_ref_id == ref_id and ref_id != -1:
+        rnext = '='
+    else:
+        rnext = names[next_ref_id]
+    fields = [raw[_CORE_SIZE:cigar_offset - 1].tobytes().decode(),
+              str(flag_nc >> 16),
+              names[ref_id],
+              str(pos + 1),
+              str((bin_mq_nl >> 8) & 0xFF),
+              ''.join(['{}{}'.format(op >> 4, _CIGAR_KEY[op & 0xF]) for op in cigar]) if cigar else '*',
+              rnext,
+              str(next_pos + 1),
+              str(tlen),
+              _raw_seq(raw, core) if l_seq else '*',
+              _raw_qual(raw, core) if l_seq else '*']
+
+    tag_block = raw[tag_offset:].tobytes()
+    # A CG tag that holds the actual CIGAR is not written out
+    cg_is_cigar = len(cigar) * 4 != seq_offset - cigar_offset
+    cursor = 0
+    while cursor < len(tag_block):
+        val_type = tag_block[cursor + 2:cursor + 3]
+        if val_type in _SAM_INT_STRUCTS:
+            # Integer tags are by far the most common: skip the generic parsing
+            tag_struct = _SAM_INT_STRUCTS[val_type]
+            fields.append('{}:i:{}'.format(tag_block[cursor:cursor + 2].decode(),
+                                           tag_struct.unpack_from(tag_block, cursor + 3)[0]))
+            cursor += 3 + tag_struct.size
+            continue
+        tag, (val_type, val), cursor = _parse_tag(tag_block, cursor)
+        if tag != 'CG' or not cg_is_cigar:
+            fields.append(_sam_tag(tag, val_type, val))
+    return '\t'.join(fields)
+
+
+# How each field of a projected record is decoded from the raw record, its unpacked
+# core fields, and the reader. Names follow the attributes of `AlignedSegment`.
+_FIELD_DECODERS = {
+    'refID': lambda raw, core, _io: core[0],
+    'pos': lambda raw, core, _io: core[1],
+    'bin': lambda raw, core, _io: core[2] >> 16,
+    'mapq': lambda raw, core, _io: (core[2] >> 8) & 0xFF,
+    'flag': lambda raw, core, _io: core[3] >> 16,
+    'l_seq': lambda raw, core, _io: core[4],
+    'next_refID': lambda raw, core, _io: core[5],
+    'next_pos': lambda raw, core, _io: core[6],
+    'tlen': lambda raw, core, _io: core[7],
+    'read_name': lambda raw, core, _io: raw[_CORE_SIZE:_CORE_SIZE + (core[2] & 0xFF) - 1].tobytes().decode(),
+    'reference_name': lambda raw, core, _io: _io._header.refs[core[0]][0],
+    'cigartuples': lambda raw, core, _io: _raw_cigartuples(raw),
+    'cigarstring': lambda raw, core, _io: _raw_cigarstring(raw),
+    'reference_end': lambda raw, core, _io: raw_reference_end(raw),
+    'reference_length': lambda raw, core, _io: _raw_reference_length(raw),
+    'seq': lambda raw, core, _io: _raw_seq(raw, core),
+    'qual': lambda raw, core, _io: _raw_qual(raw, core),
+    'query_qualities': lambda raw, core, _io: _raw_query_qualities(raw, core),
+    'tags': lambda raw, core, _io: _raw_tags(raw, core)}
+
+# Synonyms, as found on `AlignedSegment`
+for _alias, _field in (('tid', 'refID'), ('reference_id', 'refID'), ('reference_start', 'pos'),
+                       ('mapping_quality', 'mapq'), ('query_length', 'l_seq'), ('query_name', 'read_name'),
+                       ('cigar', 'cigartuples'), ('query_sequence', 'seq')):
+    _FIELD_DECODERS[_alias] = _FIELD_DECODERS[_field]
+del _alias, _field
+
+
+class Projection(object):
+    """Decodes only the requested fields of raw records into lightweight named tuples
+
+    Projections are created (and cached) through `Projection.of`, and used by
+    `AlignmentFile` when a set of `fields` is given, either when the file is
+    opened or to `fetch`. The sections of the record that none of the fields
+    need (e.g. the sequence, qualities, or tags) are never touched.
+
+    Example:
+        >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb', fields=('pos', 'mapq', 'cigarstring'))
+        >>> next(bam)
+        Record(pos=99, mapq=0, cigarstring=None)
+        >>> next(bam.fetch('chr1', 100, 120, fields=('read_name', 'reference_end')))
+        Record(read_name='EAS51_64:3:190:727:308', reference_end=137)
+
+    """
+    __slots__ = ('fields', 'record_type', '_decoders')
+    _cache = {}
+
+    def __init__(self, fields):
+        """Build the projection of `fields`. Use `Projection.of` to reuse existing projections.
+
+        Args:
+            fields (:py:obj:`tuple` of :py:obj:`str`): names of the fields to decode
+
+        Raises:
+            ValueError: if a field is not known
+        """
+        unknown = [field for field in fields if field not in _FIELD_DECODERS]
+        if unknown:
+            raise ValueError('Unknown fields: {}. Choose from: {}'.format(
+                ', '.join(unknown), ', '.join(sorted(_FIELD_DECODERS))))
+        self.fields = tuple(fields)
+        self.record_type = namedtuple('Record', self.fields)
+        self._decoders = [_FIELD_DECODERS[field] for field in self.fields]
+
+    @classmethod
+    def of(cls, fields):
+        """Gets the (cached) projection of `fields`
+
+        Args:
+            fields (:py:obj:`tuple` of :py:obj:`str`): names of the fields to decode
+
+        Returns:
+            (:py:class:`Projection`): projection decoding `fields`
+        """
+        fields = tuple(fields)
+        try:
+            return cls._cache[fields]
+        except KeyError:
+            projection = cls._cache[fields] = cls(fields)
+            return projection
+
+    def __call__(self, raw, _io):
+        """Decode a raw record
+
+        Args:
+            raw (:py:obj:`memoryview`): raw record, including its `block_size` prefix
+            _io (BgzfReader): reader the record comes from (for reference names)
+
+        Returns:
+            (:py:obj:`namedtuple`): the requested fields of the record
+        """
+        core = _unpack_core_from(raw, 4)
+        return self.record_type._make([decode(raw, core, _io) for decode in self._decoders])
 
 
 class AlignmentFile(bgzf.BgzfReader, bgzf.BgzfWriter):
     """Wrapper to allow drop in replacement for BAM functionality in a ``pysam``-like API.
 
     Args:
-        filepath_or_object (str | :py:obj:`file`): the path or file object of the BAM file
+        filepath_or_object (str | :py:obj:`file`): the path or file object of the BAM file. Pipes, \
+            sockets, and standard input (`'-'`) are read as streams: sequential iteration only.
         mode (str): Mode for reading. BAM files are binary by nature (default: 'rb').
         max_cache (int): number of desired LRU cache size, preferably a multiple of 2 (default: 128).
-        index_filename (str): path to index file (BAI) if it is named differently than the BAM file (default: None).
+        index_filename (str): path to index file (BAI or CSI) if it is named differently than the BAM file (default: None).
         filename (str | :py:obj:`file`): synonym for `filepath_or_object`
         check_header (bool): Obsolete method maintained for backwards compatibility (default: False)
         check_sq (bool): Inspect BAM file for `@SQ` entries within the header
@@ -154,13 +537,25 @@ class AlignmentFile(bgzf.BgzfReader, bgzf.BgzfWriter):
         require_index (bool): require the presence of an index file or raise (default: False)
         duplicate_filehandle (bool): Not implemented. Raises warning if True.
         ignore_truncation (bool): Whether or not to allow trucated file processing (default: False).
+        threads (int): number of threads used to inflate upcoming BGZF blocks ahead of the \
+            cursor. A value of 1 disables read-ahead (default: 1).
+        mmap (bool): memory-map the BAM file and inflate blocks straight out of the mapping \
+            instead of issuing a `seek` and `read` for every block (default: False).
+        cache_bytes (int): upper bound on the decompressed bytes held by the block cache, \
+            in addition to `max_cache` (default: None, bounded by `max_cache` only).
+        lazy (bool): only decode the sequence, qualities, tags, and CIGAR-derived attributes \
+            of reads the first time they are used (default: False).
+        fields (:py:obj:`tuple` of :py:obj:`str`): if given, iteration and `fetch` yield named \
+            tuples of only these fields (see :py:class:`bamnostic.core.Projection`) \
+            instead of :py:class:`AlignedSegment` objects (default: None).
 
     """
 
     def __init__(self, filepath_or_object, mode="rb", max_cache=128, index_filename=None,
                  filename=None, check_header=False, check_sq=True, reference_filename=None,
                  filepath_index=None, require_index=False, duplicate_filehandle=None,
-                 ignore_truncation=False):
+                 ignore_truncation=False, threads=1, mmap=False, cache_bytes=None, lazy=False,
+                 fields=None):
         """Initialize the class.
 
 
@@ -181,48 +576,215 @@ class AlignmentFile(bgzf.BgzfReader, bgzf.BgzfWriter):
         else:
             bgzf.BgzfReader.__init__(self, **kwargs)
 
+    def to_sam(self, out, region=None, header=True, buffer_size=10000):
+        """Writes reads as SAM text
+
+        Reads are rendered straight from their raw records, so no
+        :py:class:`AlignedSegment` is built, and the lines are written out
+        `buffer_size` reads at a time.
+
+        Args:
+            out (str | :py:obj:`file`): path of the SAM file to create, or a text file object
+            region (str): SAM-formatted region (e.g. 'chr1:100-200') of the reads to write. If None, \
+                all the reads of the file are written (default: None).
+            header (bool): write the SAM header first (default: True).
+            buffer_size (int): number of lines to gather before each write (default: 10000).
+
+        Returns:
+            (int): number of reads written
+
+        Example:
+            >>> import io
+            >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb')
+            >>> out = io.StringIO()
+            >>> bam.to_sam(out, region='chr1:100-120', header=False)
+            8
+            >>> print(out.getvalue().split('\\n')[0]) # doctest: +NORMALIZE_WHITESPACE
+            EAS51_64:3:190:727:308	99	chr1	103	99	35M	=	263	195	GGTGCAGAGCCGAGTCACGGGGTTGCCAGCACAGG
+                <<<<<<<<<<<<<<<<<<<<<<<<<<<::<<<844	MF:i:18	Aq:i:73	NM:i:0	UQ:i:0	H0:i:1	H1:i:0
+
+        """
+        if isinstance(out, str):
+            with open(out, 'w') as handle:
+                return self.to_sam(handle, region=region, header=header, buffer_size=buffer_size)
+
+        names = dict((tid, ref[0]) for tid, ref in self._header.refs.items())
+        names[-1] = '*'
+
+        if header:
+            if self._header._SAMheader_raw:
+                text = self._header._SAMheader_raw.decode().rstrip('\x00').rstrip('\n')
+            else:
+                text = '\n'.join(['@SQ\tSN:{}\tLN:{}'.format(*self._header.refs[tid])
+                                  for tid in range(self._header.n_refs)])
+            if text:
+                out.write(text + '\n')
+
+        if region is None:
+            if not self._stream:
+                self.seek(self._header._BAMheader_end)
+            records = self.iter_raw()
+        else:
+            if not self._random_access:
+                raise ValueError('Random access not available due to lack of index file')
+            records = self._fetch_raw(self._resolve_region(region=region))
+
+        n_reads = 0
+        lines = []
+        for voffset, raw in records:
+            lines.append(_raw_sam_line(raw, names))
+            if len(lines) == buffer_size:
+                lines.append('')
+                out.write('\n'.join(lines))
+                n_reads += buffer_size
+                lines = []
+        if lines:
+            lines.append('')
+            out.write('\n'.join(lines))
+            n_reads += len(lines) - 1
+        return n_reads
+
+
+# Headers of the files opened in this process, keyed by a digest of their
+# reference names and lengths. Pickled reads only carry the key.
+_HEADERS = {}
+
+
+def register_header(header):
+    """Make a BAM header available to reads unpickled in this process
+
+    Every :py:class:`bamnostic.AlignmentFile` registers its header when it
+    is opened, so a worker process only needs to open the same file (or
+    one with the same references) to resolve the reference names of the
+    reads it receives.
+
+    Args:
+        header (:py:class:`bamnostic.bgzf.BAMheader`): parsed BAM header
+
+    Returns:
+        (str): key of the header, a digest of its reference names and lengths
+
+    Example:
+        >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb')
+        >>> register_header(bam._header) == bam._refs_key
+        True
+
+    """
+    digest = hashlib.sha1()
+    for tid in range(header.n_refs):
+        digest.update('{}\t{}\n'.format(*header.refs[tid]).encode())
+    key = digest.hexdigest()[:16]
+    _HEADERS[key] = header
+    return key
+
+
+class _DetachedReader(object):
+    """(PRIVATE) Stand-in for the reader of an unpickled read
+
+    Provides the few reader attributes that a read uses, looking the header up
+    in the registry only when it is needed.
+    """
+    __slots__ = ('_refs_key',)
+    _lazy = True
+
+    def __init__(self, refs_key):
+        self._refs_key = refs_key
+
+    @property
+    def _header(self):
+        try:
+            return _HEADERS[self._refs_key]
+        except KeyError:
+            raise KeyError('No header registered for references {}: open the BAM file in this '
+                           'process first'.format(self._refs_key))
+
+    def get_reference_name(self, tid):
+        return self._header.refs[tid][0]
+
+
+def _unpickle_segment(refs_key, raw):
+    """(PRIVATE) Rebuild a pickled read. Its fields are decoded on first access."""
+    return AlignedSegment(_DetachedReader(refs_key), lazy=True, raw=raw)
+
 
 class AlignedSegment(object):
-    """Main class for handling reads within the BAM"""
+    """Main class for handling reads within the BAM
 
-    def __init__(self, _io):
+    Reads are compact: each one keeps its own copy of the raw record bytes, the
+    fixed-size fields, and the CIGAR operations. Everything else (the CIGAR
+    string and tuples, the reference and query alignment coordinates, ...) is
+    derived from these on demand. The decoded sequence, qualities, and tags (and
+    for lazy reads, the CIGAR operations) are cached once they have been built.
+    """
+    __slots__ = ('_io', '_raw_stream', 'refID', 'pos', 'bin', 'mapq', 'flag', 'l_seq',
+                 'next_refID', 'next_pos', 'tlen', 'read_name', '_cigar_offset', '_seq_offset',
+                 '_qual_offset', '_tag_offset', '_cigar', '_seq', '_qual', '_query_qualities', '_tags')
+
+    def __init__(self, _io, lazy=None, raw=None):
         """Instantiating the read parser just needs access to the BGZF io.object
 
+        The fixed-size fields of the read (position, flag, MAPQ, etc.) and the read
+        name are always unpacked. Lazy reads keep the raw bytes of the CIGAR,
+        sequence, qualities, and tags, and only decode them the first time they
+        are used.
+
         Args:
             io (BgzfReader): parser for processing BGZF files
+            lazy (None|bool): decode variable-length data on first access. If None, \
+                the setting of the reader is used (default: None).
+            raw (:py:obj:`memoryview`): raw bytes of an already read record, including its \
+                `block_size` prefix. If None, the next record is read from `io` (default: None).
 
         Returns:
             AlignedRead
 
         """
         self._io = _io
-        bsize_buffer = self._io.read(4)
-        try:
-            block_size = unpack_int32(bsize_buffer)[0]
-        
-        # Check for EOF: If the cursor is at the end of file, read() will return 
-        # an empty byte string. If 
-        except struct.error:
-            if all([not bsize_buffer, not self._io._handle.read()]):
+
+        if raw is None:
+            # Check for EOF: the raw record reader returns None once the
+            # EOF marker block has been reached
+            record = self._io._read_raw_record()
+            if record is None:
                 if not self._io._igore_truncation and not self._io._truncated:
                     raise StopIteration('End of file reached')
                 else:
                     raise StopIteration('Potential end of file reached')
-            else:
-                raise IOError('Reached End of file, but marker does not match BAM standard')
+            raw = record[1]
 
-        # Pull in the whole read
-        self._byte_stream = bytearray(self._io.read(block_size))
+        self._load(raw, lazy)
 
-        # Preserve the raw data for writing purposes
-        self._raw_stream = self._byte_stream[:]
-        self._raw_stream[0:0] = struct.pack('i', block_size)
-        """Used to copy the entire read's byte stream for writing purposes"""
+    def _load(self, raw, lazy=None, copy=True):
+        """(PRIVATE) (Re)populate the read from the raw bytes of a record
 
-        # Unpack all the necessary data for the read from the bytestream
+        Every field of the read is overwritten, which lets a single object be
+        reused for consecutive records (see `BgzfReader.scan`).
+
+        Args:
+            raw (:py:obj:`memoryview`): raw bytes of the record, including its `block_size` prefix
+            lazy (None|bool): decode variable-length data on first access. If None, \
+                the setting of the reader is used (default: None).
+            copy (bool): copy the raw bytes out of `raw`. Reused reads do not, since they \
+                are overwritten by the next record anyway (default: True).
+
+        """
+        # The entire read's byte stream (block_size prefix included), kept for writing
+        # purposes and as the source of all the decoded data. It is copied out of the
+        # decompressed BGZF block, so that reads kept around do not hold on to whole blocks.
+        self._raw_stream = raw.tobytes() if copy and isinstance(raw, memoryview) else raw
+
+        # Unpack all the necessary data for the read from the bytestream. This
+        # also sets the cursors to the start of each variable-length section.
         self._unpack_data()
 
-        # Pull out CIGAR information and build string & tuple representation
+        self._cigar = self._seq = self._qual = self._query_qualities = self._tags = None
+
+        if lazy is None:
+            lazy = getattr(self._io, '_lazy', False)
+        if lazy:
+            return
+
+        # Pull out the CIGAR operations: accounts for CIGAR strings > 65535 operations
         self._cigar_builder()
 
         # pull out the sequence information and build string representation
@@ -233,17 +795,24 @@ class AlignedSegment(object):
 
         # Iteratively pull out the tags for the given aligned segment
         self._tag_builder()
-        
-        # Process the CIGAR: accounts for CIGAR strings > 65535 operations
-        self._decode_cigar()
 
-        # Compute the data regarding the sequence that aligns to reference
-        # This excludes insertions and clipping
-        self._reference_attrs()
+    def __reduce__(self):
+        """Pickle the read as its raw bytes and the key of its header
 
-        # Compute the data regarding the sequence that aligns
-        # This excludes clipping, but includes insertions
-        self._query_alignment_attrs()
+        The reader the read came from is not pickled. Unpickled reads are
+        lazy, and look their reference names up in the headers registered
+        in the receiving process (see `register_header`).
+
+        Example:
+            >>> import pickle
+            >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb')
+            >>> read = next(bam)
+            >>> copy = pickle.loads(pickle.dumps(read))
+            >>> repr(copy) == repr(read), copy.reference_name # doctest: +ALLOW_UNICODE
+            (True, 'chr1')
+
+        """
+        return _unpickle_segment, (self._io._refs_key, self._raw_bytes(0))
 
     def _unpack_data(self):
         """ Unpack the data for the associated read from the BAM file
@@ -260,101 +829,137 @@ class AlignedSegment(object):
             next_pos (int): 0-based leftmost position of the next segment.
             tlen (int): Template length
             read_name (str): Read name identifier for current read
-            tid (int): synonym for refID
-            reference_name (str): name of associated reference
-            reference_length (int): length of associated reference sequence
         """
-        self.refID, self.pos = _unpack_refId_pos(self._range_popper(8))
+        (self.refID, self.pos, bin_mq_nl, flag_nc,
+         self.l_seq, self.next_refID, self.next_pos, self.tlen) = _unpack_core_from(self._raw_stream, 4)
 
-        # get refID chromosome names
-        self._bin_mq_nl, self._flag_nc = _unpack_bmq_flag(self._range_popper(8))
-        self.bin = self._bin_mq_nl >> 16
-        self.mapq = (self._bin_mq_nl & 0xFF00) >> 8
-        self._l_read_name = self._bin_mq_nl & 0xFF
+        self.bin = bin_mq_nl >> 16
+        self.mapq = (bin_mq_nl & 0xFF00) >> 8
+        self.flag = flag_nc >> 16
 
-        # Alternative to masking
-        # self.mapq = (self.bin_mq_nl ^ self.bin << 16) >> 8
-        # self._l_read_name = (self.bin_mq_nl ^ self.bin <<16) ^ (self.mapq << 8)
+        # Starting offsets of the variable-length sections of the read
+        self._cigar_offset = _CORE_SIZE + (bin_mq_nl & 0xFF)
+        self._seq_offset = self._cigar_offset + 4 * (flag_nc & 0xFFFF)
+        self._qual_offset = self._seq_offset + (self.l_seq + 1) // 2
+        self._tag_offset = self._qual_offset + self.l_seq
 
-        self.flag = self._flag_nc >> 16
-        self._n_cigar_op = self._flag_nc & 0xFFFF
-        self.l_seq, self.next_refID, self.next_pos, self.tlen = _unpack_lseq_nrid_npos_tlen(self._range_popper(16))
+        self.read_name = self._raw_bytes(_CORE_SIZE, self._cigar_offset - 1).decode()
 
-        self.read_name = unpack('<{}s'.format(self._l_read_name), self._range_popper(self._l_read_name)).decode()[:-1]
+    def _cigar_builder(self):
+        """Unpacks the BAM-encoded CIGAR operations (`length << 4 | op`)
 
-        self.tid = self.reference_id = self.refID
-        self.reference_name = self._io._header.refs[self.refID][0]
+        If the CIGAR has more than 65535 operations, it is stored in the CG tag,
+        with a placeholder in the CIGAR field. In that case, the CG tag is used.
+        """
+        n_cigar_op = (self._seq_offset - self._cigar_offset) // 4
+        self._cigar = struct.unpack_from('<{}I'.format(n_cigar_op), self._raw_stream, self._cigar_offset)
+        if n_cigar_op and self._cigar[0] == self.l_seq << 4 | 4:
+            cg = _scan_tag(self._raw_bytes(self._tag_offset), 'CG')
+            if cg is not None:
+                self._cigar = cg[1]
 
-    def _cigar_builder(self):
-        """Just unpacks the cigar data to be processed later. Ensures the cursor
-        stays in the right place."""
-        if self._n_cigar_op != 0:
-            self._cigar = struct.unpack('<{}I'.format(self._n_cigar_op), self._range_popper(4 * self._n_cigar_op))
+    @property
+    def _cigar_ops(self):
+        """BAM-encoded CIGAR operations (`length << 4 | op`), unpacked on first use by lazy reads"""
+        if self._cigar is None:
+            self._cigar_builder()
+        return self._cigar
 
-    def _decode_cigar(self):
-        """Process the CIGAR into helpful tuples and plain text CIGAR string
-        Uses unpacked values to properly process the CIGAR related data
+    def _raw_bytes(self, start, end=None):
+        """(PRIVATE) A section of the raw record as bytes, whether the record is held as bytes or as a view"""
+        section = self._raw_stream[start:end]
+        return section if isinstance(section, bytes) else section.tobytes()
 
-        Requires determining string size and key mapping to _CIGAR_KEY
+    @property
+    def tid(self):
+        """Synonym for `refID`"""
+        return self.refID
 
-        Attributes:
-            cigarstring (str): SAM format string representation of the CIGAR string
-            cigartuples (:py:obj:`list` of :py:obj:`tuple` of :py:obj:`int`): CIGAR op code and associated value
-            _cigartuples (:py:obj:`list` of :py:obj:`namedtuple`): same as `cigartuples` except
-                                    each tuple is a named tuple for mainatainability &
-                                    readability. Additionally, preserves the CIGAR op name.
-
-        """
-        # can't use bamnostic.utils.unpack because self._cigar needs to be tuples for decoding
-        if self._n_cigar_op != 0:
-            if 'CG' in self.tags and self._cigar[0] == self.l_seq << 4 | 4:
-               self._cigar = self.tags.pop('CG')[1]
-               self._n_cigar_op = len(self._cigar)
-            decoded_cigar = [(cigar_op >> 4, _CIGAR_KEY[cigar_op & 0xF]) for cigar_op in self._cigar]
-            self.cigarstring = "".join(['{}{}'.format(c[0], c[1]) for c in decoded_cigar])
-            self._cigartuples = [Cigar(bamnostic.utils._CIGAR_OPS[op[1]][1], op[0], op[1], bamnostic.utils._CIGAR_OPS[op[1]][0]) for op in decoded_cigar]
-            self.cigartuples = [(op[0], op[1]) for op in self._cigartuples]
-            self.cigar = self.cigartuples[:]
-        else:
-            self.cigar = None
-            self.cigarstring = None
-            self._cigartuples = None
-            self.cigartuples = None
+    @property
+    def reference_id(self):
+        """Synonym for `refID`"""
+        return self.refID
+
+    @property
+    def reference_name(self):
+        """Name of the reference the read is aligned to"""
+        return self._io._header.refs[self.refID][0]
+
+    @property
+    def cigarstring(self):
+        """SAM format string representation of the CIGAR string, or None if the read has no CIGAR"""
+        if not self._cigar_ops:
+            return None
+        return ''.join(['{}{}'.format(op >> 4, _CIGAR_KEY[op & 0xF]) for op in self._cigar_ops])
+
+    @property
+    def cigartuples(self):
+        """CIGAR op codes and associated lengths, or None if the read has no CIGAR
+
+        Returns:
+            (:py:obj:`list` of :py:obj:`tuple` of :py:obj:`int`): (op code, length) of each operation
+        """
+        if not self._cigar_ops:
+            return None
+        return [(op & 0xF, op >> 4) for op in self._cigar_ops]
+
+    @property
+    def cigar(self):
+        """Synonym for `cigartuples`"""
+        return self.cigartuples
+
+    @property
+    def _cigartuples(self):
+        """Same as `cigartuples` except each tuple is a :py:obj:`Cigar` named tuple for
+        maintainability & readability. Additionally, preserves the CIGAR op name.
+        """
+        if not self._cigar_ops:
+            return None
+        return [Cigar(op & 0xF, op >> 4, _CIGAR_KEY[op & 0xF], bamnostic.utils._CIGAR_OPS[_CIGAR_KEY[op & 0xF]][0])
+                for op in self._cigar_ops]
 
     def _seq_builder(self):
         """Uses unpacked values to build segment sequence
 
         Requires knowing the sequence length and key mapping to _SEQ_KEY
-
-        Attributes:
-            seq (str): alignment sequence in string format
         """
-        self._byte_seq = unpack('<{}B'.format((self.l_seq + 1) // 2), self._range_popper(1 * ((self.l_seq + 1) // 2)))
-        self.seq = "".join([
-            '{}{}'.format(
-                _SEQ_KEY[self._byte_seq[s] >> 4],
-                _SEQ_KEY[self._byte_seq[s] & 0x0F])
-            for s in range(len(self._byte_seq))])[:self.l_seq]
+        packed = bytearray(self._raw_stream[self._seq_offset:self._qual_offset])
+        self._seq = ''.join(map(_SEQ_PAIRS.__getitem__, packed))[:self.l_seq]
 
-    def _qual_builder(self):
-        """Pulls out the quality information for the given read
+    @property
+    def seq(self):
+        """Alignment sequence in string format"""
+        if self._seq is None:
+            self._seq_builder()
+        return self._seq
 
-        Attributes:
-            query_qualities (:py:obj:`array.array`): Array of Phred quality scores for each base
-                              
-                              of the aligned sequence. No offset required.
-            qual (str): ASCII-encoded quality string
-        """
-        self._raw_qual = unpack('<{}s'.format(self.l_seq), self._range_popper(self.l_seq))
+    def _qual_builder(self):
+        """Pulls out the quality information for the given read"""
+        raw_qual = self._raw_bytes(self._qual_offset, self._tag_offset)
+        self._query_qualities = CompatibleArray('B')
+        self._query_qualities.fromstring(raw_qual)
+
+        # A first byte of 0xFF means the qualities were not stored (SAM '*')
+        if raw_qual[:1] == b'\xff':
+            self._qual = '*'
+        else:
+            self._qual = raw_qual.translate(_QUAL_TABLE).decode('latin_1')
 
-        self.query_qualities = CompatibleArray('B')
-        self.query_qualities.fromstring(self._raw_qual)
-        """Phred Quality scores for each base of the alignment
-        ***without*** an ASCII offset."""
+    @property
+    def qual(self):
+        """Phred Quality scores for each base of the alignment in ASCII offsetted
+        string format, or '*' if the qualities are missing"""
+        if self._qual is None:
+            self._qual_builder()
+        return self._qual
 
-        self.qual = ''.join(offset_qual(self._raw_qual))
-        """Phred Quality scores for each base of the alignment
-        in ASCII offsetted string format."""
+    @property
+    def query_qualities(self):
+        """Phred Quality scores for each base of the alignment ***without*** an
+        ASCII offset (:py:obj:`array.array`)"""
+        if self._query_qualities is None:
+            self._qual_builder()
+        return self._query_qualities
 
     def __hash_key(self):
         return (self.reference_name, self.pos, self.read_name)
@@ -371,14 +976,24 @@ class AlignedSegment(object):
         return not self.__eq__(other)
 
     def _tag_builder(self):
-        """Uses `self._tagger()` to collect all the read tags
+        """Uses `_parse_tag()` to collect all the read tags"""
+        tags = {}
+        tag_block = self._raw_bytes(self._tag_offset)
+        cursor = 0
+        while cursor < len(tag_block):
+            tag, value, cursor = _parse_tag(tag_block, cursor)
+            tags[tag] = value
+        # A CG tag that holds the actual CIGAR is not reported as a tag
+        if 'CG' in tags and len(self._cigar_ops) * 4 != self._seq_offset - self._cigar_offset:
+            del tags['CG']
+        self._tags = tags
 
-        Attributes:
-            tags (:py:obj:`dict`): all tags, tag type, and tag value for associated read
-        """
-        self.tags = {}
-        while len(self._byte_stream) > 0:
-            self.tags.update(self._tagger())
+    @property
+    def tags(self):
+        """All tags, tag type, and tag value for associated read (:py:obj:`dict`)"""
+        if self._tags is None:
+            self._tag_builder()
+        return self._tags
 
     def __repr__(self):
         """Represent the read when the object is called.
@@ -413,146 +1028,79 @@ class AlignedSegment(object):
     def __str__(self):
         return self.__repr__()
 
-    def _range_popper(self, interval_start, interval_stop=None, front=True):
-        """Simple pop method that accepts a range instead of a single value. Modifies the original bytearray by removing items
+    def _query_alignment_bounds(self):
+        """Computes the start and end of the alignable portion of the read
 
-        Note:
-            Pops from the front of the list by default. If `front` is set to `False`, it
-            will pop everything from `interval_start` to the end of the list.
-
-        Args:
-            interval_start (int): desired number of bytes from the beginning to be decoded.
-            interval_stop (int): if present, allows for a specific range (default: None).
-            front (bool): True if popping from front of list (default: True).
+        Query alignment here means the alignable portion of the read,
+        and therefore excludes clipping, but includes insertions. Since soft
+        clips can only be found at either end of the CIGAR (hard clips aside),
+        the aligned portion is a single slice of the read.
 
         Returns:
-            popped (bytearray): removed interval-length items from `self.byte_stream`
-
+            (:py:obj:`tuple`): start and end indices of the aligned portion within the read sequence
         """
-        if interval_stop is None:
-            if front:
-                popped = self._byte_stream[:interval_start]
-                del self._byte_stream[:interval_start]
-                return popped
-            else:
-                popped = self._byte_stream[interval_start:]
-                del self._byte_stream[interval_start:]
-                return popped
-        else:
-            popped = self._byte_stream[interval_start:interval_stop]
-            del self._byte_stream[interval_start:interval_stop]
-            return popped
-
-    def _tagger(self):
-        """Processes the variety of tags that accompany sequencing reads
-
-        The BAM format does not store the length of string and hex-formatted byte
-        arrays. These are null-terminated. Due to this, when parsing the byte stream,
-        this method has to dynamically read in the next byte and check for a null.
-        In all other cases, a simple `read` is used to pull all pertinent data for the tag.
-
-        The final caveat is that the number of tags is not stored. Therefore, the method
-        also has to constantly analyze the remaining byte stream of the associated
-        aligned segment to ensure that all tags are serially parsed.
+        qa_start = 0
+        for op in self._cigar_ops:
+            if op & 0xF == 4:
+                qa_start += op >> 4
+            elif op & 0xF != 5:
+                break
+        qa_end = self.l_seq
+        for op in reversed(self._cigar_ops):
+            if op & 0xF == 4:
+                qa_end -= op >> 4
+            elif op & 0xF != 5:
+                break
+        return qa_start, qa_end
+
+    def get_blocks(self):
+        """Gets the gapless blocks of the read that are aligned to the reference
+
+        Deletions and skipped regions (`D` and `N`) start a new block, while
+        insertions and clipping do not take up any reference positions.
 
         Returns:
-            dictionary of the tag, value types, and values
-        """
-        types = {"A": 'c', "i": 'l', "f": 'f', "Z": 's', "H": 's', "c": 'b',
-                 "C": 'B', "s": 'h', "S": 'H', "i": 'i', "I": 'I'}
-
-        tag, val_type = _unpack_tag_val(self._range_popper(3))
-        tag = tag.decode()
-        val_type = val_type.decode()
-
-        # Capture byte array of a given size
-        if val_type == "B":
-            arr_type, arr_size = _unpack_array(self._range_popper(5))
-            arr = unpack('<{}{}'.format(arr_size, types[arr_type.decode()]),
-                         self._range_popper(arr_size * struct.calcsize(types[arr_type.decode()])))
-            return {tag: (val_type, arr)}
-
-        # Capture given length string or hex array
-        elif val_type == "Z" or val_type == "H":
-            val = _unpack_string(self._range_popper(1))[0]
-            if _PY_VERSION.startswith('2'):
-                while val[-1] != '\x00':
-                    val += _unpack_string(self._range_popper(1))[0]
-            else:
-                while chr(val[-1]) != '\x00':
-                    val += _unpack_string(self._range_popper(1))[0]
-            if val_type == "Z":
-                return {tag: (val_type, val.decode(encoding="latin_1")[:-1])}
-            else:
-                return {tag: (val_type, val.hex().upper())}
-
-        # Everything else
-        else:
-            val_size = struct.calcsize(types[val_type])
-            val = unpack('<' + types[val_type], self._range_popper(val_size))
-            if val_type == "A":
-                val = val.decode(encoding='latin_1')
-            return {tag: (val_type, val)}
-
-    def _reference_attrs(self):
-        """Sets and computes the attributes regarding reference alignment
-
-        Reference alignment here means the alignment of the read according to
-        the reference, and therefore excludes insertions and clipping.
-        """
-        count = 0
-        if self.cigarstring is not None:
-            cigar_align = cigar_alignment(self.seq, self.cigar, self.pos, self.query_qualities)
-            first_ref = next(cigar_align)
-            for base, index in cigar_align:
-                count += 1
-            self.__reference_start = self.pos
-            self.__reference_end = index + 1
-            self.__reference_length = self.__reference_end - self.__reference_start
-        else:
-            self.__reference_start = self.pos
-            self.__reference_end = None
-            self.__reference_length = None
+            (:py:obj:`list` of :py:obj:`tuple`): 0-based, half-open (start, end) reference \
+                coordinates of each aligned block, or an empty list if the read has no CIGAR
 
-    def _query_alignment_attrs(self):
-        """Sets and computes the attributes regarding query alignment
+        Example:
+            >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb')
+            >>> read = next(read for read in bam if read.cigarstring == '9M1D26M')
+            >>> read.reference_start, read.get_blocks()
+            (431, [(431, 440), (441, 467)])
 
-        Query alignment here means the alignable portion of the read,
-        and therefore excludes clipping, but includes insertions
-        """
-        count = 0
-        if self.cigarstring is not None:
-            cigar_align = cigar_alignment(self.seq, self.cigar, self.pos, self.query_qualities, query=True)
-            self.__qa_seq = ""
-            first_ref = next(cigar_align)
-            self.__qa_seq += first_ref[0]
-            for base, index in cigar_align:
-                self.__qa_seq += base
-                count += 1
-            self.__qa_end = index + 1
-            self.__qa_start = first_ref[1]
-        else:
-            self.__qa_seq = None
-            self.__qa_end = None
-            self.__qa_start = self.pos
+        """
+        blocks = []
+        pos = self.pos
+        for op in self._cigar_ops:
+            op_code, n_op = op & 0xF, op >> 4
+            if op_code in _MATCH_OPS:
+                blocks.append((pos, pos + n_op))
+                pos += n_op
+            elif op_code in _REF_CONSUMING_OPS:
+                pos += n_op
+        return blocks
 
     @property
     def query_alignment_end(self):
         """One past the final index position of the aligned portion of the read
 
         `query_alignment_*` all refer to the portion of the read that was aligned,
-        and therefore exclude clipping, but include insertions.
+        and therefore exclude clipping, but include insertions. Indices are
+        relative to the read sequence (`query_sequence`).
         """
-        return self.self.__qa_end
+        return self._query_alignment_bounds()[1] if self._cigar_ops else None
 
     @property
     def query_alignment_start(self):
         """The starting index of the aligned portion of the read
 
         `query_alignment_*` all refer to the portion of the read that was aligned,
-        and therefore exclude clipping, but include insertions.
+        and therefore exclude clipping, but include insertions. Indices are
+        relative to the read sequence (`query_sequence`), so this is the length
+        of the leading soft clip.
         """
-        return self.__qa_start
+        return self._query_alignment_bounds()[0] if self._cigar_ops else None
 
     @property
     def query_name(self):
@@ -566,7 +1114,10 @@ class AlignedSegment(object):
         `query_alignment_*` all refer to the portion of the read that was aligned,
         and therefore exclude clipping, but include insertions.
         """
-        return self.__qa_seq
+        if not self._cigar_ops:
+            return None
+        qa_start, qa_end = self._query_alignment_bounds()
+        return self.seq[qa_start:qa_end]
 
     @property
     def query_alignment_length(self):
@@ -575,7 +1126,11 @@ class AlignedSegment(object):
         `query_alignment_*` all refer to the portion of the read that was aligned,
         and therefore exclude clipping, but include insertions.
         """
-        return len(self.query_alignment_sequence) if self.cigar is not None else None
+        if not self._cigar_ops:
+            return None
+        qa_start, qa_end = self._query_alignment_bounds()
+        # Reads without a stored sequence have no aligned bases either
+        return max(qa_end - qa_start, 0)
 
     @property
     def reference_start(self):
@@ -585,7 +1140,7 @@ class AlignedSegment(object):
         according to the reference. Therefore, does not include insertions
         and clipping
         """
-        return self.__reference_start
+        return self.pos
 
     @property
     def reference_end(self):
@@ -595,7 +1150,8 @@ class AlignedSegment(object):
         according to the reference. Therefore, does not include insertions
         and clipping
         """
-        return self.__reference_end
+        length = self.reference_length
+        return None if length is None else self.pos + length
 
     @property
     def reference_length(self):
@@ -603,9 +1159,12 @@ class AlignedSegment(object):
 
         `reference_` here means the portion of the read that was aligned
         according to the reference. Therefore, does not include insertions
-        and clipping
+        and clipping. It is the sum of the lengths of the reference-consuming
+        CIGAR operations.
         """
-        return self.__reference_length
+        if not self._cigar_ops:
+            return None
+        return sum(op >> 4 for op in self._cigar_ops if op & 0xF in _REF_CONSUMING_OPS)
 
     @property
     def query_sequence(self):
@@ -623,7 +1182,7 @@ class AlignedSegment(object):
         `query_` here means the query as seen in the BAM file, and therefore
         includes clipping
         """
-        return len(self.seq)
+        return self.l_seq
 
     @property
     def next_reference_id(self):
@@ -741,18 +1300,28 @@ class AlignedSegment(object):
             tag (str): the tag of interest
             with_value_type (bool): return what kind of value the tag
 
+        Note:
+            If the tags of the read have not been decoded yet (see `lazy` in
+            `AlignmentFile`), only the requested tag is decoded from the raw data.
+
         Returns:
             the value associated with a given tag or the value and type
             of value (as seen in BAM format)
+
+        Raises:
+            KeyError: if the read does not have the tag
         """
-        try:
-            t = self.tags[tag]
-            if with_value_type:
-                return t[::-1]
-            else:
-                return t[1]
-        except KeyError:
+        # A CG tag may hold the actual CIGAR, so let `tags` handle it
+        if self._tags is not None or tag == 'CG':
+            t = self.tags.get(tag)
+        else:
+            t = _scan_tag(self._raw_bytes(self._tag_offset), tag)
+        if t is None:
             raise KeyError('Read does not have the {} tag'.format(tag))
+        if with_value_type:
+            return t[::-1]
+        else:
+            return t[1]
 
     def get_tags(self, with_value_type=False):
         """Returns all the tags for a given read
@@ -814,3 +1383,193 @@ class AlignedSegment(object):
             KeyError: if read does not contain MD tag
         """
         return ref_gen(self.seq, self.cigar, self.tags['MD'])
+
+
+# Fixed-size columns of a RecordBatch and the `array` typecodes they are stored as
+_BATCH_COLUMNS = (('refID', 'i'), ('pos', 'i'), ('mapq', 'B'), ('flag', 'H'), ('l_seq', 'i'),
+                  ('next_refID', 'i'), ('next_pos', 'i'), ('tlen', 'i'), ('end', 'i'))
+
+# Variable-length fields of a RecordBatch, stored as one buffer per batch plus offsets
+_BATCH_BUFFERS = ('read_name', 'cigar', 'seq', 'qual', 'tags')
+
+
+class RecordBatch(object):
+    """Columnar (struct-of-arrays) representation of a batch of reads
+
+    Rather than one :py:class:`AlignedSegment` per read, a batch holds one array
+    per field, decoded straight from the raw BAM records. Fixed-size fields are
+    stored as :py:obj:`array.array`, or as NumPy arrays if NumPy is installed:
+
+        * `refID`, `pos`, `l_seq`, `next_refID`, `next_pos`, `tlen` (int32)
+        * `mapq` (uint8) and `flag` (uint16)
+        * `end` (int32): one past the last reference position aligned, or -1 if the read has no CIGAR
+
+    Variable-length fields are stored as a `(buffer, offsets)` pair, where the
+    value of read `i` is `buffer[offsets[i]:offsets[i + 1]]`:
+
+        * `read_name` (bytes): read names, without their null terminators
+        * `cigar` (:py:obj:`array.array` of uint32): BAM-encoded CIGAR operations (`length << 4 | op`)
+        * `seq` (bytes): ASCII-decoded sequences
+        * `qual` (bytes): Phred quality scores, **without** the ASCII offset
+        * `tags` (bytes): the raw, BAM-encoded tag data
+
+    Example:
+        >>> bam = bamnostic.AlignmentFile(bamnostic.example_bam, 'rb')
+        >>> batch = next(bam.fetch_batches('chr1', 100, 120, fields=['pos', 'mapq', 'read_name'], numpy=False))
+        >>> len(batch), list(batch['pos'][:3]), list(batch['mapq'][:3])
+        (8, [102, 109, 111], [99, 99, 99])
+        >>> batch.value('read_name', 0)
+        'EAS51_64:3:190:727:308'
+
+    """
+
+    def __init__(self, columns, size):
+        """Wrap already decoded columns. See `RecordBatch.from_records` for building a batch.
+
+        Args:
+            columns (:py:obj:`dict`): arrays of fixed-size fields and (buffer, offsets) \
+                pairs of variable-length fields, keyed by field name
+            size (int): number of reads in the batch
+        """
+        self.columns = columns
+        self._size = size
+
+    @classmethod
+    def from_records(cls, records, fields=None, numpy=None):
+        """Decode the requested fields of raw BAM records into a batch
+
+        Args:
+            records (iterable): raw records, including their 4-byte `block_size` prefix \
+                (as yielded by `BgzfReader.iter_raw`)
+            fields (:py:obj:`list` of :py:obj:`str`): names of the fields to decode \
+                (default: None, all the fixed-size fields)
+            numpy (None|bool): store the columns as NumPy arrays. If None, NumPy is \
+                used when it is installed (default: None).
+
+        Returns:
+            (:py:class:`RecordBatch`): the decoded batch
+
+        Raises:
+            ValueError: if a field is not known
+            ImportError: if `numpy` is True and NumPy is not installed
+        """
+        if fields is None:
+            fields = [name for name, typecode in _BATCH_COLUMNS]
+        unknown = set(fields).difference(name for name, typecode in _BATCH_COLUMNS).difference(_BATCH_BUFFERS)
+        if unknown:
+            raise ValueError('Unknown RecordBatch fields: {}'.format(', '.join(sorted(unknown))))
+        if numpy is None:
+            numpy = _np is not None
+        elif numpy and _np is None:
+            raise ImportError('NumPy is not installed')
+
+        # Columns are filled by position in the tuple of unpacked values below
+        fixed = [(index, name, array(typecode)) for index, (name, typecode) in enumerate(_BATCH_COLUMNS)
+                 if name in fields and name != 'end']
+        want_end = 'end' in fields
+        end_column = array('i')
+        want_cigar = want_end or 'cigar' in fields
+        chunks = dict((name, []) for name in _BATCH_BUFFERS if name in fields)
+        offsets = dict((name, array(U64_TYPECODE, [0])) for name in chunks)
+        cigar_column = array('I')
+
+        size = 0
+        for raw in records:
+            size += 1
+            (ref_id, pos, bin_mq_nl, flag_nc, l_seq,
+             next_ref_id, next_pos, tlen) = _unpack_core_from(raw, 4)
+            l_read_name = bin_mq_nl & 0xFF
+            n_cigar_op = flag_nc & 0xFFFF
+            row = (ref_id, pos, (bin_mq_nl >> 8) & 0xFF, flag_nc >> 16, l_seq, next_ref_id, next_pos, tlen)
+            for index, name, column in fixed:
+                column.append(row[index])
+
+            cigar_offset = _CORE_SIZE + l_read_name
+            seq_offset = cigar_offset + 4 * n_cigar_op
+            qual_offset = seq_offset + (l_seq + 1) // 2
+            tag_offset = qual_offset + l_seq
+
+            if want_cigar:
+                cigar = _raw_cigar(raw)
+                if want_end:
+                    if cigar:
+                        end_column.append(pos + sum(op >> 4 for op in cigar if op & 0xF in _REF_CONSUMING_OPS))
+                    else:
+                        end_column.append(-1)
+                if 'cigar' in chunks:
+                    cigar_column.extend(cigar)
+                    offsets['cigar'].append(len(cigar_column))
+            if 'read_name' in chunks:
+                chunks['read_name'].append(raw[_CORE_SIZE:cigar_offset - 1].tobytes())
+                offsets['read_name'].append(offsets['read_name'][-1] + l_read_name - 1)
+            if 'seq' in chunks:
+                seq = ''.join(map(_SEQ_PAIRS.__getitem__, bytearray(raw[seq_offset:qual_offset])))[:l_seq]
+                chunks['seq'].append(seq.encode())
+                offsets['seq'].append(offsets['seq'][-1] + l_seq)
+            if 'qual' in chunks:
+                chunks['qual'].append(raw[qual_offset:tag_offset].tobytes())
+                offsets['qual'].append(offsets['qual'][-1] + l_seq)
+            if 'tags' in chunks:
+                chunks['tags'].append(raw[tag_offset:].tobytes())
+                offsets['tags'].append(offsets['tags'][-1] + len(raw) - tag_offset)
+
+        convert = cls._to_numpy if numpy else lambda column: column
+        columns = {}
+        for index, name, column in fixed:
+            columns[name] = convert(column)
+        if want_end:
+            columns['end'] = convert(end_column)
+        for name in chunks:
+            buf = cigar_column if name == 'cigar' else b''.join(chunks[name])
+            columns[name] = (convert(buf) if name == 'cigar' else buf, convert(offsets[name]))
+        return cls(columns, size)
+
+    @staticmethod
+    def _to_numpy(column):
+        """Wrap an :py:obj:`array.array` in a NumPy array without copying it"""
+        return _np.frombuffer(column, dtype=column.typecode)
+
+    @property
+    def fields(self):
+        """Names of the fields held by the batch"""
+        return [name for name, typecode in _BATCH_COLUMNS if name in self.columns] + \
+               [name for name in _BATCH_BUFFERS if name in self.columns]
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        """Gets the column of a field
+
+        Returns:
+            the array of a fixed-size field, or the (buffer, offsets) pair of a variable-length field
+
+        Raises:
+            KeyError: if the field was not decoded for the batch
+        """
+        try:
+            return self.columns[name]
+        except KeyError:
+            raise KeyError('{} was not decoded for this batch'.format(name))
+
+    def value(self, name, index):
+        """Gets the value of a variable-length field for a single read
+
+        Args:
+            name (str): name of the variable-length field
+            index (int): index of the read within the batch
+
+        Returns:
+            the read name or sequence (str), qualities or tags (bytes), or CIGAR operations (array)
+        """
+        buf, offsets = self[name]
+        value = buf[offsets[index]:offsets[index + 1]]
+        if name in ('read_name', 'seq'):
+            return value.decode()
+        return value
+
+    def __repr__(self):
+        return 'RecordBatch(size: {}, fields: {})'.format(self._size, ', '.join(self.fields))
@@ -39,6 +39,7 @@ SOFTWARE.
 """
 
 import struct
+from array import array as _array
 from collections import OrderedDict, namedtuple
 
 # Python 2 doesn't put abstract base classes in the same spot as Python 3
@@ -81,6 +82,13 @@ warnings.formatwarning = format_warnings
 unpack_int32 = struct.Struct('<i').unpack
 unpack_int32L = struct.Struct('<l').unpack
 
+# `array.array` only gained the unsigned 64-bit typecode in Python 3.3
+try:
+    _array('Q')
+    U64_TYPECODE = 'Q'
+except ValueError:
+    U64_TYPECODE = 'L'
+
 
 # Helper class for performant named indexing of region of interests
 class Roi(object):
@@ -481,7 +489,7 @@ class LruDict(OrderedDict):
         elif _PY_VERSION[:2] <= (3,2):
             self.move_to_end = self._py27_move_to_end
         else:
-            self.move_to_end = OrderedDict.move_to_end
+            self.move_to_end = super(LruDict, self).move_to_end
         self.cull()
 
     def get(self, key):
@@ -565,6 +573,128 @@ class LruDict(OrderedDict):
         self.cull()
 
 
+CacheStats = namedtuple('CacheStats', ('hits', 'misses', 'evictions', 'blocks', 'nbytes', 'max_bytes'))
+"""``namedtuple`` for reporting block cache usage
+
+    Args:
+        hits (int): number of lookups answered from the cache
+        misses (int): number of lookups that had to load the block from file
+        evictions (int): number of blocks dropped to respect the cache limits
+        blocks (int): number of blocks currently held
+        nbytes (int): decompressed bytes currently held
+        max_bytes (None|int): decompressed byte budget of the cache (None if unbounded)
+"""
+
+
+class BlockCache(LruDict):
+    """Least recently used (LRU) cache of decompressed BGZF blocks.
+
+    Values are `(data, block_size)` pairs as stored by the BGZF reader. The
+    cache is bounded by the number of blocks (`max_cache`) and, optionally, by
+    the total number of decompressed bytes it holds (`max_bytes`). Every
+    `lookup` renews the LRU status of the block, and the least recently used
+    blocks are evicted first. Hits, misses, and evictions are counted so the
+    cache's usefulness can be inspected.
+
+    Example:
+        >>> cache = BlockCache(max_bytes=10)
+        >>> cache[0] = (b'123456', 30)
+        >>> cache[30] = (b'1234', 20)
+        >>> cache.lookup(0)
+        (b'123456', 30)
+        >>> cache[50] = (b'12', 10)  # the block at 30 is now the least recently used
+        >>> sorted(cache.keys())
+        [0, 50]
+        >>> cache.lookup(30) is None
+        True
+        >>> cache.stats()
+        CacheStats(hits=1, misses=1, evictions=1, blocks=2, nbytes=8, max_bytes=10)
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Initialize the cache.
+
+        Args:
+            items (iterable): an iterable object of key/value pairs
+            max_cache (None|int): maximum number of blocks to hold (default: None, unbounded)
+            max_bytes (None|int): maximum number of decompressed bytes to hold (default: None, unbounded)
+
+        Raises:
+            ValueError: if `max_bytes` is set, but less than 1
+        """
+        self.max_bytes = kwargs.pop('max_bytes', None)
+        if self.max_bytes is not None and self.max_bytes < 1:
+            raise ValueError('Use max_bytes with a minimum of 1')
+        kwargs.setdefault('max_cache', None)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        super(BlockCache, self).__init__(*args, **kwargs)
+
+    def lookup(self, key, default=None):
+        """ Get a block, renewing its LRU status, and count the hit or miss
+
+        Args:
+            key (int): compressed offset of the block
+            default: value returned on a cache miss (default: None)
+
+        Returns:
+            the cached `(data, block_size)` pair or `default`
+        """
+        if OrderedDict.__contains__(self, key):
+            self.hits += 1
+            return self.get(key)
+        self.misses += 1
+        return default
+
+    def cull(self):
+        """ Evict the least recently used blocks until the cache is within its limits
+
+        The most recently added block is never evicted, even if it alone is
+        larger than `max_bytes`.
+        """
+        while len(self) > 1 and ((self.max_cache and len(self) > self.max_cache) or
+                                 (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            del self[next(iter(self))]
+            self.evictions += 1
+
+    def clear(self):
+        """ Drop every block from the cache (statistics are preserved) """
+        OrderedDict.clear(self)
+        self.nbytes = 0
+
+    def __setitem__(self, key, value):
+        """Add a block to the cache as the most recently used one, and then performs
+        cull() to ensure the limits have not been violated.
+
+        Args:
+            key (int): compressed offset of the block
+            value (tuple): the `(data, block_size)` pair
+        """
+        if OrderedDict.__contains__(self, key):
+            self.nbytes -= len(OrderedDict.__getitem__(self, key)[0])
+            OrderedDict.__setitem__(self, key, value)
+            self.move_to_end(key)
+        else:
+            OrderedDict.__setitem__(self, key, value)
+        self.nbytes += len(value[0])
+        self.cull()
+
+    def __delitem__(self, key):
+        self.nbytes -= len(OrderedDict.__getitem__(self, key)[0])
+        OrderedDict.__delitem__(self, key)
+
+    def stats(self):
+        """ Report the cache usage
+
+        Returns:
+            (:py:class:`CacheStats`): hit, miss, and eviction counts as well as current occupancy
+        """
+        return CacheStats(self.hits, self.misses, self.evictions, len(self), self.nbytes, self.max_bytes)
+
+
 # The BAM format uses byte encoding to compress alignment data. One such
 # compression is how operations are stored: they are stored and an
 # array of integers. These integers are mapped to their respective
@@ -1,7 +1,42 @@
 #!/usr/bin/env python
+import struct
+
 import bamnostic as bs
 import pytest
 
+_SEQ_CODES = '=ACMGRSVTWYHKDBN'
+
+
+def _bam_record(ref_id, pos, name, cigar=(), seq='', qual=None, tags=b'', flag=0, mapq=60):
+    """Encodes a BAM record (with its block_size prefix). `cigar` holds (op, length) pairs,
+    and `qual` the Phred scores (None for missing qualities)."""
+    ref_length = sum(length for op, length in cigar if op in (0, 2, 3, 7, 8))
+    bin_id = bs.bai.reg2bin(pos, pos + max(ref_length, 1)) if pos >= 0 else 4680
+    codes = [_SEQ_CODES.index(base) for base in seq] + [0]
+    packed = bytearray(codes[i] << 4 | codes[i + 1] for i in range(0, len(seq), 2))
+    qual = bytearray([0xFF] * len(seq) if qual is None else qual)
+    name = name.encode() + b'\x00'
+    data = struct.pack('<2i2I4i', ref_id, pos, bin_id << 16 | mapq << 8 | len(name),
+                       flag << 16 | len(cigar), len(seq), -1, -1, 0)
+    data += name + b''.join(struct.pack('<I', length << 4 | op) for op, length in cigar)
+    data += bytes(packed) + bytes(qual) + tags
+    return struct.pack('<i', len(data)) + data
+
+
+def _write_bam(path, refs, records):
+    """Writes a BAM file of the given (name, length) references and encoded records"""
+    text = ''.join('@SQ\tSN:{}\tLN:{}\n'.format(name, length) for name, length in refs).encode()
+    header = struct.pack('<4si', b'BAM\x01', len(text)) + text + struct.pack('<i', len(refs))
+    for name, length in refs:
+        header += struct.pack('<i', len(name) + 1) + name.encode() + b'\x00' + struct.pack('<i', length)
+    writer = bs.bgzf.BgzfWriter(path, 'wb')
+    writer.write(header)
+    for record in records:
+        writer.write(record)
+    writer.close()
+    return path
+
+
 def test_header():
     with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
         expected = {0: ('chr1', 1575), 1: ('chr2', 1584)}
@@ -13,3 +48,479 @@ def test_first_read():
     with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
         first_read = next(bam)
         assert first_read.read_name == 'EAS56_57:6:190:289:82'
+
+
+def test_threaded_readahead():
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        expected = [read.read_name for read in bam]
+    with bs.AlignmentFile(bs.example_bam, 'rb', threads=4) as bam:
+        observed = [read.read_name for read in bam]
+    assert observed == expected
+
+
+def test_mmap_matches_handle_io():
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        expected = [(read.read_name, read.pos, read.seq) for read in bam]
+    with bs.AlignmentFile(bs.example_bam, 'rb', mmap=True) as bam:
+        assert bam.head(n=1)[0].read_name == expected[0][0]
+        observed = [(read.read_name, read.pos, read.seq) for read in bam]
+    assert observed == expected
+
+
+def test_block_index_roundtrip(tmpdir):
+    gzi = str(tmpdir.join('example.bam.gzi'))
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        built = bam.block_index
+        bam.save_block_index(gzi)
+    loaded = bs.bgzf.BlockIndex.load(gzi)
+    assert loaded.coffsets == built.coffsets
+    assert loaded.uoffsets == built.uoffsets
+    assert loaded.virtual_offset(100000) == built.virtual_offset(100000)
+
+
+def test_stream_from_pipe():
+    import subprocess
+    import sys
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        expected = [read.read_name for read in bam]
+        header_block = bam._header.to_header()
+    cat = subprocess.Popen([sys.executable, '-c',
+                            'import shutil, sys; shutil.copyfileobj(open(sys.argv[1], "rb"), sys.stdout.buffer)',
+                            bs.example_bam], stdout=subprocess.PIPE)
+    with bs.AlignmentFile(cat.stdout, 'rb') as bam:
+        assert bam._header.to_header() == header_block
+        observed = [read.read_name for read in bam]
+    cat.wait()
+    assert observed == expected
+
+
+def test_fetch_batches_match_fetch():
+    fields = ['refID', 'pos', 'mapq', 'flag', 'end', 'read_name', 'seq']
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        expected = [(read.refID, read.pos, read.mapq, read.flag, read.reference_end or -1, read.read_name, read.seq)
+                    for read in bam.fetch('chr2', 100, 1000)]
+        observed = []
+        for batch in bam.fetch_batches('chr2', 100, 1000, batch_size=64, fields=fields):
+            assert len(batch) <= 64
+            for i in range(len(batch)):
+                observed.append(tuple(batch[name][i] for name in fields[:5]) +
+                                (batch.value('read_name', i), batch.value('seq', i)))
+    assert observed == expected
+
+
+def test_numpy_batches_match_array_batches():
+    np = pytest.importorskip('numpy')
+    fields = [name for name, typecode in bs.core._BATCH_COLUMNS] + list(bs.core._BATCH_BUFFERS)
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        expected = list(bam.fetch_batches('chr1', 100, 1000, batch_size=100, fields=fields, numpy=False))
+        observed = list(bam.fetch_batches('chr1', 100, 1000, batch_size=100, fields=fields, numpy=True))
+    assert [len(batch) for batch in observed] == [len(batch) for batch in expected]
+    for numpy_batch, array_batch in zip(observed, expected):
+        for name, typecode in bs.core._BATCH_COLUMNS:
+            assert isinstance(numpy_batch[name], np.ndarray)
+            assert numpy_batch[name].dtype == np.dtype(typecode)
+            assert numpy_batch[name].tolist() == list(array_batch[name])
+        for name in bs.core._BATCH_BUFFERS:
+            assert numpy_batch[name][1].tolist() == list(array_batch[name][1])
+            for i in range(len(array_batch)):
+                assert list(numpy_batch.value(name, i)) == list(array_batch.value(name, i))
+
+
+def _core_fields_of_reads(numpy):
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        expected = [(read.refID, read.pos, read.mapq, read.flag, read.tlen) for read in bam]
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        observed = []
+        for fields in bam.iter_core_fields(numpy=numpy):
+            observed.extend(zip(*[[int(value) for value in fields[name]]
+                                  for name in ('refID', 'pos', 'mapq', 'flag', 'tlen')]))
+    return observed, expected
+
+
+def test_iter_core_fields_match_reads():
+    observed, expected = _core_fields_of_reads(numpy=False)
+    assert observed == expected
+
+
+def test_numpy_core_fields_match_reads():
+    pytest.importorskip('numpy')
+    observed, expected = _core_fields_of_reads(numpy=True)
+    assert observed == expected
+
+
+def test_fetch_filters_match_post_filtering():
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        expected = [read.read_name for read in bam.fetch('chr1', 100, 1000)
+                    if read.flag & 0x40 and not read.flag & 0x704 and read.mapq >= 30 and
+                    read.reference_end is not None and read.reference_end >= 300]
+        observed = [read.read_name for read in bam.fetch('chr1', 100, 1000, require_flags=0x40,
+                                                         exclude_flags=0x704, min_mapq=30, min_end=300)]
+    assert expected and observed == expected
+
+
+def test_projected_fields_match_reads():
+    fields = ('read_name', 'pos', 'mapq', 'cigartuples', 'reference_end', 'tlen')
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        expected = [tuple(getattr(read, field) for field in fields) for read in bam.fetch('chr2', 0, 1000)]
+    with bs.AlignmentFile(bs.example_bam, 'rb', fields=fields) as bam:
+        observed = [tuple(record) for record in bam.fetch('chr2', 0, 1000)]
+        assert bam.count('chr2', 0, 1000, read_callback=lambda read: read.is_paired) == len(expected)
+    assert observed == expected
+
+
+def test_scan_reuse_matches_reads():
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        expected = [repr(read) for read in bam]
+    for reuse in (False, True, 3):
+        with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+            observed = [repr(read) for read in bam.scan(reuse=reuse)]
+        assert observed == expected
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        # Reused reads view the record in the decompressed block, and decode nothing up front
+        read = next(bam.scan(reuse=True))
+        assert isinstance(read._raw_stream, memoryview)
+        assert read._cigar is None and read._seq is None and read._tags is None
+        assert repr(read) == expected[0]
+
+
+def test_pickled_reads_roundtrip():
+    import pickle
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        reads = list(bam)
+    copies = pickle.loads(pickle.dumps(reads))
+    assert [repr(read) for read in copies] == [repr(read) for read in reads]
+    assert [read.reference_name for read in copies] == [read.reference_name for read in reads]
+
+
+def test_to_sam_matches_reads(tmpdir):
+    sam = str(tmpdir.join('example.sam'))
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        reads = list(bam)
+        assert bam.to_sam(sam) == len(reads)
+    with open(sam) as handle:
+        lines = [line.rstrip('\n').split('\t') for line in handle if not line.startswith('@')]
+    assert len(lines) == len(reads)
+    for line, read in zip(lines, reads):
+        assert line[:6] == repr(read).split('\t')[:6]
+        assert line[9:11] == [read.seq, read.qual]
+        assert sorted(field[:2] for field in line[11:]) == sorted(read.tags)
+
+
+def test_bai_queries_across_references():
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        records = [(voffset, bs.core._unpack_core_from(raw, 4)[:2], bs.core.raw_reference_end(raw))
+                   for voffset, raw in bam.iter_raw()]
+    regions = [(tid, start, start + 100) for start in range(0, 1500, 50) for tid in (0, 1)]
+    bai = bs.bai.Bai(bs.example_bam + '.bai')
+    # Offsets found by the original, stream-based parser of the index
+    assert [bai.query(*region) for region in regions] == [3473408, 3567918741] * (len(regions) // 2)
+    for tid, start, stop in regions:
+        chunks = bai.query_chunks(tid, start, stop)
+        overlapping = [voffset for voffset, (ref_id, pos), end in records
+                       if ref_id == tid and pos < stop and (end or pos + 1) > start]
+        assert overlapping and all(any(beg <= voffset < end for beg, end in chunks) for voffset in overlapping)
+        assert bai.query(tid, start, stop) <= overlapping[0]
+    ref = bai.get_ref(1)
+    assert ref.ref_id == 1 and list(ref.intervals) == list(bai._intervals[ref.ioffset:])
+    assert sorted(ref.bins) == list(ref.bin_ids)
+
+
+def test_fetch_chunks_match_full_scan():
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        reads = [(read.refID, read.pos, read.read_name) for read in bam]
+        for tid, start, stop in ((0, 0, 50), (0, 300, 900), (1, 1000, 1584), (1, 10, 11)):
+            expected = [name for ref_id, pos, name in reads if ref_id == tid and start <= pos <= stop]
+            observed = [read.read_name for read in bam.fetch(tid=tid, start=start, stop=stop)]
+            assert observed == expected
+            chunks = bam._index.query_chunks(tid, start, stop)
+            assert all(beg < end <= next_beg for (beg, end), (next_beg, _) in zip(chunks, chunks[1:]))
+
+
+def test_fetch_many_matches_fetch():
+    regions = [('chr2', 500, 700), 'chr1:100-300', ('chr1', 250, 400), ('chr2', 10, 20), ('chr1', 1000, 1575)]
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        expected = sorted((i, read.read_name, read.pos, read.flag)
+                          for i, region in enumerate(regions)
+                          for read in (bam.fetch(*region) if isinstance(region, tuple) else bam.fetch(region=region)))
+        observed = sorted((i, read.read_name, read.pos, read.flag) for i, read in bam.fetch_many(regions))
+        assert observed == expected
+        deduped = [(indices, read.read_name) for indices, read in bam.fetch_many(regions, dedup=True)]
+        assert sum(len(indices) for indices, name in deduped) == len(expected)
+
+
+def test_build_index_matches_samtools(tmpdir):
+    bai = str(tmpdir.join('example.bam.bai'))
+    assert bs.bai.build_index(bs.example_bam, bai) == bai
+    with open(bai, 'rb') as built, open(bs.example_bam + '.bai', 'rb') as expected:
+        built, expected = built.read(), expected.read()
+    # The bundled index predates samtools adding placed unmapped reads to the linear index.
+    # The first read of chr1 is one, so the first window of chr1 is all that differs.
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        first_voffset = next(bam.iter_raw())[0]
+    old_window = struct.pack('<Q', 3473523)
+    assert expected.count(old_window) == 1
+    window = expected.index(old_window)
+    assert built == expected[:window] + struct.pack('<Q', first_voffset) + expected[window + 8:]
+
+
+def test_csi_index_matches_bai(tmpdir):
+    regions = [(tid, start, start + 200) for start in range(0, 1600, 100) for tid in (0, 1)]
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        expected = [[read.read_name for read in bam.fetch(tid=tid, start=start, stop=stop)]
+                    for tid, start, stop in regions]
+    for min_shift, depth in ((14, 5), (10, 7)):
+        csi = bs.bai.build_index(bs.example_bam, str(tmpdir.join('example.bam.csi')),
+                                 csi=True, min_shift=min_shift, depth=depth)
+        with bs.AlignmentFile(bs.example_bam, 'rb', index_filename=csi) as bam:
+            assert isinstance(bam._index, bs.bai.Csi)
+            assert (bam.mapped, bam.unmapped) == (3235, 35)
+            observed = [[read.read_name for read in bam.fetch(tid=tid, start=start, stop=stop)]
+                        for tid, start, stop in regions]
+        assert observed == expected
+
+
+def test_block_cache_byte_budget():
+    cache = bs.utils.BlockCache(max_bytes=10)
+    cache[0] = (b'1234', 10)
+    cache[10] = (b'123', 10)
+    cache[20] = (b'12', 10)
+    assert cache.lookup(0) == (b'1234', 10)  # the block at 10 is now the least recently used
+    cache[30] = (b'12', 10)
+    assert list(cache.keys()) == [20, 0, 30] and cache.nbytes == 8
+    cache[20] = (b'12345', 10)  # overwriting replaces the block's bytes and renews it
+    assert list(cache.keys()) == [30, 20] and cache.nbytes == 7
+    assert cache.lookup(0) is None and cache.lookup(30) == (b'12', 10)
+    assert cache.stats() == bs.utils.CacheStats(hits=2, misses=1, evictions=2, blocks=2, nbytes=7, max_bytes=10)
+    cache.clear()
+    assert cache.stats() == bs.utils.CacheStats(hits=2, misses=1, evictions=2, blocks=0, nbytes=0, max_bytes=10)
+
+
+def test_shared_cache_across_readers(tmpdir):
+    import os
+    import shutil
+    path = str(tmpdir.join('example.bam'))
+    shutil.copyfile(bs.example_bam, path)
+    bs.bgzf.enable_shared_cache(max_bytes=2**26)
+    try:
+        with bs.AlignmentFile(path, 'rb') as bam:
+            expected = [read.read_name for read in bam]
+        first = bs.bgzf.shared_cache_stats()
+        assert first.misses > 0 and first.blocks > 0
+        with bs.AlignmentFile(path, 'rb') as bam:
+            assert [read.read_name for read in bam] == expected
+        second = bs.bgzf.shared_cache_stats()
+        assert second.misses == first.misses and second.hits > first.hits
+
+        # A rewritten file (new modification time) must not be served the old blocks
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+        with bs.AlignmentFile(path, 'rb') as bam:
+            assert [read.read_name for read in bam] == expected
+        third = bs.bgzf.shared_cache_stats()
+        assert third.misses - second.misses == first.misses
+        assert third.blocks == 2 * first.blocks
+
+        # Neither must a file whose size changed, even with its modification time restored
+        stat = os.stat(path)
+        with open(path, 'ab') as handle:
+            handle.write(bs.bgzf._bgzf_eof)
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+        with bs.AlignmentFile(path, 'rb') as bam:
+            assert [read.read_name for read in bam] == expected
+        assert bs.bgzf.shared_cache_stats().misses > third.misses
+    finally:
+        bs.bgzf.disable_shared_cache()
+    assert bs.bgzf.shared_cache_stats() is None
+
+
+def test_lazy_reads_match_eager_reads():
+    fields = ('read_name', 'flag', 'pos', 'mapq', 'cigartuples', 'seq', 'qual', 'tags', 'reference_end')
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        expected = [tuple(getattr(read, field) for field in fields) + (list(read.query_qualities), repr(read))
+                    for read in bam]
+    with bs.AlignmentFile(bs.example_bam, 'rb', lazy=True) as bam:
+        read = next(bam)
+        assert read._seq is None and read._qual is None and read._tags is None
+        assert read.seq == expected[0][5]
+        assert read._qual is None and read._tags is None
+        observed = [tuple(getattr(read, field) for field in fields) + (list(read.query_qualities), repr(read))
+                    for read in bam]
+    assert observed == expected[1:]
+
+
+def test_parse_variable_length_sections(tmpdir):
+    # Enough records for some of them to span BGZF blocks
+    expected = []
+    records = []
+    for i in range(3000):
+        name = 'read{}'.format(i) * (1 + i % 7)
+        cigar = [] if i % 5 == 0 else [(4, i % 3), (0, 20 + i % 11), (1, 2)]
+        seq = 'ACGTN'[i % 5] * (0 if i % 5 == 0 else 22 + i % 11 + i % 3)
+        qual = [(i + j) % 41 for j in range(len(seq))]
+        tags = struct.pack('<2sci', b'NM', b'i', i) + b'XZZ' + name.encode() + b'\x00'
+        records.append(_bam_record(0, i, name, cigar, seq, qual, tags, mapq=i % 61))
+        expected.append((name, i, i % 61, cigar or None, seq, qual, {'NM': ('i', i), 'XZ': ('Z', name)}))
+    path = _write_bam(str(tmpdir.join('sections.bam')), [('chr1', 10000)], records)
+    for lazy in (False, True):
+        with bs.AlignmentFile(path, 'rb', lazy=lazy) as bam:
+            observed = [(read.read_name, read.pos, read.mapq, read.cigartuples, read.seq,
+                         list(read.query_qualities), read.tags) for read in bam]
+        assert observed == expected
+
+
+def test_decode_sequence_and_missing_qualities(tmpdir):
+    seq = (_SEQ_CODES * 2)[:31]  # every base code, and an odd length
+    records = [_bam_record(0, 10, 'all_codes', [(0, 31)], seq, list(range(31))),
+               _bam_record(0, 20, 'no_quals', [(0, 31)], seq, None),
+               _bam_record(0, 30, 'no_seq')]
+    path = _write_bam(str(tmpdir.join('codes.bam')), [('chr1', 1000)], records)
+    sam = str(tmpdir.join('codes.sam'))
+    for lazy in (False, True):
+        with bs.AlignmentFile(path, 'rb', lazy=lazy) as bam:
+            full, missing, empty = list(bam)
+            bam.seek(0)
+            bam.to_sam(sam, header=False)
+        assert full.seq == seq and full.qual == ''.join(chr(33 + q) for q in range(31))
+        assert list(full.query_qualities) == list(range(31))
+        assert missing.seq == seq and missing.qual == '*'
+        assert list(missing.query_qualities) == [0xFF] * 31
+        assert (empty.seq, empty.qual, list(empty.query_qualities)) == ('', '', [])
+        with open(sam) as handle:
+            assert [line.rstrip('\n').split('\t')[9:11] for line in handle] == [[seq, full.qual], [seq, '*'], ['*', '*']]
+
+
+def test_get_tag_from_raw_tags(tmpdir):
+    tags = (b'XBBc' + struct.pack('<i3b', 3, -1, 0, 1) +
+            b'YBBS' + struct.pack('<i2H', 2, 1, 65535) +
+            b'ZBBf' + struct.pack('<i2f', 2, 0.5, -2.0) +
+            b'XHH1ae301\x00' +
+            b'XFf' + struct.pack('<f', 1.5) +
+            b'XAAx' +
+            b'XII' + struct.pack('<I', 4000000000) +
+            b'XZZlast\x00')
+    path = _write_bam(str(tmpdir.join('tags.bam')), [('chr1', 1000)],
+                      [_bam_record(0, 10, 'tagged', [(0, 4)], 'ACGT', [30] * 4, tags)])
+    expected = {'XB': ('B', [-1, 0, 1]), 'YB': ('B', [1, 65535]), 'ZB': ('B', [0.5, -2.0]),
+                'XH': ('H', '1AE301'), 'XF': ('f', 1.5), 'XA': ('A', 'x'), 'XI': ('I', 4000000000),
+                'XZ': ('Z', 'last')}
+    with bs.AlignmentFile(path, 'rb', lazy=True) as bam:
+        read = next(bam)
+        for tag, (val_type, value) in sorted(expected.items()):
+            observed = read.get_tag(tag)
+            assert (list(observed) if val_type == 'B' else observed) == value
+            assert read.get_tag(tag, with_value_type=True)[1] == val_type
+        with pytest.raises(KeyError):
+            read.get_tag('NM')
+        # Single tags are looked up without decoding all of them
+        assert read._tags is None
+        assert dict((tag, (val_type, list(value) if val_type == 'B' else value))
+                    for tag, (val_type, value) in read.tags.items()) == expected
+
+
+def test_cigar_coordinates_of_spliced_and_clipped_reads(tmpdir):
+    spliced = [(5, 5), (4, 3), (0, 10), (1, 2), (0, 5), (3, 100), (0, 7), (2, 1), (0, 4), (4, 2), (5, 4)]
+    mismatched = [(4, 2), (7, 3), (8, 1), (7, 4)]
+    seq = 'ACGT' * 10
+    records = [_bam_record(0, 100, 'spliced', spliced, seq[:33], [30] * 33),
+               _bam_record(0, 150, 'mismatched', mismatched, seq[:10], [30] * 10),
+               _bam_record(0, 200, 'no_seq', [(0, 10)]),
+               _bam_record(0, 300, 'unmapped', [], seq[:8], [30] * 8, flag=4)]
+    path = _write_bam(str(tmpdir.join('cigar.bam')), [('chr1', 1000)], records)
+    with bs.AlignmentFile(path, 'rb') as bam:
+        spliced, mismatched, no_seq, unmapped = list(bam)
+    assert spliced.cigarstring == '5H3S10M2I5M100N7M1D4M2S4H'
+    assert spliced.get_blocks() == [(100, 110), (110, 115), (215, 222), (223, 227)]
+    assert (spliced.reference_start, spliced.reference_end, spliced.reference_length) == (100, 227, 127)
+    assert (spliced.query_alignment_start, spliced.query_alignment_end, spliced.query_alignment_length) == (3, 31, 28)
+    assert spliced.query_alignment_sequence == seq[3:31] and spliced.query_length == 33
+
+    assert mismatched.get_blocks() == [(150, 153), (153, 154), (154, 158)]
+    assert (mismatched.query_alignment_start, mismatched.query_alignment_end,
+            mismatched.query_alignment_length, mismatched.reference_end) == (2, 10, 8, 158)
+
+    assert no_seq.get_blocks() == [(200, 210)] and no_seq.query_alignment_length == 0
+
+    assert unmapped.get_blocks() == []
+    assert (unmapped.query_alignment_start, unmapped.query_alignment_end, unmapped.query_alignment_length,
+            unmapped.reference_end) == (None, None, None, None)
+
+
+def test_slotted_reads():
+    fields = ('seq', 'qual', 'tags', 'cigartuples', 'reference_end')
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        eager = list(bam)
+    with bs.AlignmentFile(bs.example_bam, 'rb', lazy=True) as bam:
+        lazy = list(bam)
+    assert len(lazy) == len(eager)
+    for lazy_read, eager_read in zip(lazy, eager):
+        assert not hasattr(lazy_read, '__dict__') and not hasattr(eager_read, '__dict__')
+        for field in fields:
+            assert getattr(lazy_read, field) == getattr(eager_read, field)
+    with pytest.raises(AttributeError):
+        eager[0].not_a_field = None
+
+
+def test_build_index_counts_placed_unmapped_reads(tmpdir):
+    import random
+    rng = random.Random(0)
+
+    def padding():
+        # Poorly compressible tags, so that every bin spans enough of the file not to be merged into its parent
+        return b'XBBC' + struct.pack('<i', 150000) + bytes(bytearray(rng.getrandbits(4) for _ in range(150000)))
+
+    records = [_bam_record(0, 100, 'mapped0', [(0, 50)], 'A' * 50, [30] * 50, padding()),
+               _bam_record(0, 20000, 'unmapped1', [], 'C' * 50, [30] * 50, padding(), flag=4),
+               _bam_record(0, 20010, 'mapped1', [(0, 50)], 'G' * 50, [30] * 50),
+               _bam_record(0, 40000, 'unmapped2', [], 'T' * 50, [30] * 50, padding(), flag=4),
+               _bam_record(0, 50000, 'mapped3', [(0, 50)], 'A' * 50, [30] * 50, padding())]
+    path = _write_bam(str(tmpdir.join('placed.bam')), [('chr1', 100000)], records)
+    with bs.AlignmentFile(path, 'rb') as bam:
+        voffsets = dict((bs.core._unpack_core_from(raw, 4)[1], voffset) for voffset, raw in bam.iter_raw())
+
+    # The first read of windows 1 and 2 (16384 bp each) is a placed unmapped read
+    bai = bs.bai.load_index(bs.bai.build_index(path))
+    assert list(bai.get_ref(0).intervals) == [voffsets[100], voffsets[20000], voffsets[40000], voffsets[50000]]
+    assert (bai.unmapped[0].n_mapped, bai.unmapped[0].n_unmapped) == (3, 2)
+
+    csi = bs.bai.load_index(bs.bai.build_index(path, csi=True))
+    ref = csi.get_ref(0)
+    loffsets = dict(zip(ref.bin_ids, ref.bin_loffsets))
+    assert (loffsets[4682], loffsets[4683]) == (voffsets[20000], voffsets[40000])
+
+    with bs.AlignmentFile(path, 'rb') as bam:
+        assert [read.read_name for read in bam.fetch('chr1', 20000, 20001)] == ['unmapped1']
+        assert [read.read_name for read in bam.fetch('chr1', 39000, 45000)] == ['unmapped2']
+
+
+def test_readahead_depth_after_forward_seek():
+    with bs.AlignmentFile(bs.example_bam, 'rb', threads=2) as bam:
+        offsets = list(bam.block_index.coffsets)
+        assert sorted(bam._readahead) == offsets[1:5]
+        # Jump past two of the blocks being read ahead, to one that is read ahead too
+        for i in (3, 5, 7):
+            bam._load_block(offsets[i])
+            assert sorted(bam._readahead) == offsets[i + 1:i + 5]
+        expected = [read.read_name for read in bam.fetch('chr2', 1000, 1500)]
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        assert [read.read_name for read in bam.fetch('chr2', 1000, 1500)] == expected
+
+
+def test_stream_without_eof_marker(tmpdir):
+    import subprocess
+    import sys
+    with bs.AlignmentFile(bs.example_bam, 'rb') as bam:
+        expected = [read.read_name for read in bam]
+    path = str(tmpdir.join('truncated.bam'))
+    with open(bs.example_bam, 'rb') as handle, open(path, 'wb') as truncated:
+        data = handle.read()
+        assert data.endswith(bs.bgzf._bgzf_eof)
+        truncated.write(data[:-len(bs.bgzf._bgzf_eof)])
+    for threads in (1, 2):
+        cat = subprocess.Popen([sys.executable, '-c',
+                                'import shutil, sys; shutil.copyfileobj(open(sys.argv[1], "rb"), sys.stdout.buffer)',
+                                path], stdout=subprocess.PIPE)
+        with bs.AlignmentFile(cat.stdout, 'rb', ignore_truncation=True, threads=threads) as bam:
+            observed = [read.read_name for read in bam]
+            assert bam._truncated
+        cat.wait()
+        assert observed == expected